@@ -1,21 +1,97 @@
 import os
-from flask import Flask
+from flask import Flask, request, g, jsonify
 from flask_cors import CORS
-from controllers import health_controller, chat_controller
+from controllers import health_controller, chat_controller, admin_controller, conversations_controller
 from config import Config
+from utils.deadline import deadline_from_request, set_deadline, reset_deadline
+from utils.memory import start_memory_monitor
+from utils.responses import install_response_layer
+from utils.tenancy import UnknownTenant, configured_tenants, reset_tenant, set_tenant, tenant_from_request
+from utils.tracing import KIND_SERVER, begin_span, finish_span
 
 def create_app():
     app = Flask(__name__)
+    install_response_layer(app)
     
     # Enable CORS for all routes
     CORS(app, origins=['http://localhost:3000', 'http://127.0.0.1:3000', 'https://*'])
     
     from services.database_service import init_database
+    from services.scenario_classifier import get_classifier
+    from services.conversation_query import conversation_index
+    from services.prompt_store import prompt_store_for
     
     init_database()
+    start_memory_monitor()
+    
+    # Serve each tenant's prompt from its local snapshot from the first request on
+    for tenant in configured_tenants():
+        prompt_store_for(tenant).ensure_loaded()
+    
+    # Load (or train) the scenario classifier before the first request needs it
+    if Config.SCENARIO_ROUTING_ENABLED:
+        get_classifier()
+    
+    # Warm the conversation listing index (Firestore listener or local corpus)
+    conversation_index.start()
+    
+    @app.before_request
+    def start_request_deadline():
+        # Every downstream call in this request gets the remaining budget
+        g.deadline_token = set_deadline(deadline_from_request(request))
+    
+    @app.teardown_request
+    def clear_request_deadline(exc=None):
+        token = g.pop('deadline_token', None)
+        if token is not None:
+            reset_deadline(token)
+    
+    @app.before_request
+    def start_request_span():
+        # Continues the caller's trace when the request carries a traceparent header
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        g.trace_span, g.trace_token = begin_span(f"{request.method} {route}", request.headers.get('traceparent'),
+                                                 kind=KIND_SERVER,
+                                                 attributes={'http.method': request.method, 'http.route': route})
+    
+    @app.after_request
+    def tag_request_span(response):
+        span = g.get('trace_span')
+        if span is not None:
+            span.set_attributes({'http.status_code': response.status_code})
+            if response.status_code >= 500:
+                span.set_error(f"HTTP {response.status_code}")
+            response.headers['traceparent'] = span.traceparent
+        return response
+    
+    @app.teardown_request
+    def end_request_span(exc=None):
+        span = g.pop('trace_span', None)
+        if span is not None:
+            finish_span(span, g.pop('trace_token'), exc)
+    
+    @app.before_request
+    def resolve_tenant():
+        # Prompts, sessions, caches and model-call limits below are all the tenant's own
+        try:
+            tenant = tenant_from_request(request)
+        except UnknownTenant as e:
+            return jsonify({'error': str(e)}), 404
+        g.tenant_token = set_tenant(tenant)
+        span = g.get('trace_span')
+        if span is not None:
+            span.set_attributes({'tenant.id': tenant})
+    
+    @app.teardown_request
+    def clear_tenant(exc=None):
+        token = g.pop('tenant_token', None)
+        if token is not None:
+            reset_tenant(token)
     
     app.register_blueprint(health_controller.bp)
     app.register_blueprint(chat_controller.chat_controller)
+    app.register_blueprint(admin_controller.admin_controller)
+    app.register_blueprint(conversations_controller.conversations_controller)
     
     return app
 
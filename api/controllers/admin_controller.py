@@ -0,0 +1,180 @@
+from flask import Blueprint, request, jsonify, send_file, Response
+from controllers.chat_controller import ai_service, improve_queue, shadow_evaluator, speculator
+from services.conversation_query import conversation_index
+from services.generation_profiles import generation_stats
+from services.interaction_log import interaction_log
+from services.prompt_store import prompt_store_for, prompt_stores
+from utils.idempotency import idempotency_store
+from utils.profiler import profile_store
+from utils.responses import response_stats
+from utils.session_manager import tenant_session_counts
+from utils.tenancy import admin_access_error, configured_tenants
+from utils.tracing import exporter as trace_exporter
+from utils.memory import memory_report, take_snapshot, snapshot_diff, enforce_soft_limit
+
+admin_controller = Blueprint('admin', __name__, url_prefix='/admin')
+
+@admin_controller.before_request
+def require_admin_token():
+    """Restrict admin endpoints to the default tenant, behind X-Admin-Token when ADMIN_TOKEN is configured"""
+    denial = admin_access_error(request)
+    if denial:
+        message, status = denial
+        return jsonify({'error': message}), status
+
+@admin_controller.route('/profiles', methods=['GET'])
+def list_profiles():
+    """List captured request profiles"""
+    return jsonify(profile_store.list())
+
+@admin_controller.route('/profiles', methods=['DELETE'])
+def clear_profiles():
+    """Drop all captured profiles and aggregates"""
+    profile_store.clear()
+    return jsonify({'message': 'Profiles cleared'})
+
+@admin_controller.route('/profiles/aggregate.folded', methods=['GET'])
+def download_aggregate_profile():
+    """Collapsed stacks summed over all profiled requests (?endpoint= to filter)"""
+    folded = profile_store.aggregate_folded(request.args.get('endpoint'))
+    return Response(folded, mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=aggregate.folded'})
+
+@admin_controller.route('/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """Download one profile as collapsed stacks (?format=folded) or pstats (?format=prof)"""
+    entry = profile_store.get(profile_id)
+    if not entry:
+        return jsonify({'error': 'profile not found'}), 404
+    
+    file_format = request.args.get('format', 'folded')
+    path = entry['files'].get(file_format)
+    if not path:
+        return jsonify({'error': f'format {file_format} not available for this profile'}), 404
+    
+    return send_file(path, as_attachment=True, download_name=f"{profile_id}.{file_format}")
+
+@admin_controller.route('/memory', methods=['GET'])
+def get_memory():
+    """Process RSS and per-structure memory accounting"""
+    return jsonify(memory_report())
+
+@admin_controller.route('/memory/snapshots', methods=['POST'])
+def create_memory_snapshot():
+    """Take a tracemalloc snapshot now (starts tracing if needed)"""
+    take_snapshot()
+    return jsonify(snapshot_diff(top=request.args.get('top', 20, type=int)))
+
+@admin_controller.route('/memory/snapshots', methods=['GET'])
+def get_memory_snapshot_diff():
+    """Top allocation growth between the two latest tracemalloc snapshots"""
+    return jsonify(snapshot_diff(top=request.args.get('top', 20, type=int),
+                                 group_by=request.args.get('groupBy', 'lineno')))
+
+@admin_controller.route('/memory/evict', methods=['POST'])
+def evict_memory():
+    """Run soft-limit eviction immediately"""
+    return jsonify({'evicted': enforce_soft_limit()})
+
+@admin_controller.route('/generation', methods=['GET'])
+def get_generation_stats():
+    """Generation profiles in effect with per-profile truncation rate and output tokens"""
+    return jsonify(generation_stats())
+
+@admin_controller.route('/shadow', methods=['GET'])
+def get_shadow_report():
+    """Candidate prompt under shadow evaluation, its comparison with the primary and past decisions"""
+    return jsonify(shadow_evaluator.report())
+
+@admin_controller.route('/shadow/promote', methods=['POST'])
+def promote_shadow_candidate():
+    """Commit the candidate prompt now, regardless of thresholds"""
+    try:
+        candidate = shadow_evaluator.promote()
+        if not candidate:
+            return jsonify({'error': 'no candidate under evaluation'}), 404
+        return jsonify(candidate)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@admin_controller.route('/shadow/reject', methods=['POST'])
+def reject_shadow_candidate():
+    """Discard the candidate prompt; production keeps the primary"""
+    candidate = shadow_evaluator.reject()
+    if not candidate:
+        return jsonify({'error': 'no candidate under evaluation'}), 404
+    return jsonify(candidate)
+
+@admin_controller.route('/interaction-log', methods=['GET'])
+def get_interaction_log():
+    """Interaction log segments, buffer and shipping counters"""
+    return jsonify(interaction_log.report())
+
+@admin_controller.route('/interaction-log/rotate', methods=['POST'])
+def rotate_interaction_log():
+    """Close the active segment so the shipper picks it up on its next pass"""
+    interaction_log.rotate()
+    return jsonify({'message': 'Rotation requested'})
+
+@admin_controller.route('/keys', methods=['GET'])
+def get_key_pool():
+    """Per-key rate budgets, parking and usage when several API keys are configured"""
+    backend = ai_service.backend
+    if not hasattr(backend, 'report'):
+        return jsonify({'keys': [], 'message': 'key pool not in use'})
+    return jsonify(backend.report())
+
+@admin_controller.route('/idempotency', methods=['GET'])
+def get_idempotency_store():
+    """Stored Idempotency-Key results and replay/attach counters"""
+    return jsonify(idempotency_store.report())
+
+@admin_controller.route('/conversation-index', methods=['GET'])
+def get_conversation_index():
+    """Source, readiness and size of the conversation listing index"""
+    return jsonify(conversation_index.report())
+
+@admin_controller.route('/prompt-store', methods=['GET'])
+def get_prompt_store():
+    """Prompt history replica of a tenant (?tenant=, default tenant without it): source, head, version and blob counts, snapshot path"""
+    tenant = request.args.get('tenant')
+    if tenant and tenant not in configured_tenants():
+        return jsonify({'error': f'Unknown tenant: {tenant[:64]}'}), 404
+    return jsonify(prompt_store_for(tenant).report())
+
+@admin_controller.route('/responses', methods=['GET'])
+def get_response_stats():
+    """JSON encoder in use and per-endpoint serialization/compression cost"""
+    return jsonify(response_stats.report())
+
+@admin_controller.route('/scheduler', methods=['GET'])
+def get_model_scheduler():
+    """Model-call slots in use and per-priority queue depth, waiting sessions and wait percentiles"""
+    return jsonify(ai_service.scheduler.report())
+
+@admin_controller.route('/feedback-dedup', methods=['GET'])
+def get_feedback_dedup():
+    """Near-duplicate filter for /improve-ai: index sizes, skipped and merged counts, lookup time"""
+    return jsonify(dict(improve_queue.dedup.report(), queue=improve_queue.stats))
+
+@admin_controller.route('/speculation', methods=['GET'])
+def get_speculation():
+    """Speculative /draft replies: budget use, hits, misses and wasted generations"""
+    return jsonify(speculator.report())
+
+@admin_controller.route('/tracing', methods=['GET'])
+def get_tracing():
+    """Span exporter: target, spans exported, queued and dropped, sampling settings"""
+    return jsonify(trace_exporter.report())
+
+@admin_controller.route('/tenants', methods=['GET'])
+def get_tenants():
+    """Per tenant: active sessions, model-call limits and usage, prompt head version"""
+    sessions = tenant_session_counts()
+    calls = ai_service.scheduler.tenants.report()
+    heads = {store.tenant: store.head for store in prompt_stores()}
+    return jsonify({tenant: {
+        'sessions': sessions.get(tenant, 0),
+        'modelCalls': calls.get(tenant),
+        'promptHead': heads.get(tenant)
+    } for tenant in dict.fromkeys(configured_tenants() + list(sessions) + list(calls))})
@@ -0,0 +1,122 @@
+import contextvars
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional
+
+from config import Config
+from utils.deadline import downstream_timeout
+from utils.logger import logger
+from utils.tenancy import current_tenant
+
+
+class PromptContextCache:
+    """Tracks the model-side context caches for static prompt prefixes.
+
+    Entries are keyed by tenant and a hash of the prefix and kept in a small
+    LRU (CONTEXT_CACHE_MAX_ENTRIES), so requests alternating between prefixes
+    (scenario variants, a shadow candidate, other tenants' prompts) each keep
+    hitting their own cache. Handles pushed out of the LRU are released;
+    expired ones are left to the server-side TTL, since a request may still
+    be using them.
+
+    A missing cache is created once per key in the background; requests wait
+    for it at most CONTEXT_CACHE_CREATE_TIMEOUT_SECONDS (within their own
+    deadline) and otherwise send the full prompt. Failures put caching into
+    a back-off period during which callers send the full prompt.
+    """
+
+    def __init__(self, backend, enabled: bool = None, ttl_seconds: int = None,
+                 min_chars: int = None, retry_after_seconds: int = None,
+                 max_entries: int = None, create_timeout_seconds: float = None):
+        self.backend = backend
+        self.enabled = Config.CONTEXT_CACHE_ENABLED if enabled is None else enabled
+        self.ttl_seconds = ttl_seconds or Config.CONTEXT_CACHE_TTL_SECONDS
+        self.min_chars = Config.CONTEXT_CACHE_MIN_CHARS if min_chars is None else min_chars
+        self.retry_after_seconds = retry_after_seconds or Config.CONTEXT_CACHE_RETRY_SECONDS
+        self.max_entries = max_entries or Config.CONTEXT_CACHE_MAX_ENTRIES
+        self.create_timeout = create_timeout_seconds or Config.CONTEXT_CACHE_CREATE_TIMEOUT_SECONDS
+        self._lock = threading.Lock()
+        # (tenant, prefix key) -> (handle, expires_at), least recently used first
+        self._entries = OrderedDict()
+        # (tenant, prefix key) -> Future of the create in progress
+        self._creating = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-cache")
+        self._disabled_until = 0.0
+        self.stats = {"hits": 0, "creates": 0, "failures": 0, "fallbacks": 0, "evictions": 0}
+
+    def is_available(self, prefix: str) -> bool:
+        return (
+            self.enabled
+            and self.backend is not None
+            and getattr(self.backend, "supports_caching", False)
+            and len(prefix) >= self.min_chars
+            and time.monotonic() >= self._disabled_until
+        )
+
+    def handle_for(self, prefix: str) -> Optional[str]:
+        """Return a cache handle for prefix, creating or refreshing it as needed"""
+        if not self.is_available(prefix):
+            self.stats["fallbacks"] += 1
+            return None
+
+        key = (current_tenant(), hashlib.sha256(prefix.encode("utf-8")).hexdigest())
+        with self._lock:
+            entry = self._entries.get(key)
+            # Refresh a little before the server-side TTL runs out
+            if entry is not None and time.monotonic() < entry[1]:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            future = self._creating.get(key)
+            if future is None:
+                future = self._executor.submit(contextvars.copy_context().run, self._create, key, prefix)
+                self._creating[key] = future
+
+        timeout = downstream_timeout("context_cache", self.create_timeout)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # The create carries on and registers its handle for later requests
+            self.stats["fallbacks"] += 1
+            return None
+        except Exception:
+            return None
+
+    def _create(self, key, prefix: str) -> str:
+        try:
+            handle = self.backend.create_cache(prefix, self.ttl_seconds)
+        except Exception as e:
+            with self._lock:
+                self._creating.pop(key, None)
+                self.stats["failures"] += 1
+                self._disabled_until = time.monotonic() + self.retry_after_seconds
+            logger.warning(f"Context caching unavailable, sending full prompts: {str(e)}")
+            raise
+
+        evicted = []
+        with self._lock:
+            self._creating.pop(key, None)
+            self._entries[key] = (handle, time.monotonic() + self.ttl_seconds * 0.9)
+            self._entries.move_to_end(key)
+            self.stats["creates"] += 1
+            while len(self._entries) > self.max_entries:
+                _, (old_handle, _) = self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+                evicted.append(old_handle)
+        logger.info(f"Registered {len(prefix)}-char prompt prefix as context cache {handle}")
+
+        for old_handle in evicted:
+            if old_handle != handle:
+                self.backend.delete_cache(old_handle)
+        return handle
+
+    def invalidate(self, handle: Optional[str] = None):
+        """Forget handle (e.g. after the backend reports it missing), or all of the current tenant's handles"""
+        tenant = current_tenant()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items()
+                        if key[0] == tenant and (handle is None or entry[0] == handle)]:
+                del self._entries[key]
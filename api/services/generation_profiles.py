@@ -0,0 +1,138 @@
+"""Generation profiles: output caps, sampling and stop sequences per call type.
+
+Reply generation picks a profile from the intent of the client message, so a
+"thanks" gets a short cap while a document-list question gets a long one.
+Reply profiles stop at the closing ``"}`` of the JSON envelope; the model
+omits the stop sequence itself, so it is appended back before parsing.
+Editor calls return whole prompts (which contain escaped ``\\"}`` sequences)
+and therefore never use stop sequences.
+
+Defaults live here; GENERATION_PROFILES_PATH points to a JSON file whose
+entries override or extend them, e.g. ``{"reply": {"max_output_tokens": 384}}``.
+"""
+import json
+import re
+import threading
+from typing import Any, Dict, Optional
+
+from config import Config
+from utils.logger import logger
+
+JSON_ENVELOPE_STOP = '"}'
+
+DEFAULT_PROFILES = {
+    "reply": {"max_output_tokens": 512, "temperature": 0.7, "stop_sequences": [JSON_ENVELOPE_STOP]},
+    "reply_acknowledgement": {"max_output_tokens": 96, "temperature": 0.7, "stop_sequences": [JSON_ENVELOPE_STOP]},
+    "reply_documents": {"max_output_tokens": 1024, "temperature": 0.4, "stop_sequences": [JSON_ENVELOPE_STOP]},
+    "editor": {"max_output_tokens": 8192, "temperature": 0.2, "stop_sequences": []},
+}
+
+# Profile used by each call stage when no intent applies
+STAGE_PROFILES = {
+    "generate_reply": "reply",
+    "improve_prompt": "editor",
+    "manual_improve_prompt": "editor",
+}
+
+ACKNOWLEDGEMENT_PATTERN = re.compile(
+    r"^\W*(ok(ay)?|thanks?( you)?|thank you( so much)?|ty|great|perfect|cool|got it|noted|sure|bye|"
+    r"sounds good|will do|alright|awesome)\b[\w\s!.,']{0,30}$", re.IGNORECASE
+)
+DOCUMENTS_PATTERN = re.compile(r"\b(documents?|requirements?|checklist|what do i need|paperwork|list)\b", re.IGNORECASE)
+
+# Finish reasons that mean the output hit the token cap
+TRUNCATED_FINISH_REASONS = ("MAX_TOKENS", "LENGTH")
+
+_profiles = None
+_profiles_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_profiles() -> Dict[str, Dict[str, Any]]:
+    """Default profiles merged with the overrides file (loaded once)"""
+    global _profiles
+    if _profiles is None:
+        with _profiles_lock:
+            if _profiles is None:
+                profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+                if Config.GENERATION_PROFILES_PATH:
+                    try:
+                        with open(Config.GENERATION_PROFILES_PATH, 'r', encoding='utf-8') as f:
+                            for name, overrides in json.load(f).items():
+                                profiles.setdefault(name, {}).update(overrides)
+                    except (OSError, ValueError) as e:
+                        logger.error(f"Failed to load generation profiles: {str(e)}")
+                _profiles = profiles
+    return _profiles
+
+
+def detect_intent(client_sequence: str) -> Optional[str]:
+    """Coarse intent of a client message: 'acknowledgement', 'documents' or None"""
+    text = client_sequence.strip()
+    if len(text) <= 40 and ACKNOWLEDGEMENT_PATTERN.match(text):
+        return "acknowledgement"
+    if DOCUMENTS_PATTERN.search(text):
+        return "documents"
+    return None
+
+
+def profile_name_for(stage: str, intent: Optional[str] = None) -> str:
+    base = STAGE_PROFILES.get(stage, "reply")
+    if intent and f"{base}_{intent}" in get_profiles():
+        return f"{base}_{intent}"
+    return base
+
+
+def generation_config(profile_name: str) -> Dict[str, Any]:
+    """Backend generation_config for a profile (empty values are dropped)"""
+    profile = get_profiles().get(profile_name, {})
+    return {key: value for key, value in profile.items() if value not in (None, [])}
+
+
+def restore_stop_sequence(text: str, profile_name: str, finish_reason: Optional[str]) -> str:
+    """Append the envelope stop sequence the backend cut off, so the reply parses as JSON
+
+    Natural ends also report STOP, so the sequence is only restored on an
+    unterminated envelope that it completes; plain text is left alone.
+    """
+    stops = get_profiles().get(profile_name, {}).get("stop_sequences") or []
+    if JSON_ENVELOPE_STOP not in stops or finish_reason != "STOP" or not _is_unterminated_envelope(text):
+        return text
+    return text + JSON_ENVELOPE_STOP
+
+
+def _is_unterminated_envelope(text: str) -> bool:
+    if not text.lstrip().startswith("{"):
+        return False
+    try:
+        json.loads(text)
+        return False
+    except ValueError:
+        pass
+    try:
+        json.loads(text + JSON_ENVELOPE_STOP)
+        return True
+    except ValueError:
+        return False
+
+
+def record_generation(profile_name: str, output_tokens: int, finish_reason: Optional[str]):
+    truncated = finish_reason in TRUNCATED_FINISH_REASONS
+    with _stats_lock:
+        stats = _stats.setdefault(profile_name, {"calls": 0, "truncated": 0, "output_tokens": 0})
+        stats["calls"] += 1
+        stats["truncated"] += int(truncated)
+        stats["output_tokens"] += output_tokens or 0
+    if truncated:
+        logger.warning(f"Generation with profile {profile_name} hit max_output_tokens")
+
+
+def generation_stats() -> Dict[str, Any]:
+    """Per-profile call counts, truncation rate and mean output tokens"""
+    with _stats_lock:
+        stats = {name: dict(values) for name, values in _stats.items()}
+    for values in stats.values():
+        values["truncation_rate"] = values["truncated"] / values["calls"] if values["calls"] else 0.0
+        values["mean_output_tokens"] = values["output_tokens"] / values["calls"] if values["calls"] else 0.0
+    return {"profiles": get_profiles(), "stats": stats}
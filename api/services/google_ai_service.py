@@ -1,21 +1,40 @@
-import google.generativeai as genai
 import json
-from typing import List, Dict, Any
+import time
+from typing import List, Dict, Any, Optional
 from config import Config
+from services.context_cache import PromptContextCache
+from services.generation_profiles import (
+    TRUNCATED_FINISH_REASONS, detect_intent, generation_config, profile_name_for, record_generation,
+    restore_stop_sequence
+)
+from services.llm_backends import LLMBackend, LLMBackendError, LLMResponse, create_backend
+from services.model_scheduler import ModelCallScheduler
+from utils.deadline import ClientDisconnected, DeadlineExceeded, Superseded, call_with_deadline, current_deadline, downstream_timeout
+from utils.tenancy import TenantQuotaExceeded
+from utils.tracing import KIND_CLIENT, current_span, set_span_attributes, start_span, traced
+
+PROMPT_PLACEHOLDERS = ("{client_sequence}", "{chat_history}")
 
 class GoogleAIService:
-    def __init__(self):
-        if Config.GOOGLE_AI_API_KEY:
-            genai.configure(api_key=Config.GOOGLE_AI_API_KEY)
-            self.model = genai.GenerativeModel(Config.GOOGLE_AI_MODEL)
-        else:
-            self.model = None
+    def __init__(self, backend: Optional[LLMBackend] = None):
+        # Backend is chosen by Config.LLM_BACKEND unless one is injected
+        self.backend = backend if backend is not None else create_backend()
+        self.context_cache = PromptContextCache(self.backend)
+        self.scheduler = ModelCallScheduler()
     
     def generate_reply(self, client_sequence: str, chat_history: List[Dict[str, str]], prompt: str = None) -> str:
         """Generate AI reply based on client sequence and chat history"""
+        return self.generate_reply_detailed(client_sequence, chat_history, prompt)["reply"]
+    
+    @traced('ai.generate_reply')
+    def generate_reply_detailed(self, client_sequence: str, chat_history: List[Dict[str, str]],
+                                prompt: str = None) -> Dict[str, Any]:
+        """Generate AI reply and report latencyMs, promptTokens, outputTokens, parseFailed, truncated and error"""
+        metrics = {"latencyMs": 0.0, "promptTokens": 0, "outputTokens": 0, "parseFailed": False, "truncated": False,
+                   "error": None}
         
-        if not self.model:
-            return json.dumps({"reply": "AI service not configured. Please set GOOGLE_AI_API_KEY environment variable."})
+        if not self.backend:
+            return dict(metrics, reply=json.dumps({"reply": "AI service not configured. Please set GOOGLE_AI_API_KEY environment variable."}))
         
         # Format chat history
         history_text = ""
@@ -24,9 +43,12 @@ class GoogleAIService:
             history_text += f"- ({role}) {msg['message']}\n"
         
         # Use the provided prompt or fall back to default
+        static_prefix = ""
         if prompt:
-            # Replace placeholders in the custom prompt
-            formatted_prompt = prompt.replace("{client_sequence}", client_sequence).replace("{chat_history}", history_text)
+            # Replace placeholders in the custom prompt; the text before the first
+            # placeholder is identical across requests and can be context-cached
+            static_prefix, dynamic_suffix = self.split_prompt(prompt)
+            formatted_prompt = dynamic_suffix.replace("{client_sequence}", client_sequence).replace("{chat_history}", history_text)
             print(f"Using custom prompt from Firestore: {prompt[:100]}...")
         else:
             # Use the default hardcoded prompt
@@ -45,33 +67,35 @@ Chat history:
 {history_text}"""
             print("Using default hardcoded prompt")
         
+        # Short acknowledgements get a small output cap, document questions a large one
+        profile = profile_name_for("generate_reply", detect_intent(client_sequence))
+        set_span_attributes({'chat.history_length': len(chat_history), 'chat.message_chars': len(client_sequence),
+                             'prompt.custom': bool(prompt), 'generation.profile': profile})
+        
         try:
-            response = self.model.generate_content(formatted_prompt)
+            response = self._generate_with_prefix(static_prefix, formatted_prompt, profile)
+            metrics.update(
+                # Model time only: slot waits and cache creation depend on load and priority, not the prompt
+                latencyMs=response.backend_ms,
+                # prompt_token_count already includes the cached prefix
+                promptTokens=response.prompt_tokens,
+                outputTokens=response.output_tokens,
+                truncated=response.finish_reason in TRUNCATED_FINISH_REASONS
+            )
             response_text = response.text.strip()
             print(f"Raw AI response: {response_text}")
             
-            # Try to extract JSON from the response
-            try:
-                # Look for JSON pattern in the response
-                import re
-                json_match = re.search(r'\{[^}]*"reply"[^}]*\}', response_text, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group())
-                    return result.get("reply", response_text)
-                else:
-                    # Try parsing the entire response as JSON
-                    result = json.loads(response_text)
-                    return result.get("reply", response_text)
-            except json.JSONDecodeError as je:
-                print(f"JSON parsing error: {je}")
-                # If JSON parsing fails, return the raw response
-                return response_text
-                
+            return dict(metrics, reply=self._parse_reply(response_text, metrics))
+        except (DeadlineExceeded, ClientDisconnected, Superseded, TenantQuotaExceeded):
+            raise
         except Exception as e:
             print(f"Error generating reply: {e}")
+            span = current_span()
+            if span is not None:
+                span.set_error(f"{type(e).__name__}: {e}")
             import traceback
             traceback.print_exc()
-            return "I apologize, but I'm having trouble generating a response right now."
+            return dict(metrics, error=str(e), reply="I apologize, but I'm having trouble generating a response right now.")
     
     def improve_prompt(self, current_prompt: str, client_sequence: str, chat_history: List[Dict[str, str]], 
                       consultant_reply: str, predicted_reply: str) -> str:
@@ -96,13 +120,61 @@ Return the updated prompt in JSON format:
 {{"prompt": "updated prompt here"}}"""
         
         try:
-            response = self.model.generate_content(editor_prompt)
+            response = self._generate("improve_prompt", editor_prompt)
             result = json.loads(response.text.strip())
             return result.get("prompt", current_prompt)
+        except (DeadlineExceeded, ClientDisconnected, Superseded, TenantQuotaExceeded):
+            raise
         except Exception as e:
             print(f"Error improving prompt: {e}")
             return current_prompt
     
+    def improve_prompt_batch(self, current_prompt: str, examples: List[Dict[str, Any]]) -> str:
+        """Improve the AI prompt from several feedback examples in a single editor call.
+
+        Each example holds client_sequence, chat_history, consultant_reply and predicted_reply.
+        """
+        if len(examples) == 1:
+            example = examples[0]
+            return self.improve_prompt(
+                current_prompt, example["client_sequence"], example["chat_history"],
+                example["consultant_reply"], example["predicted_reply"]
+            )
+        
+        example_text = ""
+        for idx, example in enumerate(examples, start=1):
+            example_text += f"""Example {idx}
+Client message: {example["client_sequence"]}
+
+Chat history:
+{self._format_history(example["chat_history"])}
+Actual consultant reply: {example["consultant_reply"]}
+Predicted AI reply: {example["predicted_reply"]}
+
+"""
+        
+        editor_prompt = f"""You are an AI prompt editor. Your task is to improve an AI chatbot prompt based on the differences between the predicted AI replies and the actual consultant replies in the examples below.
+
+Current AI prompt:
+{current_prompt}
+
+Feedback examples:
+
+{example_text}Analyze the differences between the actual and predicted replies across all examples. Identify what the consultant did better or differently. Update the AI prompt to make it more aligned with the consultant's style and accuracy. Make surgical, targeted improvements and do not overfit to a single example.
+
+Return the updated prompt in JSON format:
+{{"prompt": "updated prompt here"}}"""
+        
+        try:
+            response = self._generate("improve_prompt", editor_prompt)
+            result = json.loads(response.text.strip())
+            return result.get("prompt", current_prompt)
+        except (DeadlineExceeded, ClientDisconnected, Superseded, TenantQuotaExceeded):
+            raise
+        except Exception as e:
+            print(f"Error improving prompt from batch: {e}")
+            return current_prompt
+    
     def manual_improve_prompt(self, current_prompt: str, instructions: str) -> str:
         """Manually improve the prompt based on specific instructions"""
         
@@ -119,13 +191,113 @@ Return the updated prompt in JSON format:
 {{"prompt": "updated prompt here"}}"""
         
         try:
-            response = self.model.generate_content(improvement_prompt)
+            response = self._generate("manual_improve_prompt", improvement_prompt)
             result = json.loads(response.text.strip())
             return result.get("prompt", current_prompt)
+        except (DeadlineExceeded, ClientDisconnected, Superseded, TenantQuotaExceeded):
+            raise
         except Exception as e:
             print(f"Error manually improving prompt: {e}")
             return current_prompt
     
+    @staticmethod
+    def split_prompt(prompt: str):
+        """Split a prompt template into (static prefix, dynamic suffix) at the first placeholder"""
+        positions = [prompt.find(p) for p in PROMPT_PLACEHOLDERS if p in prompt]
+        if not positions:
+            return prompt, ""
+        split_at = min(positions)
+        return prompt[:split_at], prompt[split_at:]
+    
+    def _generate_with_prefix(self, static_prefix: str, dynamic_prompt: str, profile: str = None) -> LLMResponse:
+        """Generate using the context-cached prefix when available, else the full prompt"""
+        handle = self.context_cache.handle_for(static_prefix) if static_prefix else None
+        set_span_attributes({'llm.context_cache': 'hit' if handle else 'miss' if static_prefix else 'none'})
+        if handle:
+            try:
+                return self._generate("generate_reply", dynamic_prompt, profile, cached_content=handle)
+            except LLMBackendError as e:
+                # Only a cache the backend no longer has is worth resending in full; overload and timeouts are not
+                if not e.not_found:
+                    raise
+                print(f"Cached generation failed, retrying with full prompt: {e}")
+                self.context_cache.invalidate(handle)
+                set_span_attributes({'llm.context_cache': 'invalidated'})
+        return self._generate("generate_reply", static_prefix + dynamic_prompt, profile)
+    
+    def _generate(self, stage: str, prompt: str, profile: str = None, **options) -> LLMResponse:
+        """Call the backend with the stage's generation profile, within the request's remaining time budget"""
+        profile = profile or profile_name_for(stage)
+        config = generation_config(profile)
+        if config:
+            options["generation_config"] = config
+        deadline = current_deadline()
+        with start_span('llm.generate', {'llm.stage': stage, 'llm.backend': getattr(self.backend, 'name', None),
+                                         'generation.profile': profile}, kind=KIND_CLIENT) as span:
+            try:
+                # Requests wait for a slot within their budget; background work waits as long as it takes
+                queued = time.perf_counter()
+                with self.scheduler.slot(stage, timeout=deadline.remaining() if deadline is not None else None):
+                    set_span_attributes({'llm.slot_wait_ms': round((time.perf_counter() - queued) * 1000.0, 2)})
+                    timeout = downstream_timeout(stage, Config.LLM_TIMEOUT_SECONDS)
+                    called = time.perf_counter()
+                    response = call_with_deadline(stage, self.backend.generate, prompt, timeout=timeout, **options)
+                    response.backend_ms = (time.perf_counter() - called) * 1000.0
+            except LLMBackendError:
+                # A backend timeout (or slot wait) caused by the request budget is a deadline failure
+                if deadline is not None:
+                    deadline.check(stage)
+                raise
+            response.text = restore_stop_sequence(response.text, profile, response.finish_reason)
+            record_generation(profile, response.output_tokens, response.finish_reason)
+            if span is not None:
+                span.set_attributes({'llm.model': (response.metadata or {}).get('model'),
+                                     'llm.prompt_tokens': response.prompt_tokens,
+                                     'llm.cached_tokens': response.cached_tokens,
+                                     'llm.output_tokens': response.output_tokens,
+                                     'llm.finish_reason': response.finish_reason,
+                                     'llm.backend_ms': round(response.backend_ms, 2)})
+        return response
+    
+    @traced('ai.parse_reply')
+    def _parse_reply(self, response_text: str, metrics: Dict[str, Any]) -> str:
+        """Reply text from the model output; sets metrics["parseFailed"] when it is not valid JSON"""
+        set_span_attributes({'response.chars': len(response_text)})
+        try:
+            # Look for JSON pattern in the response
+            import re
+            json_match = re.search(r'\{[^}]*"reply"[^}]*\}', response_text, re.DOTALL)
+            if json_match:
+                result = json.loads(json_match.group())
+            else:
+                # Try parsing the entire response as JSON
+                result = json.loads(response_text)
+            set_span_attributes({'parse.outcome': 'json'})
+            return result.get("reply", response_text)
+        except json.JSONDecodeError as je:
+            print(f"JSON parsing error: {je}")
+            metrics["parseFailed"] = True
+            # Output cut at max_output_tokens still holds most of the reply
+            partial = self._salvage_reply(response_text)
+            if partial is not None:
+                set_span_attributes({'parse.outcome': 'salvaged'})
+                return partial
+            # If JSON parsing fails, return the raw response
+            set_span_attributes({'parse.outcome': 'raw'})
+            return response_text
+    
+    @staticmethod
+    def _salvage_reply(response_text: str) -> Optional[str]:
+        """Reply text from an unterminated {"reply": "... envelope, if present"""
+        import re
+        match = re.search(r'"reply"\s*:\s*"((?:[^"\\]|\\.)*)', response_text, re.DOTALL)
+        if not match:
+            return None
+        try:
+            return json.loads('"' + match.group(1).rstrip("\\") + '"')
+        except json.JSONDecodeError:
+            return match.group(1)
+    
     def _format_history(self, chat_history: List[Dict[str, str]]) -> str:
         """Format chat history for display"""
         history_text = ""
@@ -1,4 +1,9 @@
 from .logger import logger
-from .session_manager import get_session, update_session_context
+from .session_manager import (
+    get_session, update_session_context, get_chat_history, get_turns_since, get_last_turn_index
+)
 
-__all__ = ['logger', 'get_session', 'update_session_context']
\ No newline at end of file
+__all__ = [
+    'logger', 'get_session', 'update_session_context', 'get_chat_history', 'get_turns_since',
+    'get_last_turn_index'
+]
@@ -0,0 +1,229 @@
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+from config import Config
+from utils.logger import logger
+
+# Registered in-process structures: {name: {"size": fn, "evict": fn, "priority": int}}
+_sources = {}
+_sources_lock = threading.Lock()
+
+_snapshots = deque(maxlen=2)
+_snapshots_lock = threading.Lock()
+_monitor = None
+_stats = {"soft_limit_hits": 0, "evictions": 0, "skipped": 0, "last_check": None}
+# Accounted size of the registered structures after the last eviction, while RSS stays above the limit
+_evicted_down_to = None
+
+
+def register_memory_source(name, size_fn, evict_fn=None, priority=100):
+    """Register a structure for size accounting and soft-limit eviction.
+
+    size_fn() returns the estimated size in bytes; evict_fn(fraction) should
+    free roughly that fraction of the structure and return the number of
+    entries dropped. Lower priority sources are evicted first.
+    """
+    with _sources_lock:
+        _sources[name] = {"size": size_fn, "evict": evict_fn, "priority": priority}
+
+
+def deep_sizeof(obj, seen=None):
+    """Approximate retained size of obj and everything reachable through containers"""
+    if seen is None:
+        seen = set()
+    obj_id = id(obj)
+    if obj_id in seen:
+        return 0
+    seen.add(obj_id)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+def current_rss_bytes():
+    """Resident set size of this process (0 when it cannot be read)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # ru_maxrss is the peak, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except Exception:
+        return 0
+
+
+def memory_report():
+    """Per-structure sizes, process RSS and tracemalloc state"""
+    with _sources_lock:
+        sources = dict(_sources)
+    structures = {}
+    for name, source in sources.items():
+        try:
+            structures[name] = source["size"]()
+        except Exception as e:
+            structures[name] = None
+            logger.warning(f"Memory accounting for {name} failed: {str(e)}")
+
+    report = {
+        "rssBytes": current_rss_bytes(),
+        "softLimitBytes": _soft_limit_bytes(),
+        "structures": structures,
+        "tracemalloc": tracemalloc.is_tracing(),
+        "stats": dict(_stats)
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report["traced"] = {"currentBytes": current, "peakBytes": peak}
+    return report
+
+
+def take_snapshot():
+    """Record a tracemalloc snapshot (keeps the latest two for diffing)"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(Config.TRACEMALLOC_FRAMES)
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    with _snapshots_lock:
+        _snapshots.append((time.time(), snapshot))
+    return snapshot
+
+
+def snapshot_diff(top=20, group_by='lineno'):
+    """Top allocation changes between the two latest snapshots (or the latest alone)"""
+    with _snapshots_lock:
+        snapshots = list(_snapshots)
+    if not snapshots:
+        return {"snapshots": 0, "top": []}
+
+    taken_at, latest = snapshots[-1]
+    if len(snapshots) > 1:
+        previous_at, previous = snapshots[0]
+        stats = latest.compare_to(previous, group_by)
+        top_stats = [{
+            "location": _format_traceback(stat.traceback),
+            "sizeBytes": stat.size,
+            "sizeDiffBytes": stat.size_diff,
+            "count": stat.count,
+            "countDiff": stat.count_diff
+        } for stat in stats[:top]]
+        return {"snapshots": 2, "from": previous_at, "to": taken_at, "top": top_stats}
+
+    top_stats = [{
+        "location": _format_traceback(stat.traceback),
+        "sizeBytes": stat.size,
+        "count": stat.count
+    } for stat in latest.statistics(group_by)[:top]]
+    return {"snapshots": 1, "to": taken_at, "top": top_stats}
+
+
+def enforce_soft_limit():
+    """Evict from registered structures while RSS is over the soft limit.
+
+    CPython rarely returns freed memory to the OS, so RSS can stay above the
+    limit after an eviction. What gets evicted is therefore bounded by the
+    structures' own accounted sizes: the first pass frees up to the RSS
+    excess, later passes only what the structures have grown by since the
+    previous one. Sizes are freed from lower priority sources first.
+    """
+    global _evicted_down_to
+    limit = _soft_limit_bytes()
+    _stats["last_check"] = time.time()
+    rss = current_rss_bytes()
+    if not limit or rss < limit:
+        _evicted_down_to = None
+        return 0
+
+    with _sources_lock:
+        sources = sorted(_sources.items(), key=lambda item: item[1]["priority"])
+    sizes = {name: _source_size(name, source) for name, source in sources}
+    accounted = sum(sizes.values())
+    needed = min(rss - limit, accounted - (_evicted_down_to or 0))
+    if needed <= 0:
+        # The excess is memory the structures already gave up (or never held)
+        _stats["skipped"] += 1
+        return 0
+
+    _stats["soft_limit_hits"] += 1
+    logger.warning(f"RSS above soft memory limit of {limit // (1024 * 1024)} MB; evicting up to {needed // 1024} KB")
+    evicted = 0
+    for name, source in sources:
+        if needed <= 0:
+            break
+        if source["evict"] is None or not sizes[name]:
+            continue
+        fraction = min(Config.MEMORY_EVICT_FRACTION, needed / sizes[name])
+        try:
+            dropped = source["evict"](fraction) or 0
+        except Exception as e:
+            logger.error(f"Eviction from {name} failed: {str(e)}")
+            continue
+        freed = sizes[name] - _source_size(name, source)
+        sizes[name] -= freed
+        needed -= freed
+        evicted += dropped
+        logger.info(f"Evicted {dropped} entries ({freed // 1024} KB) from {name}")
+    gc.collect()
+    _evicted_down_to = sum(sizes.values())
+    _stats["evictions"] += evicted
+    return evicted
+
+
+def _source_size(name, source):
+    try:
+        return source["size"]() or 0
+    except Exception as e:
+        logger.warning(f"Memory accounting for {name} failed: {str(e)}")
+        return 0
+
+
+def start_memory_monitor():
+    """Start the background thread that checks the soft limit and takes snapshots"""
+    global _monitor
+    if _monitor is not None:
+        return
+    if Config.TRACEMALLOC_ENABLED and not tracemalloc.is_tracing():
+        tracemalloc.start(Config.TRACEMALLOC_FRAMES)
+    if not (Config.MEMORY_SOFT_LIMIT_MB or Config.TRACEMALLOC_ENABLED):
+        return
+    _monitor = threading.Thread(target=_monitor_loop, name='memory-monitor', daemon=True)
+    _monitor.start()
+
+
+def _monitor_loop():
+    last_snapshot = 0.0
+    while True:
+        time.sleep(Config.MEMORY_CHECK_INTERVAL_SECONDS)
+        try:
+            enforce_soft_limit()
+            if Config.TRACEMALLOC_ENABLED and time.time() - last_snapshot >= Config.TRACEMALLOC_SNAPSHOT_INTERVAL_SECONDS:
+                take_snapshot()
+                last_snapshot = time.time()
+        except Exception as e:
+            logger.error(f"Memory monitor error: {str(e)}")
+
+
+def _soft_limit_bytes():
+    return int(Config.MEMORY_SOFT_LIMIT_MB * 1024 * 1024) if Config.MEMORY_SOFT_LIMIT_MB else 0
+
+
+def _format_traceback(traceback):
+    frame = traceback[0]
+    return f"{frame.filename}:{frame.lineno}"
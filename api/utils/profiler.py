@@ -0,0 +1,256 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from flask import request
+
+from config import Config
+from utils.logger import logger
+from utils.memory import deep_sizeof, register_memory_source
+from utils.tenancy import admin_access_error
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLE = 'sample'
+
+
+class ProfileStore:
+    """Keeps recent per-request profiles and collapsed-stack aggregates per endpoint.
+
+    Collapsed stacks use the ``frame;frame;frame value`` format understood by
+    flamegraph.pl and speedscope, with values in microseconds.
+    """
+
+    def __init__(self, output_dir=None, max_profiles=None):
+        self.output_dir = os.path.abspath(output_dir or Config.PROFILE_OUTPUT_DIR)
+        self.max_profiles = max_profiles or Config.PROFILE_MAX_FILES
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()
+        self._aggregates = {}
+
+    def add(self, endpoint, mode, duration_ms, folded, stats=None):
+        profile_id = uuid.uuid4().hex[:12]
+        entry = {
+            'id': profile_id,
+            'endpoint': endpoint,
+            'mode': mode,
+            'durationMs': round(duration_ms, 3),
+            'createdAt': time.time(),
+            'files': {}
+        }
+        os.makedirs(self.output_dir, exist_ok=True)
+        folded_path = os.path.join(self.output_dir, f"{profile_id}.folded")
+        _write_folded(folded_path, folded)
+        entry['files']['folded'] = folded_path
+        if stats is not None:
+            prof_path = os.path.join(self.output_dir, f"{profile_id}.prof")
+            stats.dump_stats(prof_path)
+            entry['files']['prof'] = prof_path
+
+        with self._lock:
+            self._profiles[profile_id] = entry
+            self._aggregates.setdefault(endpoint, Counter()).update(folded)
+            while len(self._profiles) > self.max_profiles:
+                _, old = self._profiles.popitem(last=False)
+                for path in old['files'].values():
+                    _remove_quietly(path)
+        return entry
+
+    def list(self):
+        with self._lock:
+            return {
+                'profiles': [dict(p) for p in reversed(self._profiles.values())],
+                'aggregates': {endpoint: len(stacks) for endpoint, stacks in self._aggregates.items()}
+            }
+
+    def get(self, profile_id):
+        with self._lock:
+            entry = self._profiles.get(profile_id)
+            return dict(entry) if entry else None
+
+    def aggregate_folded(self, endpoint=None):
+        """Collapsed stacks summed over every captured request (optionally one endpoint)"""
+        with self._lock:
+            total = Counter()
+            for name, stacks in self._aggregates.items():
+                if endpoint is None or name == endpoint:
+                    total.update(stacks)
+        return _format_folded(total)
+
+    def size_bytes(self):
+        with self._lock:
+            return deep_sizeof(self._aggregates) + deep_sizeof(self._profiles)
+
+    def evict(self, fraction):
+        # Aggregates are only diagnostics; drop them wholesale under memory pressure
+        with self._lock:
+            dropped = len(self._aggregates)
+            self._aggregates.clear()
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            for entry in self._profiles.values():
+                for path in entry['files'].values():
+                    _remove_quietly(path)
+            self._profiles.clear()
+            self._aggregates.clear()
+
+
+profile_store = ProfileStore()
+register_memory_source('profiles', profile_store.size_bytes, profile_store.evict, priority=10)
+
+
+def _requested_mode():
+    """Profiling mode for the current request, or None when it is not profiled"""
+    header = request.headers.get('X-Profile')
+    if header:
+        # Header-triggered profiling is an admin capability, gated like the admin endpoints
+        if admin_access_error(request):
+            return None
+        return header if header in (MODE_CPROFILE, MODE_SAMPLE) else Config.PROFILE_MODE
+    if Config.PROFILE_SAMPLE_RATE and random.random() < Config.PROFILE_SAMPLE_RATE:
+        return Config.PROFILE_MODE
+    return None
+
+
+def profiled(endpoint):
+    """Profile the wrapped Flask handler when requested by header or sampling rate"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # Fast path: one attribute read and one header lookup when disabled
+            if not Config.PROFILE_SAMPLE_RATE and 'X-Profile' not in request.headers:
+                return fn(*args, **kwargs)
+            mode = _requested_mode()
+            if mode is None:
+                return fn(*args, **kwargs)
+            if mode == MODE_SAMPLE:
+                return _run_sampled(endpoint, fn, args, kwargs)
+            return _run_cprofile(endpoint, fn, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def _run_cprofile(endpoint, fn, args, kwargs):
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        try:
+            stats = pstats.Stats(profiler, stream=io.StringIO())
+            profile_store.add(endpoint, MODE_CPROFILE, duration_ms, _pstats_to_folded(stats), stats)
+        except Exception as e:
+            logger.error(f"Failed to store profile for {endpoint}: {str(e)}")
+
+
+def _run_sampled(endpoint, fn, args, kwargs):
+    sampler = _StackSampler(threading.get_ident(), Config.PROFILE_SAMPLE_INTERVAL_MS / 1000.0)
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sampler.stop()
+        duration_ms = (time.perf_counter() - started) * 1000
+        try:
+            profile_store.add(endpoint, MODE_SAMPLE, duration_ms, sampler.folded())
+        except Exception as e:
+            logger.error(f"Failed to store profile for {endpoint}: {str(e)}")
+
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval"""
+
+    def __init__(self, target_thread_id, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code.co_filename, frame.f_code.co_name))
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def folded(self):
+        interval_us = int(self.interval * 1_000_000)
+        return Counter({stack: count * interval_us for stack, count in self.samples.items()})
+
+
+def _pstats_to_folded(stats):
+    """Approximate collapsed stacks from cProfile's caller/callee graph.
+
+    cProfile only records caller->callee edges, so each function's self time is
+    split across its callers in proportion to the calls made from each edge.
+    """
+    callees = {}
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge))
+
+    folded = Counter()
+
+    def walk(func, path, share):
+        cc, nc, tt, ct, callers = stats.stats[func]
+        label = _frame_label(func[0], func[2])
+        stack = f"{path};{label}" if path else label
+        self_us = int(tt * share * 1_000_000)
+        if self_us:
+            folded[stack] += self_us
+        for callee, edge in callees.get(func, []):
+            if callee == func or _frame_label(callee[0], callee[2]) in stack.split(';'):
+                continue
+            callee_calls = stats.stats[callee][1] or 1
+            callee_share = share * min(1.0, edge[1] / callee_calls)
+            # Prune branches below 1us so wide call graphs stay tractable
+            if stats.stats[callee][3] * callee_share < 1e-6:
+                continue
+            walk(callee, stack, callee_share)
+
+    for root in roots:
+        walk(root, '', 1.0)
+    return folded
+
+
+def _frame_label(filename, name):
+    return f"{os.path.basename(filename)}:{name}"
+
+
+def _format_folded(folded):
+    return ''.join(f"{stack} {value}\n" for stack, value in sorted(folded.items()) if value > 0)
+
+
+def _write_folded(path, folded):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(_format_folded(folded))
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
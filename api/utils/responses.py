@@ -0,0 +1,264 @@
+"""Response layer: faster JSON encoding, compression and ETags.
+
+``FastJSONProvider`` replaces Flask's JSON provider. It encodes with orjson
+when it is installed (same key order and date format as the stdlib provider)
+and falls back to the stdlib encoder otherwise or for values orjson rejects.
+``compress_response`` gzip- or brotli-encodes large JSON/text bodies for
+clients that accept it, caching the compressed body of responses that carry
+an ETag. Serialization and compression time are accumulated per endpoint.
+
+``python -m utils.responses bench`` measures the encoders and compressors on
+payloads shaped like the real endpoints.
+"""
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+import timeit
+from collections import OrderedDict
+
+from flask import current_app, has_request_context, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+
+from config import Config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html', 'text/csv')
+# Compressed bodies of ETag'd responses: {(etag, encoding): bytes}
+COMPRESSED_CACHE_SIZE = 32
+
+
+class ResponseStats:
+    """Per-endpoint serialization and compression cost"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, **values):
+        with self._lock:
+            entry = self._endpoints.setdefault(endpoint, {
+                'responses': 0, 'serializeUs': 0.0, 'bytes': 0,
+                'compressed': 0, 'compressUs': 0.0, 'bytesSent': 0, 'notModified': 0
+            })
+            for key, value in values.items():
+                entry[key] += value
+
+    def report(self):
+        with self._lock:
+            report = {}
+            for endpoint, entry in self._endpoints.items():
+                responses = entry['responses'] or 1
+                report[endpoint] = dict(
+                    entry,
+                    meanSerializeUs=round(entry['serializeUs'] / responses, 1),
+                    meanBytes=round(entry['bytes'] / responses),
+                    compressionRatio=round(entry['bytesSent'] / entry['bytes'], 3) if entry['bytes'] else None
+                )
+            return {
+                'encoder': 'orjson' if orjson is not None else 'json',
+                'encodings': ['br', 'gzip'] if brotli is not None else ['gzip'],
+                'endpoints': report
+            }
+
+
+response_stats = ResponseStats()
+_compressed_cache = OrderedDict()
+_compressed_cache_lock = threading.Lock()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._encode(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        started = time.perf_counter()
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        if orjson is None or pretty:
+            dump_args = {'indent': 2} if pretty else {'separators': (',', ':')}
+            body = (super().dumps(obj, **dump_args) + '\n').encode('utf-8')
+        else:
+            body = self._encode(obj) + b'\n'
+        if has_request_context():
+            response_stats.record(request.endpoint or request.path, responses=1, bytes=len(body),
+                                  serializeUs=(time.perf_counter() - started) * 1e6)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+    def _encode(self, obj):
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=self.default, option=options)
+        except (TypeError, orjson.JSONEncodeError):
+            # e.g. integers beyond 64 bits; the stdlib encoder handles them
+            return super().dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def compress_response(response):
+    """after_request hook: encode large bodies with the best encoding the client accepts"""
+    if not Config.RESPONSE_COMPRESSION_ENABLED or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < Config.RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+
+    encoding = _negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+    etag, _ = response.get_etag()
+    started = time.perf_counter()
+    compressed = _cached_compressed(etag, encoding, body)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # The encoded body differs from the identity one byte for byte
+        response.set_etag(etag, weak=True)
+    response_stats.record(request.endpoint or request.path, compressed=1,
+                          compressUs=(time.perf_counter() - started) * 1e6)
+    return response
+
+
+def etag_response(etag, build_payload, cache_control='no-cache'):
+    """JSON response with an ETag, or 304 when If-None-Match already has it (build_payload is not called)"""
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response_stats.record(request.endpoint or request.path, notModified=1)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def install_response_layer(app):
+    app.json = FastJSONProvider(app)
+
+    @app.after_request
+    def _count_sent_bytes(response):
+        # Runs after compression (after_request hooks run in reverse order)
+        if response.status_code == 200 and response.mimetype == 'application/json' and not response.is_streamed:
+            response_stats.record(request.endpoint or request.path, bytesSent=response.content_length or 0)
+        return response
+
+    app.after_request(compress_response)
+
+
+def _negotiate(accept_encodings):
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(encoding, body):
+    if encoding == 'br':
+        return brotli.compress(body, quality=Config.RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=Config.RESPONSE_GZIP_LEVEL, mtime=0)
+
+
+def _cached_compressed(etag, encoding, body):
+    if not etag:
+        return _compress(encoding, body)
+    key = (etag, encoding)
+    with _compressed_cache_lock:
+        cached = _compressed_cache.get(key)
+        if cached is not None:
+            _compressed_cache.move_to_end(key)
+            return cached
+    compressed = _compress(encoding, body)
+    with _compressed_cache_lock:
+        _compressed_cache[key] = compressed
+        if len(_compressed_cache) > COMPRESSED_CACHE_SIZE:
+            _compressed_cache.popitem(last=False)
+    return compressed
+
+
+def _bench_payloads(prompt_rounds):
+    """Payloads shaped like GET /prompt, /generate-reply, /conversations and /prompt/versions"""
+    from services.database_service import _get_default_prompt
+
+    rule = "- When the client asks about {topic}, explain the requirement, the documents and the timeline.\n"
+    prompt = _get_default_prompt() + ''.join(rule.format(topic=f"topic {i}") for i in range(prompt_rounds))
+    return {
+        'GET /prompt': {'prompt': prompt, 'version': prompt_rounds},
+        'POST /generate-reply': {
+            'aiReply': "For the DTV you'll need a bank statement showing 500,000 THB. " * 4,
+            'scenario': 'bank_balance_and_financial_requirements_questions'
+        },
+        'GET /conversations': {
+            'conversations': [{'id': f'conv_{i}', 'contact_id': f'contact_{i}', 'scenario': 'Soft Power Activities',
+                               'message_count': 12, 'processed': False, 'conversation_index': i} for i in range(50)],
+            'count': 50, 'nextCursor': 'WzQ5LCAiY29udl80OSJd', 'indexReady': True
+        },
+        'GET /prompt/versions': {
+            'currentVersion': prompt_rounds,
+            'versions': [{'version': v, 'hash': f'{v:016x}', 'createdAt': 1731000000.0 + v,
+                          'source': 'improve-ai', 'rollbackOf': None} for v in range(20)]
+        },
+    }
+
+
+def _time_us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def bench(prompt_rounds=200, number=2000):
+    stdlib = lambda obj: json.dumps(obj, ensure_ascii=True, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    results = {}
+    for endpoint, payload in _bench_payloads(prompt_rounds).items():
+        body = stdlib(payload)
+        row = {'bytes': len(body), 'jsonUs': round(_time_us(lambda: stdlib(payload), number), 2)}
+        if orjson is not None:
+            options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS
+            row['orjsonUs'] = round(_time_us(lambda: orjson.dumps(payload, option=options), number), 2)
+        if len(body) >= Config.RESPONSE_COMPRESSION_MIN_BYTES:
+            for encoding in (['br', 'gzip'] if brotli is not None else ['gzip']):
+                compressed = _compress(encoding, body)
+                row[f'{encoding}Bytes'] = len(compressed)
+                row[f'{encoding}Us'] = round(_time_us(lambda: _compress(encoding, body), max(1, number // 10)), 2)
+        results[endpoint] = row
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Response serialization micro-benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+    bench_parser = commands.add_parser('bench', help='time JSON encoders and compressors per endpoint payload')
+    bench_parser.add_argument('--prompt-rounds', type=int, default=200,
+                              help='rules appended to the default prompt, as after that many improvement rounds')
+    bench_parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    print(json.dumps(bench(args.prompt_rounds, args.number), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,57 +1,254 @@
+import itertools
+import threading
+import time
+from collections import deque
 from datetime import datetime, timedelta
+from config import Config
+from utils.deadline import current_deadline
 from utils.logger import logger
+from utils.memory import deep_sizeof, register_memory_source
+from utils.tenancy import current_tenant
+from utils.tracing import set_span_attributes, traced
 
-# Dictionary to store user sessions 
-# Format: {session_id: {"last_updated": datetime, "product_context": {...}, "conversation_history": [...]}}
+# Dictionary to store user sessions, namespaced by tenant
+# Format: {(tenant, session_id): {"last_updated": datetime, "product_context": {...}, "conversation_history": [...],
+#                                 "chat_history": [...], "turn_offset": int}}
 active_sessions = {}
+_sessions_lock = threading.RLock()
 
 # Session timeout in minutes
 SESSION_TIMEOUT = 30
 
+# Maximum chat turns kept server-side per session (older turns are dropped,
+# turn indexes keep counting so clients can still reconcile by index)
+MAX_SESSION_TURNS = 200
+
+# Messages of a session waiting to be answered together: {(tenant, session_id): MessageBurst}
+_bursts = {}
+_burst_ids = itertools.count(1)
+
+def session_key(session_id):
+    """Key of the session in the current tenant's namespace"""
+    return current_tenant(), session_id
+
 def get_session(session_id):
     """Get session data for a specific session ID, or create new if doesn't exist"""
     cleanup_expired_sessions()
+    key = session_key(session_id)
     
-    if session_id not in active_sessions:
-        logger.info(f"Creating new session: {session_id}")
-        active_sessions[session_id] = {
-            "last_updated": datetime.now(),
-            "product_context": None,
-            "conversation_history": []
-        }
-    else:
-        # Update the last_updated time
-        active_sessions[session_id]["last_updated"] = datetime.now()
-    
-    return active_sessions[session_id]
+    with _sessions_lock:
+        if key not in active_sessions:
+            logger.info(f"Creating new session: {session_id} (tenant {key[0]})")
+            if Config.TENANT_MAX_SESSIONS:
+                _enforce_tenant_session_limit(key[0])
+            active_sessions[key] = {
+                "last_updated": datetime.now(),
+                "product_context": None,
+                "conversation_history": [],
+                "chat_history": [],
+                "turn_offset": 0
+            }
+        else:
+            # Update the last_updated time
+            active_sessions[key]["last_updated"] = datetime.now()
+        
+        return active_sessions[key]
 
-def update_session_context(session_id, product_context, question, answer):
-    """Update session with new product context and conversation history"""
-    if session_id not in active_sessions:
-        get_session(session_id)
-    
-    active_sessions[session_id]["product_context"] = product_context
-    
-    # Add the QA pair to conversation history (keep last 5 for context)
-    active_sessions[session_id]["conversation_history"].append({
-        "question": question,
-        "answer": answer,
+def _enforce_tenant_session_limit(tenant):
+    # A tenant at TENANT_MAX_SESSIONS makes room among its own sessions, never another tenant's
+    owned = [key for key in active_sessions if key[0] == tenant]
+    overflow = len(owned) - Config.TENANT_MAX_SESSIONS + 1
+    if overflow > 0:
+        for key in sorted(owned, key=lambda k: active_sessions[k]["last_updated"])[:overflow]:
+            del active_sessions[key]
+
+def update_session_context(session_id, product_context, question, answer, client_messages=None):
+    """Update session with new product context and conversation history.
+
+    The client question and AI answer are also appended to the session's chat
+    history as two turns (one client turn per message when client_messages
+    lists the messages a merged question was made of). Returns the turn index
+    of the answer.
+    """
+    with _sessions_lock:
+        session = get_session(session_id)
+        
+        session["product_context"] = product_context
+        
+        # Add the QA pair to conversation history (keep last 5 for context)
+        session["conversation_history"].append({
+            "question": question,
+            "answer": answer,
+            "timestamp": datetime.now().isoformat()
+        })
+        
+        # Limit conversation history to last 5 exchanges
+        if len(session["conversation_history"]) > 5:
+            session["conversation_history"] = session["conversation_history"][-5:]
+        
+        for message in client_messages or [question]:
+            _append_turn(session, "client", message)
+        return _append_turn(session, "consultant", answer)
+
+def get_chat_history(session_id):
+    """Get the session's chat history in the {role, message} format used by GoogleAIService"""
+    with _sessions_lock:
+        session = get_session(session_id)
+        return [{"role": turn["role"], "message": turn["message"]} for turn in session["chat_history"]]
+
+def seed_session(session_id, chat_history):
+    """Restore a client-held chat history into a session that has no turns (new or expired).
+
+    Returns True when the history was stored; a session that still has turns
+    keeps them and the client's copy is ignored.
+    """
+    with _sessions_lock:
+        session = get_session(session_id)
+        if session["chat_history"] or session["turn_offset"]:
+            return False
+        for turn in chat_history:
+            _append_turn(session, turn.get("role"), turn.get("message"))
+        return True
+
+def get_turns_since(session_id, last_seen_turn=None):
+    """Get turns with an index greater than last_seen_turn (all retained turns when None)"""
+    with _sessions_lock:
+        session = get_session(session_id)
+        turns = session["chat_history"]
+        if last_seen_turn is None:
+            return list(turns)
+        start = max(0, last_seen_turn + 1 - session["turn_offset"])
+        return turns[start:]
+
+def get_last_turn_index(session_id):
+    """Get the index of the newest turn in the session, or -1 when it has none"""
+    with _sessions_lock:
+        session = get_session(session_id)
+        return session["turn_offset"] + len(session["chat_history"]) - 1
+
+class MessageBurst:
+    """Consecutive client messages of one session that get a single reply"""
+
+    def __init__(self, key):
+        self.key = key
+        self.messages = []
+        self.opened_at = time.monotonic()
+        self.changed = threading.Condition(_sessions_lock)
+        # Id of the newest message; the request that sent it answers the burst
+        self.leader = None
+        # Deadline of the request generating the reply, superseded when another message arrives
+        self.generation = None
+
+    @property
+    def text(self):
+        return "\n".join(self.messages)
+
+    def close(self, leader):
+        """End the burst if leader still answers it; False when a newer message took it over"""
+        with _sessions_lock:
+            if _bursts.get(self.key) is not self or self.leader != leader:
+                return False
+            del _bursts[self.key]
+            return True
+
+@traced('session.debounce')
+def join_burst(session_id, message, window_ms=None, max_wait_ms=None):
+    """Add a message to the session's pending burst and wait for the session to go quiet.
+
+    Returns (burst, leader) once no newer message arrived for window_ms (or the
+    burst has been open for max_wait_ms); the caller generates one reply for
+    burst.text and calls burst.close(leader) before recording it. Returns None
+    when a newer message took the burst over, and supersedes a generation still
+    running for an earlier message.
+    """
+    window = (window_ms if window_ms is not None else Config.CHAT_DEBOUNCE_MS) / 1000.0
+    max_wait = (max_wait_ms if max_wait_ms is not None else Config.CHAT_DEBOUNCE_MAX_MS) / 1000.0
+    key = session_key(session_id)
+    with _sessions_lock:
+        burst = _bursts.get(key)
+        if burst is None:
+            burst = _bursts[key] = MessageBurst(key)
+        if burst.generation is not None:
+            burst.generation.supersede("Superseded by a newer message")
+            burst.generation = None
+        leader = next(_burst_ids)
+        burst.messages.append(message)
+        burst.leader = leader
+        burst.changed.notify_all()
+
+        quiet_until = min(time.monotonic() + window, burst.opened_at + max_wait)
+        while burst.leader == leader:
+            remaining = quiet_until - time.monotonic()
+            if remaining <= 0:
+                break
+            burst.changed.wait(remaining)
+        set_span_attributes({'burst.messages': len(burst.messages), 'burst.superseded': burst.leader != leader})
+        if burst.leader != leader:
+            return None
+        burst.generation = current_deadline()
+        return burst, leader
+
+def _append_turn(session, role, message):
+    turn_index = session["turn_offset"] + len(session["chat_history"])
+    session["chat_history"].append({
+        "turn": turn_index,
+        "role": role,
+        "message": message,
         "timestamp": datetime.now().isoformat()
     })
     
-    # Limit conversation history to last 5 exchanges
-    if len(active_sessions[session_id]["conversation_history"]) > 5:
-        active_sessions[session_id]["conversation_history"] = active_sessions[session_id]["conversation_history"][-5:]
+    # Keep the retained window bounded
+    overflow = len(session["chat_history"]) - MAX_SESSION_TURNS
+    if overflow > 0:
+        session["chat_history"] = session["chat_history"][overflow:]
+        session["turn_offset"] += overflow
+    
+    return turn_index
+
+def tenant_session_counts():
+    """Active sessions per tenant"""
+    with _sessions_lock:
+        counts = {}
+        for tenant, _ in active_sessions:
+            counts[tenant] = counts.get(tenant, 0) + 1
+        return counts
+
+def sessions_size_bytes():
+    """Approximate memory held by all active sessions"""
+    with _sessions_lock:
+        return deep_sizeof(active_sessions)
+
+def evict_sessions(fraction):
+    """Drop a fraction of sessions, least recently used first; returns how many were dropped.
+
+    Sessions are taken from whichever tenant holds the most at each step, so
+    a tenant whose traffic spiked gives up its own sessions before a small
+    tenant loses any.
+    """
+    with _sessions_lock:
+        count = int(len(active_sessions) * fraction)
+        by_tenant = {}
+        for key in sorted(active_sessions, key=lambda k: active_sessions[k]["last_updated"]):
+            by_tenant.setdefault(key[0], deque()).append(key)
+        for _ in range(count):
+            largest = max(by_tenant.values(), key=len)
+            del active_sessions[largest.popleft()]
+        return count
 
 def cleanup_expired_sessions():
     """Remove sessions that have been inactive for longer than SESSION_TIMEOUT"""
     now = datetime.now()
-    expired_sessions = []
-    
-    for session_id, session_data in active_sessions.items():
-        if now - session_data["last_updated"] > timedelta(minutes=SESSION_TIMEOUT):
-            expired_sessions.append(session_id)
     
-    for session_id in expired_sessions:
-        logger.info(f"Removing expired session: {session_id}")
-        del active_sessions[session_id]
\ No newline at end of file
+    with _sessions_lock:
+        expired_sessions = []
+        
+        for key, session_data in active_sessions.items():
+            if now - session_data["last_updated"] > timedelta(minutes=SESSION_TIMEOUT):
+                expired_sessions.append(key)
+        
+        for key in expired_sessions:
+            logger.info(f"Removing expired session: {key[1]} (tenant {key[0]})")
+            del active_sessions[key]
+
+# Sessions are evicted after caches when the soft memory limit is hit
+register_memory_source('sessions', sessions_size_bytes, evict_sessions, priority=50)
@@ -0,0 +1,109 @@
+import contextlib
+import contextvars
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+# Tenant of the request being handled (None means the default tenant)
+_current_tenant = contextvars.ContextVar('tenant', default=None)
+
+# Tenant IDs end up in Firestore document paths and file names
+TENANT_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,62}$")
+
+
+class UnknownTenant(Exception):
+    """Raised when a request names a tenant this deployment does not serve"""
+
+
+class TenantQuotaExceeded(Exception):
+    """Raised when a tenant has used up its model calls for the current minute"""
+
+    def __init__(self, tenant: str, limit: int, retry_after: float):
+        super().__init__(f"Tenant {tenant} reached its limit of {limit} model calls per minute")
+        self.tenant = tenant
+        self.limit = limit
+        # Whole seconds, as sent in Retry-After
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def current_tenant() -> str:
+    return _current_tenant.get() or Config.DEFAULT_TENANT
+
+
+def is_default_tenant(tenant: Optional[str] = None) -> bool:
+    return (tenant or current_tenant()) == Config.DEFAULT_TENANT
+
+
+def set_tenant(tenant: str):
+    """Make tenant current for this context; returns a token for reset_tenant()"""
+    return _current_tenant.set(tenant)
+
+
+def reset_tenant(token):
+    _current_tenant.reset(token)
+
+
+@contextlib.contextmanager
+def tenant_context(tenant: str):
+    """Run the block (e.g. background work queued by a request) as tenant"""
+    token = _current_tenant.set(tenant)
+    try:
+        yield
+    finally:
+        _current_tenant.reset(token)
+
+
+def configured_tenants() -> List[str]:
+    """The default tenant followed by the ones listed in TENANTS"""
+    tenants = [Config.DEFAULT_TENANT]
+    for tenant in filter(None, (item.strip() for item in Config.TENANTS.split(","))):
+        if tenant not in tenants:
+            tenants.append(tenant)
+    return tenants
+
+
+def admin_access_error(request) -> Optional[Tuple[str, int]]:
+    """Why request may not use admin capabilities as (message, status), None when it may
+
+    Admin data spans every tenant, so only the default tenant gets it, and with
+    TENANTS set an unset ADMIN_TOKEN fails closed rather than open.
+    """
+    if not is_default_tenant():
+        return "Admin endpoints are only available to the default tenant", 403
+    if not Config.ADMIN_TOKEN:
+        if len(configured_tenants()) > 1:
+            return "ADMIN_TOKEN must be set to use admin endpoints when TENANTS is configured", 403
+        return None
+    if request.headers.get("X-Admin-Token") != Config.ADMIN_TOKEN:
+        return "admin token required", 401
+    return None
+
+
+def tenant_from_request(request) -> str:
+    """Tenant named by the tenant header, the default tenant without one"""
+    tenant = request.headers.get(Config.TENANT_HEADER)
+    if not tenant:
+        return Config.DEFAULT_TENANT
+    tenant = tenant.strip().lower()
+    if not TENANT_ID_PATTERN.match(tenant) or tenant not in configured_tenants():
+        raise UnknownTenant(f"Unknown tenant: {tenant[:64]}")
+    return tenant
+
+
+def parse_tenant_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    """Parse "acme:4:120,beta:2:60" into {tenant: (max concurrent calls, calls per minute)}; 0 means no limit"""
+    limits = {}
+    for part in filter(None, (item.strip() for item in spec.split(","))):
+        fields = part.split(":")
+        if len(fields) != 3:
+            raise ValueError(f"TENANT_LIMITS entries are tenant:concurrency:per_minute, got {part}")
+        limits[fields[0]] = (int(fields[1]), int(fields[2]))
+    return limits
+
+
+def tenant_limits(tenant: str) -> Tuple[int, int]:
+    """(max concurrent model calls, model calls per minute) for tenant; 0 means no limit"""
+    return parse_tenant_limits(Config.TENANT_LIMITS).get(
+        tenant, (Config.TENANT_MAX_CONCURRENCY, Config.TENANT_MODEL_CALLS_PER_MINUTE))
@@ -7,6 +7,37 @@ class Config:
     # Google AI Studio configuration
     GOOGLE_AI_API_KEY = os.getenv("GOOGLE_AI_API_KEY")
     GOOGLE_AI_MODEL = os.getenv("GOOGLE_AI_MODEL", "gemini-2.5-flash-lite")
+    # Key pool: comma-separated "key[:rpm[:tpm]]" entries; more than one key enables per-key rate scheduling
+    GOOGLE_AI_API_KEYS = os.getenv("GOOGLE_AI_API_KEYS")
+    GOOGLE_AI_KEY_RPM = float(os.getenv("GOOGLE_AI_KEY_RPM", "1000"))
+    GOOGLE_AI_KEY_TPM = float(os.getenv("GOOGLE_AI_KEY_TPM", "1000000"))
+    GOOGLE_AI_KEY_PARK_SECONDS = float(os.getenv("GOOGLE_AI_KEY_PARK_SECONDS", "60"))
+    KEY_POOL_MAX_WAIT_SECONDS = float(os.getenv("KEY_POOL_MAX_WAIT_SECONDS", "5"))
+    
+    # Model backend: "gemini", "cassette" (record/replay) or "fake" (local fake server)
+    LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+    LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+    LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH", "cassettes/llm.json")
+    LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "replay")
+    LLM_CASSETTE_INNER = os.getenv("LLM_CASSETTE_INNER", "gemini")
+    FAKE_LLM_URL = os.getenv("FAKE_LLM_URL", "http://127.0.0.1:8099")
+    
+    # Context caching of the static prompt prefix
+    CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+    CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+    # Gemini rejects caches below a minimum token count (~1k tokens for flash models)
+    CONTEXT_CACHE_MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", "4096"))
+    CONTEXT_CACHE_RETRY_SECONDS = int(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", "300"))
+    # Prefixes kept cached at once (variants, shadow candidates, tenants) and how long a request waits for a new one
+    CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "8"))
+    CONTEXT_CACHE_CREATE_TIMEOUT_SECONDS = float(os.getenv("CONTEXT_CACHE_CREATE_TIMEOUT_SECONDS", "5"))
+    
+    # Asynchronous /improve-ai job queue
+    IMPROVE_WORKERS = int(os.getenv("IMPROVE_WORKERS", "4"))
+    IMPROVE_BATCH_WINDOW_MS = int(os.getenv("IMPROVE_BATCH_WINDOW_MS", "2000"))
+    IMPROVE_MAX_BATCH = int(os.getenv("IMPROVE_MAX_BATCH", "8"))
+    IMPROVE_MAX_COMMIT_RETRIES = int(os.getenv("IMPROVE_MAX_COMMIT_RETRIES", "3"))
+    IMPROVE_JOB_RETENTION = int(os.getenv("IMPROVE_JOB_RETENTION", "1000"))
     
     # Firebase configuration
     FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID")
@@ -17,5 +48,127 @@ class Config:
     FIREBASE_AUTH_URI = os.getenv("FIREBASE_AUTH_URI", "https://accounts.google.com/o/oauth2/auth")
     FIREBASE_TOKEN_URI = os.getenv("FIREBASE_TOKEN_URI", "https://oauth2.googleapis.com/token")
     
+    # Conversation corpus (JSON array or NDJSON); defaults to data/conversations.json
+    CONVERSATIONS_PATH = os.getenv("CONVERSATIONS_PATH")
+    
+    # Request deadlines (overridable per request with X-Request-Timeout-Ms)
+    DEFAULT_REQUEST_TIMEOUT_MS = float(os.getenv("DEFAULT_REQUEST_TIMEOUT_MS", "30000"))
+    MAX_REQUEST_TIMEOUT_MS = float(os.getenv("MAX_REQUEST_TIMEOUT_MS", "120000"))
+    DEADLINE_CALL_THREADS = int(os.getenv("DEADLINE_CALL_THREADS", "32"))
+    
+    # Admin endpoints (/admin/*), default tenant only; open when unset unless TENANTS is set
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+    
+    # On-demand profiling (X-Profile: cprofile|sample header or sampling rate)
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")
+    PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+    PROFILE_OUTPUT_DIR = os.getenv("PROFILE_OUTPUT_DIR", "profiles")
+    PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+    
+    # Memory accounting: soft limit (0 disables) triggers cache/session eviction
+    MEMORY_SOFT_LIMIT_MB = float(os.getenv("MEMORY_SOFT_LIMIT_MB", "0"))
+    MEMORY_EVICT_FRACTION = float(os.getenv("MEMORY_EVICT_FRACTION", "0.25"))
+    MEMORY_CHECK_INTERVAL_SECONDS = float(os.getenv("MEMORY_CHECK_INTERVAL_SECONDS", "10"))
+    TRACEMALLOC_ENABLED = os.getenv("TRACEMALLOC_ENABLED", "false").lower() == "true"
+    TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+    TRACEMALLOC_SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("TRACEMALLOC_SNAPSHOT_INTERVAL_SECONDS", "300"))
+    
+    # Scenario classifier and per-scenario prompt variants
+    SCENARIO_ROUTING_ENABLED = os.getenv("SCENARIO_ROUTING_ENABLED", "true").lower() == "true"
+    CLASSIFIER_MODEL_PATH = os.getenv("CLASSIFIER_MODEL_PATH", "models/scenario_classifier.npz")
+    CLASSIFIER_FEATURES = int(os.getenv("CLASSIFIER_FEATURES", str(1 << 18)))
+    CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", "0.6"))
+    CLASSIFIER_RETRY_SECONDS = int(os.getenv("CLASSIFIER_RETRY_SECONDS", "600"))
+    PROMPT_VARIANT_CACHE_SECONDS = float(os.getenv("PROMPT_VARIANT_CACHE_SECONDS", "60"))
+    
+    # Generation profiles (output caps, temperature, stop sequences); JSON file overrides the defaults
+    GENERATION_PROFILES_PATH = os.getenv("GENERATION_PROFILES_PATH")
+    
+    # Prompt rollout: "direct" commits edits immediately, "shadow" evaluates them on sampled traffic first
+    PROMPT_ROLLOUT_MODE = os.getenv("PROMPT_ROLLOUT_MODE", "direct")
+    SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0.1"))
+    SHADOW_WORKERS = int(os.getenv("SHADOW_WORKERS", "2"))
+    SHADOW_MAX_PENDING = int(os.getenv("SHADOW_MAX_PENDING", "32"))
+    SHADOW_MIN_SAMPLES = int(os.getenv("SHADOW_MIN_SAMPLES", "20"))
+    SHADOW_AUTO_DECIDE = os.getenv("SHADOW_AUTO_DECIDE", "true").lower() == "true"
+    SHADOW_MAX_LATENCY_RATIO = float(os.getenv("SHADOW_MAX_LATENCY_RATIO", "1.5"))
+    SHADOW_MAX_OUTPUT_TOKENS_RATIO = float(os.getenv("SHADOW_MAX_OUTPUT_TOKENS_RATIO", "1.5"))
+    SHADOW_MAX_FAILURE_RATE = float(os.getenv("SHADOW_MAX_FAILURE_RATE", "0.05"))
+    
+    # Append-only interaction log shipped to SQLite or Firestore ("none" keeps segments locally)
+    INTERACTION_LOG_ENABLED = os.getenv("INTERACTION_LOG_ENABLED", "true").lower() == "true"
+    INTERACTION_LOG_DIR = os.getenv("INTERACTION_LOG_DIR", "interaction_logs")
+    INTERACTION_LOG_SINK = os.getenv("INTERACTION_LOG_SINK", "sqlite")
+    INTERACTION_LOG_SQLITE_PATH = os.getenv("INTERACTION_LOG_SQLITE_PATH", "interaction_logs/interactions.db")
+    INTERACTION_LOG_FSYNC_INTERVAL_MS = float(os.getenv("INTERACTION_LOG_FSYNC_INTERVAL_MS", "1000"))
+    INTERACTION_LOG_SEGMENT_MAX_BYTES = int(os.getenv("INTERACTION_LOG_SEGMENT_MAX_BYTES", str(16 * 1024 * 1024)))
+    INTERACTION_LOG_SEGMENT_MAX_AGE_SECONDS = float(os.getenv("INTERACTION_LOG_SEGMENT_MAX_AGE_SECONDS", "300"))
+    INTERACTION_LOG_SHIP_INTERVAL_SECONDS = float(os.getenv("INTERACTION_LOG_SHIP_INTERVAL_SECONDS", "30"))
+    INTERACTION_LOG_MAX_PENDING = int(os.getenv("INTERACTION_LOG_MAX_PENDING", "10000"))
+    INTERACTION_LOG_KEEP_SHIPPED = os.getenv("INTERACTION_LOG_KEEP_SHIPPED", "false").lower() == "true"
+    
+    # Idempotency-Key support on POST endpoints
+    IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+    IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+    IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+    
+    # Prompt history: local replica for cold start, keyframe spacing of the delta chain
+    PROMPT_SNAPSHOT_PATH = os.getenv("PROMPT_SNAPSHOT_PATH", "prompt_store/snapshot.json")
+    PROMPT_HISTORY_KEYFRAME_INTERVAL = int(os.getenv("PROMPT_HISTORY_KEYFRAME_INTERVAL", "10"))
+    
+    # Model-call scheduler: concurrent calls, slots only interactive replies may use, class weights
+    MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "16"))
+    MODEL_INTERACTIVE_RESERVED_SLOTS = int(os.getenv("MODEL_INTERACTIVE_RESERVED_SLOTS", "4"))
+    MODEL_PRIORITY_WEIGHTS = os.getenv("MODEL_PRIORITY_WEIGHTS", "interactive:16,admin:4,batch:1")
+    
+    # Session-mode chat: messages within the window are answered together, up to the max wait.
+    # Off by default: merging needs a worker that serves concurrent requests (gunicorn --threads or gevent)
+    CHAT_DEBOUNCE_MS = int(os.getenv("CHAT_DEBOUNCE_MS", "0"))
+    CHAT_DEBOUNCE_MAX_MS = int(os.getenv("CHAT_DEBOUNCE_MAX_MS", "3000"))
+    
+    # Speculative replies from /draft: off by default; budget, per-draft deadline, lifetime and match threshold
+    SPECULATION_ENABLED = os.getenv("SPECULATION_ENABLED", "false").lower() == "true"
+    SPECULATION_MAX_IN_FLIGHT = int(os.getenv("SPECULATION_MAX_IN_FLIGHT", "4"))
+    SPECULATION_MAX_PER_MINUTE = int(os.getenv("SPECULATION_MAX_PER_MINUTE", "60"))
+    SPECULATION_TIMEOUT_MS = int(os.getenv("SPECULATION_TIMEOUT_MS", "15000"))
+    SPECULATION_TTL_SECONDS = float(os.getenv("SPECULATION_TTL_SECONDS", "60"))
+    SPECULATION_MATCH_THRESHOLD = float(os.getenv("SPECULATION_MATCH_THRESHOLD", "0.9"))
+    
+    # Near-duplicate filtering of /improve-ai feedback: similarity threshold, index size and file
+    FEEDBACK_DEDUP_ENABLED = os.getenv("FEEDBACK_DEDUP_ENABLED", "true").lower() == "true"
+    FEEDBACK_DEDUP_THRESHOLD = float(os.getenv("FEEDBACK_DEDUP_THRESHOLD", "0.6"))
+    FEEDBACK_DEDUP_MAX_ENTRIES = int(os.getenv("FEEDBACK_DEDUP_MAX_ENTRIES", "5000"))
+    FEEDBACK_DEDUP_PATH = os.getenv("FEEDBACK_DEDUP_PATH", "models/feedback_minhash.npz")
+    
+    # Tenants: TENANT_HEADER selects one of TENANTS (empty: single tenant); per-tenant model-call and session limits
+    DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+    TENANTS = os.getenv("TENANTS", "")
+    TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant-ID")
+    TENANT_MAX_CONCURRENCY = int(os.getenv("TENANT_MAX_CONCURRENCY", "0"))
+    TENANT_MODEL_CALLS_PER_MINUTE = int(os.getenv("TENANT_MODEL_CALLS_PER_MINUTE", "0"))
+    TENANT_LIMITS = os.getenv("TENANT_LIMITS", "")
+    TENANT_MAX_SESSIONS = int(os.getenv("TENANT_MAX_SESSIONS", "0"))
+    
+    # Request tracing: head sample rate, slow traces always kept, OTLP collector (rotated JSON-lines file when unset)
+    TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+    TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+    TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))
+    TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "visa-qa-api")
+    OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+    TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "traces/spans.jsonl")
+    TRACE_JSONL_MAX_BYTES = int(os.getenv("TRACE_JSONL_MAX_BYTES", str(64 * 1024 * 1024)))
+    TRACE_JSONL_MAX_FILES = int(os.getenv("TRACE_JSONL_MAX_FILES", "3"))
+    TRACE_EXPORT_BATCH_SIZE = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", "256"))
+    TRACE_EXPORT_INTERVAL_MS = int(os.getenv("TRACE_EXPORT_INTERVAL_MS", "2000"))
+    TRACE_EXPORT_TIMEOUT_SECONDS = float(os.getenv("TRACE_EXPORT_TIMEOUT_SECONDS", "5"))
+    TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "8192"))
+    
+    # Response compression (brotli when the brotli package is installed, else gzip)
+    RESPONSE_COMPRESSION_ENABLED = os.getenv("RESPONSE_COMPRESSION_ENABLED", "true").lower() == "true"
+    RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+    RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+    RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "5"))
+    
     # Flask configuration
     PORT = int(os.environ.get('PORT', 3032))
\ No newline at end of file
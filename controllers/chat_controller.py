@@ -1,13 +1,83 @@
-from flask import Blueprint, request, jsonify
+import time
+from flask import Blueprint, g, request, jsonify
 from services.google_ai_service import GoogleAIService
-from services.database_service import get_prompt, update_prompt
+from services.database_service import (
+    PromptVersionConflict, delete_scenario_prompt, get_prompt, get_prompt_version, get_prompt_with_version,
+    list_prompt_versions, list_scenario_prompts, prompt_hash, rollback_prompt, update_prompt, update_scenario_prompt
+)
+from services.feedback_dedup import FeedbackDeduplicator
+from services.interaction_log import interaction_log
+from services.scenario_classifier import classify_scenario
+from services.improve_queue import ImproveJobQueue
+from services.model_scheduler import reset_model_session, set_model_session
+from services.shadow_eval import ShadowEvaluator
+from services.speculation import ReplySpeculator
+from utils.session_manager import (
+    get_chat_history, get_last_turn_index, get_turns_since, join_burst, seed_session, update_session_context
+)
+from utils.deadline import ClientDisconnected, DeadlineExceeded, Superseded
+from utils.idempotency import idempotent
+from utils.profiler import profiled
+from utils.tenancy import TenantQuotaExceeded
+from utils.tracing import set_span_attributes
+from utils.responses import etag_response
 
 chat_controller = Blueprint('chat', __name__)
 ai_service = GoogleAIService()
+feedback_dedup = FeedbackDeduplicator()
+shadow_evaluator = ShadowEvaluator(ai_service, dedup=feedback_dedup)
+improve_queue = ImproveJobQueue(ai_service, shadow=shadow_evaluator, dedup=feedback_dedup)
+speculator = ReplySpeculator(ai_service)
+
+@chat_controller.before_request
+def set_fairness_session():
+    """Queue this request's model calls under its chat session (client address when there is none)"""
+    data = request.get_json(silent=True) if request.is_json else None
+    session = None
+    if isinstance(data, dict):
+        # /chat uses session_id, /generate-reply sessionId
+        session = data.get('session_id') or data.get('sessionId')
+    session = session or request.remote_addr
+    g.model_session_token = set_model_session(session)
+
+@chat_controller.teardown_request
+def clear_fairness_session(exc=None):
+    token = g.pop('model_session_token', None)
+    if token is not None:
+        reset_model_session(token)
+
+def _resume_session(session_id, chat_history, last_seen_turn):
+    """Seed a session from the client's history, or report that the server lost the turns the client has seen"""
+    if chat_history is not None:
+        seed_session(session_id, chat_history)
+        return None
+    if last_seen_turn is not None and last_seen_turn > get_last_turn_index(session_id):
+        # Answering now would drop the conversation's context; the client resends it as chatHistory
+        return {'error': 'Session history is no longer available; resend the request with the chat history',
+                'sessionReset': True}
+    return None
+
+def _session_delta(session_id, last_seen_turn, reply_turn):
+    """Turns the client has not seen yet, ending with the reply just generated"""
+    if last_seen_turn is None:
+        last_seen_turn = reply_turn - 2
+    
+    # The client knows turns the server no longer has (expired or restarted session)
+    session_reset = last_seen_turn > reply_turn - 2
+    turns = get_turns_since(session_id, None if session_reset else last_seen_turn)
+    
+    return {
+        'turnIndex': reply_turn,
+        'turns': turns,
+        'sessionReset': session_reset
+    }
 
 @chat_controller.route('/chat', methods=['POST'])
+@profiled('chat')
+@idempotent
 def chat():
     """Simple chat endpoint for frontend compatibility"""
+    burst, burst_leader = None, None
     try:
         data = request.get_json()
         
@@ -17,28 +87,90 @@ def chat():
         
         message = data['message']
         session_id = data.get('session_id', 'default')
-        chat_history = data.get('chat_history', [])
-        
-        # Get current prompt from database
-        current_prompt = get_prompt()
-        
-        # Generate AI reply
-        ai_reply = ai_service.generate_reply(message, chat_history, current_prompt)
         
-        return jsonify({
+        # Session mode: the server keeps the history, the client only sends the new message
+        # (chat_history alongside session_id only seeds a session the server has no turns for)
+        session_mode = 'session_id' in data
+        if session_mode:
+            lost = _resume_session(session_id, data.get('chat_history'), data.get('last_seen_turn'))
+            if lost:
+                return jsonify(dict(lost, session_id=session_id)), 409
+            # Messages sent in quick succession get one reply, answered on the newest request
+            joined = join_burst(session_id, message)
+            if joined is None:
+                return jsonify({'reply': None, 'session_id': session_id, 'superseded': True})
+            burst, burst_leader = joined
+            message = burst.text
+            chat_history = get_chat_history(session_id)
+        else:
+            chat_history = data.get('chat_history', [])
+        
+        # A reply generated from the client's draft while they were typing
+        speculated = speculator.take(session_id, message) if session_mode and speculator.enabled() else None
+        set_span_attributes({'session.mode': session_mode, 'chat.history_length': len(chat_history),
+                             'speculation.hit': speculated is not None if session_mode else None})
+        if speculated is not None:
+            result = speculated[0]
+        else:
+            # Get the prompt for the detected scenario (main prompt when unclassified)
+            scenario, _ = classify_scenario(message)
+            current_prompt = get_prompt(scenario)
+            
+            # Generate AI reply
+            result = ai_service.generate_reply_detailed(message, chat_history, current_prompt)
+        if result.get('error'):
+            # The apology reply is not an answer: keep it out of the session and the idempotency store
+            return jsonify({'error': result['error']}), 502
+        ai_reply = result['reply']
+        
+        response = {
             'reply': ai_reply,
             'session_id': session_id
-        })
-        
+        }
+        if speculated is not None:
+            response['speculative'] = True
+        if session_mode:
+            messages = list(burst.messages)
+            if not burst.close(burst_leader):
+                # A newer message arrived while generating; its request answers all of them
+                return jsonify({'reply': None, 'session_id': session_id, 'superseded': True})
+            reply_turn = update_session_context(session_id, None, message, ai_reply, client_messages=messages)
+            delta = _session_delta(session_id, data.get('last_seen_turn'), reply_turn)
+            response.update({
+                'turn_index': delta['turnIndex'],
+                'turns': delta['turns'],
+                'session_reset': delta['sessionReset'],
+                'merged_messages': len(messages)
+            })
+        
+        return jsonify(response)
+        
+    except Superseded:
+        return jsonify({'reply': None, 'session_id': session_id, 'superseded': True})
+    except TenantQuotaExceeded as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ClientDisconnected as e:
+        # Nobody is listening; the status only shows up in access logs
+        return jsonify({'error': str(e)}), 499
     except Exception as e:
         import traceback
         print(f"Chat error: {e}")
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
+    finally:
+        if burst is not None:
+            # Failed requests drop their burst instead of leaving it for the next message
+            burst.close(burst_leader)
 
 @chat_controller.route('/generate-reply', methods=['POST'])
+@profiled('generate_reply')
+@idempotent
 def generate_reply():
     """Generate an AI response based on conversation context"""
+    started = time.perf_counter()
+    burst, burst_leader = None, None
     try:
         data = request.get_json()
         
@@ -47,28 +179,129 @@ def generate_reply():
             return jsonify({'error': 'clientSequence is required'}), 400
         
         client_sequence = data['clientSequence']
-        chat_history = data.get('chatHistory', [])
-        
-        # Get current prompt from database
-        current_prompt = get_prompt()
-        print(f"Controller: Retrieved prompt from database: {current_prompt[:100]}...")
-        
-        # Generate AI reply
-        ai_reply = ai_service.generate_reply(client_sequence, chat_history, current_prompt)
-        
-        return jsonify({
+        session_id = data.get('sessionId')
+        
+        # Session mode: the server keeps the history, the client only sends the new message
+        # (chatHistory alongside sessionId only seeds a session the server has no turns for)
+        session_mode = session_id is not None
+        if session_mode:
+            lost = _resume_session(session_id, data.get('chatHistory'), data.get('lastSeenTurn'))
+            if lost:
+                return jsonify(dict(lost, sessionId=session_id)), 409
+            # Messages sent in quick succession get one reply, answered on the newest request
+            joined = join_burst(session_id, client_sequence)
+            if joined is None:
+                return jsonify({'aiReply': None, 'sessionId': session_id, 'superseded': True})
+            burst, burst_leader = joined
+            client_sequence = burst.text
+            chat_history = get_chat_history(session_id)
+        else:
+            chat_history = data.get('chatHistory', [])
+        
+        # A reply generated from the client's draft while they were typing
+        speculated = speculator.take(session_id, client_sequence) if session_mode and speculator.enabled() else None
+        set_span_attributes({'session.mode': session_mode, 'chat.history_length': len(chat_history),
+                             'speculation.hit': speculated is not None if session_mode else None})
+        if speculated is not None:
+            result, scenario, current_prompt = dict(speculated[0]), speculated[1], speculated[2]
+            result['speculative'] = True
+        else:
+            # Get the prompt for the detected scenario (main prompt when unclassified)
+            scenario, confidence = classify_scenario(client_sequence)
+            current_prompt = get_prompt(scenario)
+            print(f"Controller: Retrieved prompt for scenario {scenario or 'default'} ({confidence:.2f}): {current_prompt[:100]}...")
+            
+            # Generate AI reply
+            result = ai_service.generate_reply_detailed(client_sequence, chat_history, current_prompt)
+        ai_reply = result['reply']
+        
+        # Candidate prompts replace the main prompt, so only main-prompt traffic is shadowed
+        if scenario is None:
+            shadow_evaluator.maybe_shadow(client_sequence, chat_history, result)
+        if result.get('error'):
+            # The apology reply is not an answer: keep it out of the session and the idempotency store
+            return jsonify({'error': result['error']}), 502
+        
+        response = {
             'aiReply': ai_reply
+        }
+        if speculated is not None:
+            response['speculative'] = True
+        if session_mode:
+            messages = list(burst.messages)
+            if not burst.close(burst_leader):
+                # A newer message arrived while generating; its request answers all of them
+                return jsonify({'aiReply': None, 'sessionId': session_id, 'superseded': True})
+            reply_turn = update_session_context(session_id, None, client_sequence, ai_reply, client_messages=messages)
+            response['sessionId'] = session_id
+            response['mergedMessages'] = len(messages)
+            response.update(_session_delta(session_id, data.get('lastSeenTurn'), reply_turn))
+        
+        interaction_log.append('generate_reply', {
+            'promptHash': prompt_hash(current_prompt),
+            'scenario': scenario,
+            'sessionId': session_id,
+            'clientSequence': client_sequence,
+            'chatHistory': chat_history,
+            'reply': ai_reply,
+            'metrics': {key: value for key, value in result.items() if key != 'reply'},
+            'requestMs': (time.perf_counter() - started) * 1000.0
         })
         
+        return jsonify(response)
+        
+    except Superseded:
+        return jsonify({'aiReply': None, 'sessionId': session_id, 'superseded': True})
+    except TenantQuotaExceeded as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ClientDisconnected as e:
+        return jsonify({'error': str(e)}), 499
     except Exception as e:
         import traceback
         print(f"Controller error: {e}")
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
+    finally:
+        if burst is not None:
+            burst.close(burst_leader)
+
+@chat_controller.route('/draft', methods=['POST'])
+@profiled('draft')
+def draft():
+    """Pre-generate a reply to the client's in-progress message (speculative mode)"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'sessionId' not in data or 'text' not in data:
+            return jsonify({'error': 'Missing required fields: sessionId, text'}), 400
+        if not speculator.enabled():
+            return jsonify({'status': 'disabled'})
+        
+        result = speculator.draft(data['sessionId'], data['text'])
+        return jsonify(result), 202 if result['status'] == 'started' else 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_controller.route('/sessions/<session_id>/turns', methods=['GET'])
+def get_session_turns(session_id):
+    """Get the session turns after ?since=<turn index> for client reconciliation"""
+    try:
+        since = request.args.get('since', type=int)
+        return jsonify({
+            'sessionId': session_id,
+            'turns': get_turns_since(session_id, since)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @chat_controller.route('/improve-ai', methods=['POST'])
+@profiled('improve_ai')
+@idempotent
 def improve_ai():
-    """Auto-improve the AI prompt by comparing predicted vs actual consultant reply"""
+    """Queue a job that auto-improves the AI prompt by comparing predicted vs actual consultant reply"""
     try:
         data = request.get_json()
         
@@ -81,30 +314,30 @@ def improve_ai():
         chat_history = data['chatHistory']
         consultant_reply = data['consultantReply']
         
-        # Get current prompt from database
-        current_prompt = get_prompt()
-        
-        # Generate predicted reply
-        predicted_reply = ai_service.generate_reply(client_sequence, chat_history, current_prompt)
-        
-        # Improve the prompt
-        updated_prompt = ai_service.improve_prompt(
-            current_prompt, client_sequence, chat_history, 
-            consultant_reply, predicted_reply
-        )
-        
-        # Update prompt in database
-        update_prompt(updated_prompt)
+        # Prediction, editing and the prompt commit happen on the background queue
+        job = improve_queue.submit(client_sequence, chat_history, consultant_reply)
         
         return jsonify({
-            'predictedReply': predicted_reply,
-            'updatedPrompt': updated_prompt
-        })
+            'jobId': job['jobId'],
+            'status': job['status'],
+            'duplicateOf': job['duplicateOf'],
+            'statusUrl': f"/jobs/{job['jobId']}"
+        }), 202
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@chat_controller.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get the status of a queued improve-ai job"""
+    job = improve_queue.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify(job)
+
 @chat_controller.route('/improve-ai-manually', methods=['POST'])
+@profiled('improve_ai_manually')
+@idempotent
 def improve_ai_manually():
     """Manually update the AI prompt with specific instructions"""
     try:
@@ -116,11 +349,22 @@ def improve_ai_manually():
         
         instructions = data['instructions']
         
-        # Get current prompt from database
-        current_prompt = get_prompt()
+        # Get current prompt from database (or the candidate under shadow evaluation)
+        current_prompt = (shadow_evaluator.enabled() and shadow_evaluator.working_prompt()) or get_prompt()
         
         # Improve the prompt
         updated_prompt = ai_service.manual_improve_prompt(current_prompt, instructions)
+        if updated_prompt == current_prompt:
+            # The editor hands back the prompt it was given when it fails; that is not an edit
+            return jsonify({'error': 'Prompt editor returned no change; nothing was committed'}), 502
+        
+        if shadow_evaluator.enabled():
+            candidate = shadow_evaluator.propose(updated_prompt, 'improve-ai-manually')
+            return jsonify({
+                'updatedPrompt': updated_prompt,
+                'candidateId': candidate['candidateId'],
+                'status': candidate['status']
+            })
         
         # Update prompt in database
         update_prompt(updated_prompt)
@@ -129,21 +373,35 @@ def improve_ai_manually():
             'updatedPrompt': updated_prompt
         })
         
+    except TenantQuotaExceeded as e:
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ClientDisconnected as e:
+        return jsonify({'error': str(e)}), 499
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @chat_controller.route('/prompt', methods=['GET'])
+@profiled('get_prompt')
 def get_current_prompt():
     """Get the current AI prompt"""
     try:
-        current_prompt = get_prompt()
-        return jsonify({
-            'prompt': current_prompt
+        current_prompt, version = get_prompt_with_version()
+        # Unchanged prompts are answered with 304 before serializing the text
+        return etag_response(f"prompt-{version}-{prompt_hash(current_prompt)}", lambda: {
+            'prompt': current_prompt,
+            'version': version
         })
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ClientDisconnected as e:
+        return jsonify({'error': str(e)}), 499
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @chat_controller.route('/prompt', methods=['PUT'])
+@profiled('update_prompt')
 def update_current_prompt():
     """Update the AI prompt directly"""
     try:
@@ -155,6 +413,15 @@ def update_current_prompt():
         
         new_prompt = data['prompt']
         
+        if shadow_evaluator.enabled():
+            candidate = shadow_evaluator.propose(new_prompt, 'put-prompt')
+            return jsonify({
+                'message': 'Prompt staged for shadow evaluation',
+                'prompt': new_prompt,
+                'candidateId': candidate['candidateId'],
+                'status': candidate['status']
+            })
+        
         # Update prompt in database
         update_prompt(new_prompt)
         
@@ -163,5 +430,109 @@ def update_current_prompt():
             'prompt': new_prompt
         })
         
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ClientDisconnected as e:
+        return jsonify({'error': str(e)}), 499
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_controller.route('/prompt/versions', methods=['GET'])
+def get_prompt_versions():
+    """Prompt history, newest first (?limit=, ?before=<version> to page)"""
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        before = request.args.get('before', type=int)
+        _, current_version = get_prompt_with_version()
+        return jsonify({
+            'currentVersion': current_version,
+            'versions': list_prompt_versions(limit, before)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_controller.route('/prompt/versions/<int:version>', methods=['GET'])
+def get_prompt_version_text(version):
+    """Text and metadata of one prompt version"""
+    try:
+        entry = get_prompt_version(version)
+        if entry is None:
+            return jsonify({'error': f'prompt version {version} not found'}), 404
+        # Versions never change once written
+        return etag_response(f"prompt-{version}-{entry['hash']}", lambda: entry,
+                             cache_control='public, max-age=31536000, immutable')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_controller.route('/prompt/rollback', methods=['POST'])
+@profiled('rollback_prompt')
+@idempotent
+def rollback_current_prompt():
+    """Make an earlier prompt version current again (recorded as a new version)"""
+    try:
+        data = request.get_json()
+        
+        # Validate required fields
+        if not data or not isinstance(data.get('version'), int):
+            return jsonify({'error': 'version is required'}), 400
+        
+        new_version = rollback_prompt(data['version'], expected_version=data.get('expected_version'))
+        
+        return jsonify({
+            'message': f"Prompt rolled back to version {data['version']}",
+            'version': new_version,
+            'rollbackOf': data['version']
+        })
+        
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    except PromptVersionConflict as e:
+        return jsonify({'error': str(e)}), 409
+    except DeadlineExceeded as e:
+        return jsonify({'error': str(e)}), 504
+    except ClientDisconnected as e:
+        return jsonify({'error': str(e)}), 499
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_controller.route('/prompt/variants', methods=['GET'])
+def get_prompt_variants():
+    """List the scenario-specific prompt variants"""
+    try:
+        return jsonify({
+            'variants': list_scenario_prompts()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_controller.route('/prompt/variants/<scenario>', methods=['PUT'])
+def update_prompt_variant(scenario):
+    """Create or replace the prompt variant used for a scenario"""
+    try:
+        data = request.get_json()
+        
+        # Validate required fields
+        if not data or 'prompt' not in data:
+            return jsonify({'error': 'prompt is required'}), 400
+        
+        update_scenario_prompt(scenario, data['prompt'])
+        
+        return jsonify({
+            'message': 'Prompt variant updated successfully',
+            'scenario': scenario,
+            'prompt': data['prompt']
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@chat_controller.route('/prompt/variants/<scenario>', methods=['DELETE'])
+def delete_prompt_variant(scenario):
+    """Remove a scenario prompt variant; the scenario falls back to the main prompt"""
+    try:
+        delete_scenario_prompt(scenario)
+        return jsonify({
+            'message': 'Prompt variant deleted',
+            'scenario': scenario
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
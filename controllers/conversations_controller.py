@@ -0,0 +1,63 @@
+from flask import Blueprint, request, jsonify
+from services.conversation_query import MAX_PAGE_SIZE, InvalidCursor, conversation_index
+from utils.profiler import profiled
+from utils.tenancy import is_default_tenant
+
+conversations_controller = Blueprint('conversations', __name__)
+
+@conversations_controller.before_request
+def require_default_tenant():
+    """The conversation corpus belongs to the default tenant; other tenants cannot list or read it"""
+    if not is_default_tenant():
+        return jsonify({'error': 'Conversations are only available to the default tenant'}), 403
+
+def _fields_arg():
+    """?fields=a,b,c as a list, None when not given"""
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+@conversations_controller.route('/conversations', methods=['GET'])
+@profiled('list_conversations')
+def list_conversations():
+    """Page through conversations filtered by scenario, processed and contact_id"""
+    try:
+        processed = request.args.get('processed')
+        if processed is not None:
+            if processed.lower() not in ('true', 'false'):
+                return jsonify({'error': 'processed must be true or false'}), 400
+            processed = processed.lower() == 'true'
+
+        limit = request.args.get('limit', 50, type=int)
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+
+        page = conversation_index.query(
+            scenario=request.args.get('scenario'),
+            processed=processed,
+            contact_id=request.args.get('contact_id'),
+            limit=limit,
+            cursor=request.args.get('cursor'),
+            fields=_fields_arg()
+        )
+        page['indexReady'] = conversation_index.ready.is_set()
+        return jsonify(page)
+
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@conversations_controller.route('/conversations/scenarios', methods=['GET'])
+def list_conversation_scenarios():
+    """Conversation count per scenario"""
+    return jsonify({'scenarios': conversation_index.scenarios()})
+
+@conversations_controller.route('/conversations/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id):
+    """One conversation by document id or contact_id, messages included unless ?fields= says otherwise"""
+    conversation = conversation_index.get(conversation_id, _fields_arg())
+    if conversation is None:
+        return jsonify({'error': 'conversation not found'}), 404
+    return jsonify(conversation)
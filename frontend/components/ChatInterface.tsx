@@ -2,7 +2,11 @@
 
 import { useState, useRef, useEffect } from 'react';
 import { Send, Bot, User, RefreshCw, ThumbsUp, ThumbsDown, Copy, Check } from 'lucide-react';
-import { aiAssistantApi, ChatMessage } from '@/lib/api';
+import { isAxiosError } from 'axios';
+import { aiAssistantApi, ChatMessage, newIdempotencyKey } from '@/lib/api';
+
+const SPECULATIVE_DRAFTS = process.env.NEXT_PUBLIC_SPECULATIVE_DRAFTS === 'true';
+const DRAFT_DEBOUNCE_MS = 600;
 
 export default function ChatInterface() {
   const [messages, setMessages] = useState<ChatMessage[]>([]);
@@ -12,6 +16,15 @@ export default function ChatInterface() {
   const [copiedMessageId, setCopiedMessageId] = useState<number | null>(null);
   const [feedback, setFeedback] = useState<{ [key: number]: 'up' | 'down' | null }>({});
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  // Server-side session: only the new message is sent, the server keeps the history
+  const sessionIdRef = useRef<string>(
+    typeof crypto !== 'undefined' && 'randomUUID' in crypto
+      ? crypto.randomUUID()
+      : `session-${Date.now()}-${Math.random().toString(36).slice(2)}`
+  );
+  const lastSeenTurnRef = useRef<number | undefined>(undefined);
+  // Messages can be sent while a reply is pending; the server answers a quick series with one reply
+  const pendingRef = useRef(0);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -21,8 +34,18 @@ export default function ChatInterface() {
     scrollToBottom();
   }, [messages]);
 
+  // Speculative mode: once typing pauses, let the server pre-generate a reply to the draft
+  useEffect(() => {
+    const text = input.trim();
+    if (!SPECULATIVE_DRAFTS || !text) return;
+    const timer = setTimeout(() => {
+      aiAssistantApi.draft({ sessionId: sessionIdRef.current, text }).catch(() => undefined);
+    }, DRAFT_DEBOUNCE_MS);
+    return () => clearTimeout(timer);
+  }, [input]);
+
   const handleSend = async () => {
-    if (!input.trim() || isLoading) return;
+    if (!input.trim()) return;
 
     const userMessage: ChatMessage = {
       role: 'client',
@@ -31,14 +54,29 @@ export default function ChatInterface() {
 
     setMessages(prev => [...prev, userMessage]);
     setInput('');
+    pendingRef.current += 1;
     setIsLoading(true);
     setError(null);
 
     try {
-      const response = await aiAssistantApi.generateReply({
+      const request = {
         clientSequence: userMessage.message,
-        chatHistory: messages.filter(m => m !== userMessage),
-      });
+        sessionId: sessionIdRef.current,
+        lastSeenTurn: lastSeenTurnRef.current,
+      };
+      let response;
+      try {
+        response = await aiAssistantApi.generateSessionReply(request, newIdempotencyKey());
+      } catch (sendError) {
+        // The server lost the session (expired or restarted): resend with the conversation so far
+        if (!isAxiosError(sendError) || sendError.response?.status !== 409 || !sendError.response.data?.sessionReset) {
+          throw sendError;
+        }
+        response = await aiAssistantApi.generateSessionReply({ ...request, chatHistory: messages }, newIdempotencyKey());
+      }
+      // A newer message took this one over; its request brings the reply
+      if (response.superseded || response.aiReply === null) return;
+      lastSeenTurnRef.current = response.turnIndex;
 
       const aiMessage: ChatMessage = {
         role: 'consultant',
@@ -57,7 +95,8 @@ export default function ChatInterface() {
       };
       setMessages(prev => [...prev, errorBotMessage]);
     } finally {
-      setIsLoading(false);
+      pendingRef.current -= 1;
+      setIsLoading(pendingRef.current > 0);
     }
   };
 
@@ -252,13 +291,12 @@ export default function ChatInterface() {
             onKeyPress={handleKeyPress}
             placeholder="Type your message... (Press Enter to send, Shift+Enter for new line)"
             className="flex-1 px-4 py-2 border border-gray-300 rounded-lg focus:outline-none focus:ring-2 focus:ring-blue-500 focus:border-transparent resize-none text-gray-900 placeholder-gray-500"
-            disabled={isLoading}
             rows={1}
             style={{ minHeight: '40px', maxHeight: '120px' }}
           />
           <button
             onClick={handleSend}
-            disabled={isLoading || !input.trim()}
+            disabled={!input.trim()}
             className="px-4 py-2 bg-blue-600 text-white rounded-lg hover:bg-blue-700 disabled:opacity-50 disabled:cursor-not-allowed transition-colors flex items-center gap-2 self-end"
           >
             <Send size={18} />
@@ -1,6 +1,7 @@
 import axios from 'axios';
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:5000';
+const TENANT_ID = process.env.NEXT_PUBLIC_TENANT_ID;
 
 export interface ChatMessage {
   role: 'client' | 'consultant';
@@ -16,6 +17,41 @@ export interface GenerateReplyResponse {
   aiReply: string;
 }
 
+export interface SessionTurn extends ChatMessage {
+  turn: number;
+  timestamp: string;
+}
+
+// Session mode: the server keeps the chat history, so only the new message is sent
+export interface SessionReplyRequest {
+  clientSequence: string;
+  sessionId: string;
+  lastSeenTurn?: number;
+  // Only sent after a 409 with sessionReset: seeds the server's session with the conversation so far
+  chatHistory?: ChatMessage[];
+}
+
+export interface SessionReplyResponse {
+  // null when a newer message superseded this one; the newer request carries the reply
+  aiReply: string | null;
+  sessionId: string;
+  turnIndex: number;
+  turns: SessionTurn[];
+  sessionReset: boolean;
+  superseded?: boolean;
+  mergedMessages?: number;
+}
+
+export interface DraftRequest {
+  sessionId: string;
+  text: string;
+}
+
+export interface DraftResponse {
+  status: 'started' | 'unchanged' | 'skipped' | 'disabled';
+  reason?: string;
+}
+
 export interface ImproveAIRequest {
   clientSequence: string;
   chatHistory: ChatMessage[];
@@ -23,8 +59,40 @@ export interface ImproveAIRequest {
 }
 
 export interface ImproveAIResponse {
-  predictedReply: string;
-  updatedPrompt: string;
+  jobId: string;
+  status: ImproveJobStatus;
+  statusUrl: string;
+  duplicateOf: DuplicateFeedback | null;
+}
+
+export type ImproveJobStatus =
+  | 'queued' | 'predicting' | 'batched' | 'editing' | 'completed' | 'failed'
+  // Near-duplicate feedback: skipped when already applied, merged while the job it repeats runs
+  | 'skipped' | 'merged';
+
+// Statuses a job never leaves; 'merged' ends with the outcome of the job it follows
+export const FINISHED_JOB_STATUSES: ImproveJobStatus[] = ['completed', 'failed', 'skipped'];
+
+export interface DuplicateFeedback {
+  kind: 'applied' | 'pending';
+  jobId: string;
+  similarity: number;
+  promptVersion?: number;
+}
+
+export interface ImproveJob {
+  jobId: string;
+  status: ImproveJobStatus;
+  predictedReply: string | null;
+  updatedPrompt: string | null;
+  promptVersion: number | null;
+  batchSize: number | null;
+  // Set when shadow evaluation staged the edit as a candidate instead of committing it
+  candidateId: string | null;
+  duplicateOf: DuplicateFeedback | null;
+  error: string | null;
+  createdAt: number;
+  updatedAt: number;
 }
 
 export interface ImproveAIManuallyRequest {
@@ -33,6 +101,9 @@ export interface ImproveAIManuallyRequest {
 
 export interface ImproveAIManuallyResponse {
   updatedPrompt: string;
+  // With shadow evaluation on, the edit is staged as a candidate instead of committed
+  candidateId?: string;
+  status?: string;
 }
 
 export interface GetPromptResponse {
@@ -52,22 +123,71 @@ const api = axios.create({
   baseURL: API_BASE_URL,
   headers: {
     'Content-Type': 'application/json',
+    // Tenant whose prompts and sessions this frontend uses (the API default when unset)
+    ...(TENANT_ID ? { 'X-Tenant-ID': TENANT_ID } : {}),
   },
 });
 
+const randomHex = (bytes: number): string => {
+  const values = new Uint8Array(bytes);
+  if (typeof crypto !== 'undefined' && 'getRandomValues' in crypto) {
+    crypto.getRandomValues(values);
+  } else {
+    values.forEach((_, i) => { values[i] = Math.floor(Math.random() * 256); });
+  }
+  return Array.from(values, (b) => b.toString(16).padStart(2, '0')).join('');
+};
+
+// W3C trace context: every call starts a trace the API continues; the server decides what to keep
+api.interceptors.request.use((config) => {
+  config.headers.set('traceparent', `00-${randomHex(16)}-${randomHex(8)}-00`);
+  return config;
+});
+
+// One key per user action; resending with the same key returns the original result
+export const newIdempotencyKey = (): string =>
+  typeof crypto !== 'undefined' && 'randomUUID' in crypto
+    ? crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+const idempotencyHeaders = (idempotencyKey?: string) =>
+  idempotencyKey ? { headers: { 'Idempotency-Key': idempotencyKey } } : undefined;
+
 export const aiAssistantApi = {
-  generateReply: async (data: GenerateReplyRequest): Promise<GenerateReplyResponse> => {
-    const response = await api.post('/generate-reply', data);
+  generateReply: async (data: GenerateReplyRequest, idempotencyKey?: string): Promise<GenerateReplyResponse> => {
+    const response = await api.post('/generate-reply', data, idempotencyHeaders(idempotencyKey));
+    return response.data;
+  },
+
+  generateSessionReply: async (data: SessionReplyRequest, idempotencyKey?: string): Promise<SessionReplyResponse> => {
+    const response = await api.post('/generate-reply', data, idempotencyHeaders(idempotencyKey));
+    return response.data;
+  },
+
+  draft: async (data: DraftRequest): Promise<DraftResponse> => {
+    const response = await api.post('/draft', data);
+    return response.data;
+  },
+
+  getSessionTurns: async (sessionId: string, since?: number): Promise<{ sessionId: string; turns: SessionTurn[] }> => {
+    const response = await api.get(`/sessions/${encodeURIComponent(sessionId)}/turns`, {
+      params: since === undefined ? {} : { since },
+    });
+    return response.data;
+  },
+
+  improveAI: async (data: ImproveAIRequest, idempotencyKey?: string): Promise<ImproveAIResponse> => {
+    const response = await api.post('/improve-ai', data, idempotencyHeaders(idempotencyKey));
     return response.data;
   },
 
-  improveAI: async (data: ImproveAIRequest): Promise<ImproveAIResponse> => {
-    const response = await api.post('/improve-ai', data);
+  getJob: async (jobId: string): Promise<ImproveJob> => {
+    const response = await api.get(`/jobs/${jobId}`);
     return response.data;
   },
 
-  improveAIManually: async (data: ImproveAIManuallyRequest): Promise<ImproveAIManuallyResponse> => {
-    const response = await api.post('/improve-ai-manually', data);
+  improveAIManually: async (data: ImproveAIManuallyRequest, idempotencyKey?: string): Promise<ImproveAIManuallyResponse> => {
+    const response = await api.post('/improve-ai-manually', data, idempotencyHeaders(idempotencyKey));
     return response.data;
   },
 
@@ -0,0 +1,232 @@
+"""Columnar message table and vectorized conversation statistics.
+
+The export flattens every message of the corpus into a NumPy structured
+array (one row per message) with contact and scenario dictionary-encoded as
+integer codes; message text goes to a separate UTF-8 blob addressed by
+offset/length columns. Stats then run as array operations over the table.
+
+    python -m services.conversation_analytics export data/conversations.json analytics/
+    python -m services.conversation_analytics stats analytics/
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Any, Dict
+
+import numpy as np
+
+from services.conversation_corpus import iter_conversations
+
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+MESSAGE_DTYPE = np.dtype([
+    ('contact', np.int32),
+    ('scenario', np.int32),
+    ('turn', np.int32),
+    ('message_id', np.int64),
+    ('direction', np.int8),
+    ('timestamp', np.int64),
+    ('text_offset', np.int64),
+    ('text_length', np.int32),
+])
+
+TABLE_FILE = 'messages.npy'
+TEXT_FILE = 'texts.bin'
+DICTIONARY_FILE = 'dictionaries.json'
+
+# Rows buffered before being flushed to a chunk array
+CHUNK_ROWS = 65536
+
+
+def export_message_table(corpus_path: str, out_dir: str) -> int:
+    """Flatten a conversation corpus into the columnar table; returns the message count"""
+    os.makedirs(out_dir, exist_ok=True)
+    contacts, scenarios = [], []
+    scenario_codes = {}
+    chunks, rows = [], []
+    text_offset = 0
+
+    with open(os.path.join(out_dir, TEXT_FILE), 'wb') as texts:
+        for conversation in iter_conversations(corpus_path):
+            contact_code = len(contacts)
+            contacts.append(str(conversation.get('contact_id', contact_code)))
+            scenario = conversation.get('scenario', 'Unknown scenario')
+            scenario_code = scenario_codes.setdefault(scenario, len(scenario_codes))
+            if scenario_code == len(scenarios):
+                scenarios.append(scenario)
+
+            for turn, message in enumerate(conversation.get('conversation', [])):
+                text = (message.get('text') or '').encode('utf-8')
+                texts.write(text)
+                rows.append((
+                    contact_code,
+                    scenario_code,
+                    turn,
+                    message.get('message_id', turn),
+                    DIRECTION_OUT if message.get('direction') == 'out' else DIRECTION_IN,
+                    message.get('timestamp', 0),
+                    text_offset,
+                    len(text),
+                ))
+                text_offset += len(text)
+                if len(rows) >= CHUNK_ROWS:
+                    chunks.append(np.array(rows, dtype=MESSAGE_DTYPE))
+                    rows = []
+
+    if rows or not chunks:
+        chunks.append(np.array(rows, dtype=MESSAGE_DTYPE))
+    table = np.concatenate(chunks)
+    np.save(os.path.join(out_dir, TABLE_FILE), table)
+    with open(os.path.join(out_dir, DICTIONARY_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'contacts': contacts, 'scenarios': scenarios}, f, ensure_ascii=False)
+    return len(table)
+
+
+class MessageTable:
+    """Memory-mapped message table with its dictionaries"""
+
+    def __init__(self, table_dir: str):
+        self.table_dir = table_dir
+        self.rows = np.load(os.path.join(table_dir, TABLE_FILE), mmap_mode='r')
+        with open(os.path.join(table_dir, DICTIONARY_FILE), 'r', encoding='utf-8') as f:
+            dictionaries = json.load(f)
+        self.contacts = dictionaries['contacts']
+        self.scenarios = dictionaries['scenarios']
+
+    def __len__(self):
+        return len(self.rows)
+
+    def text(self, row_index: int) -> str:
+        row = self.rows[row_index]
+        with open(os.path.join(self.table_dir, TEXT_FILE), 'rb') as f:
+            f.seek(int(row['text_offset']))
+            return f.read(int(row['text_length'])).decode('utf-8')
+
+
+def _summary(values: np.ndarray) -> Dict[str, Any]:
+    if len(values) == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        'count': int(len(values)),
+        'mean': float(values.mean()),
+        'p50': float(p50),
+        'p90': float(p90),
+        'p99': float(p99),
+        'max': float(values.max()),
+    }
+
+
+def _ordered(rows: np.ndarray) -> np.ndarray:
+    # Exports are already in conversation/time order; only sort merged or edited tables
+    contact_step = np.diff(rows['contact'])
+    time_step = np.diff(rows['timestamp'])
+    if np.all((contact_step > 0) | ((contact_step == 0) & (time_step >= 0))):
+        return rows
+    order = np.lexsort((rows['timestamp'], rows['contact']))
+    return rows[order]
+
+
+def response_times(rows: np.ndarray):
+    """Consultant response times in ms, measured from the first unanswered client message.
+
+    Returns (response_ms, scenario_code) arrays with one entry per consultant
+    message that answers a client run.
+    """
+    rows = _ordered(rows)
+    n = len(rows)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+    index = np.arange(n)
+    new_conversation = np.ones(n, dtype=bool)
+    new_conversation[1:] = rows['contact'][1:] != rows['contact'][:-1]
+    prev_direction = np.empty(n, dtype=np.int8)
+    prev_direction[0] = DIRECTION_OUT
+    prev_direction[1:] = rows['direction'][:-1]
+
+    is_in = rows['direction'] == DIRECTION_IN
+    run_start = is_in & (new_conversation | (prev_direction == DIRECTION_OUT))
+    # Index of the latest client-run start at or before each row
+    last_run_start = np.maximum.accumulate(np.where(run_start, index, -1))
+    # Start of the current conversation, to ignore runs from the previous one
+    conversation_start = np.maximum.accumulate(np.where(new_conversation, index, 0))
+
+    answers = (
+        (rows['direction'] == DIRECTION_OUT)
+        & ~new_conversation
+        & (prev_direction == DIRECTION_IN)
+        & (last_run_start >= conversation_start)
+    )
+    starts = last_run_start[answers]
+    response_ms = rows['timestamp'][answers] - rows['timestamp'][starts]
+    return response_ms, rows['scenario'][answers]
+
+
+def turns_per_conversation(rows: np.ndarray, contact_count: int) -> np.ndarray:
+    return np.bincount(rows['contact'], minlength=contact_count)
+
+
+def compute_stats(table: MessageTable) -> Dict[str, Any]:
+    """Response-time distribution, turns per scenario and message lengths"""
+    rows = np.asarray(table.rows)
+    scenario_count = len(table.scenarios)
+
+    response_ms, response_scenarios = response_times(rows)
+    by_scenario_response = {}
+    for code in np.unique(response_scenarios):
+        by_scenario_response[table.scenarios[code]] = _summary(response_ms[response_scenarios == code] / 1000.0)
+
+    turns = turns_per_conversation(rows, len(table.contacts))
+    conversation_scenario = np.zeros(len(table.contacts), dtype=np.int64)
+    conversation_scenario[rows['contact']] = rows['scenario']
+    conversations_per_scenario = np.bincount(conversation_scenario, minlength=scenario_count)
+    turns_per_scenario = np.bincount(conversation_scenario, weights=turns, minlength=scenario_count)
+
+    lengths = rows['text_length']
+    directions = rows['direction']
+
+    return {
+        'messages': int(len(rows)),
+        'conversations': len(table.contacts),
+        'responseTimeSeconds': {
+            'overall': _summary(response_ms / 1000.0),
+            'byScenario': by_scenario_response,
+        },
+        'turnsPerConversation': _summary(turns.astype(np.float64)),
+        'turnsPerScenario': {
+            table.scenarios[code]: {
+                'conversations': int(conversations_per_scenario[code]),
+                'totalTurns': int(turns_per_scenario[code]),
+                'meanTurns': float(turns_per_scenario[code] / conversations_per_scenario[code])
+            }
+            for code in range(scenario_count) if conversations_per_scenario[code]
+        },
+        'messageLengthBytes': {
+            'client': _summary(lengths[directions == DIRECTION_IN].astype(np.float64)),
+            'consultant': _summary(lengths[directions == DIRECTION_OUT].astype(np.float64)),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversation analytics")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='flatten a corpus into the columnar message table')
+    export.add_argument('corpus')
+    export.add_argument('out_dir')
+    stats = commands.add_parser('stats', help='print aggregate statistics for an exported table')
+    stats.add_argument('table_dir')
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        print(f"Exported {export_message_table(args.corpus, args.out_dir)} messages to {args.out_dir}")
+    else:
+        print(json.dumps(compute_stats(MessageTable(args.table_dir)), indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
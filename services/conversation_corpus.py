@@ -0,0 +1,237 @@
+"""Conversation corpus access in constant memory.
+
+Supports the original JSON array export and an NDJSON format (one
+conversation per line). NDJSON files can get a sidecar offset index
+(``<file>.idx``): an open-addressing hash table of contact_id -> byte offset,
+read through mmap so a lookup touches a couple of pages regardless of file
+size.
+
+    python -m services.conversation_corpus convert data/conversations.json data/conversations.ndjson
+    python -m services.conversation_corpus index data/conversations.ndjson
+    python -m services.conversation_corpus get data/conversations.ndjson SYNTH_001
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+FORMAT_ARRAY = 'array'
+FORMAT_NDJSON = 'ndjson'
+
+READ_CHUNK_SIZE = 1 << 16
+
+INDEX_MAGIC = b'CVIX'
+INDEX_VERSION = 1
+# magic, version, slot count, record count
+INDEX_HEADER = struct.Struct('<4sIQQ')
+# key hash, byte offset
+INDEX_SLOT = struct.Struct('<QQ')
+
+
+def detect_format(path: str) -> str:
+    """Return FORMAT_ARRAY or FORMAT_NDJSON from the first non-whitespace byte"""
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024)
+            if not chunk:
+                raise ValueError(f"Empty conversation file: {path}")
+            stripped = chunk.lstrip()
+            if stripped:
+                return FORMAT_ARRAY if stripped[:1] == b'[' else FORMAT_NDJSON
+
+
+def iter_conversations(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield conversations one at a time without loading the whole file"""
+    if detect_format(path) == FORMAT_ARRAY:
+        yield from _iter_json_array(path)
+    else:
+        for _, conversation in iter_ndjson_with_offsets(path):
+            yield conversation
+
+
+def iter_ndjson_with_offsets(path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Yield (byte offset, conversation) for each line of an NDJSON file"""
+    with open(path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                yield offset, json.loads(line)
+            offset += len(line)
+
+
+def _iter_json_array(path: str) -> Iterator[Dict[str, Any]]:
+    """Incrementally decode the elements of a top-level JSON array"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(READ_CHUNK_SIZE).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"Expected a JSON array in {path}")
+        buffer = buffer[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The next element straddles the chunk boundary; read more
+                if eof:
+                    raise
+                chunk = f.read(READ_CHUNK_SIZE)
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield item
+            buffer = buffer[end:]
+            if not buffer and not eof:
+                chunk = f.read(READ_CHUNK_SIZE)
+                eof = not chunk
+                buffer = chunk
+
+
+def convert_to_ndjson(source_path: str, target_path: str, build_index: bool = True) -> int:
+    """Stream any supported export into NDJSON (written atomically); returns the conversation count"""
+    directory = os.path.dirname(os.path.abspath(target_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.conversations-')
+    count = 0
+    with os.fdopen(fd, 'w', encoding='utf-8') as out:
+        for conversation in iter_conversations(source_path):
+            out.write(json.dumps(conversation, ensure_ascii=False, separators=(',', ':')))
+            out.write('\n')
+            count += 1
+    os.replace(tmp_path, target_path)
+    if build_index:
+        build_offset_index(target_path)
+    return count
+
+
+def index_path_for(path: str) -> str:
+    return path + '.idx'
+
+
+def _key_hash(contact_id: str) -> int:
+    value = int.from_bytes(hashlib.blake2b(contact_id.encode('utf-8'), digest_size=8).digest(), 'little')
+    # 0 marks an empty slot
+    return value or 1
+
+
+def build_offset_index(ndjson_path: str, index_path: Optional[str] = None) -> int:
+    """Write the contact_id -> offset sidecar index for an NDJSON file; returns the record count"""
+    index_path = index_path or index_path_for(ndjson_path)
+    entries = [(_key_hash(str(conv.get('contact_id'))), offset)
+               for offset, conv in iter_ndjson_with_offsets(ndjson_path) if conv.get('contact_id') is not None]
+
+    # Power-of-two table at <= 50% load keeps probe chains short
+    slot_count = 1
+    while slot_count < max(2, len(entries) * 2):
+        slot_count <<= 1
+    table = bytearray(slot_count * INDEX_SLOT.size)
+    mask = slot_count - 1
+    for key_hash, offset in entries:
+        slot = key_hash & mask
+        while INDEX_SLOT.unpack_from(table, slot * INDEX_SLOT.size)[0]:
+            slot = (slot + 1) & mask
+        INDEX_SLOT.pack_into(table, slot * INDEX_SLOT.size, key_hash, offset)
+
+    directory = os.path.dirname(os.path.abspath(index_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.conversations-idx-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, slot_count, len(entries)))
+        f.write(table)
+    os.replace(tmp_path, index_path)
+    return len(entries)
+
+
+class ConversationIndex:
+    """O(1) random access to an indexed NDJSON corpus through mmap"""
+
+    def __init__(self, ndjson_path: str, index_path: Optional[str] = None):
+        self.path = ndjson_path
+        self.index_path = index_path or index_path_for(ndjson_path)
+        self._data_file = open(ndjson_path, 'rb')
+        self._index_file = open(self.index_path, 'rb')
+        self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slot_count, self.record_count = INDEX_HEADER.unpack_from(self._index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise ValueError(f"Not a conversation index: {self.index_path}")
+
+    def __len__(self):
+        return self.record_count
+
+    def offset_of(self, contact_id: str) -> Optional[int]:
+        key_hash = _key_hash(contact_id)
+        mask = self.slot_count - 1
+        slot = key_hash & mask
+        for _ in range(self.slot_count):
+            stored_hash, offset = INDEX_SLOT.unpack_from(self._index, INDEX_HEADER.size + slot * INDEX_SLOT.size)
+            if stored_hash == 0:
+                return None
+            # Hashes can collide; confirm against the record itself
+            if stored_hash == key_hash and str(self._read_at(offset).get('contact_id')) == contact_id:
+                return offset
+            slot = (slot + 1) & mask
+        return None
+
+    def get(self, contact_id: str) -> Optional[Dict[str, Any]]:
+        offset = self.offset_of(contact_id)
+        return None if offset is None else self._read_at(offset)
+
+    def _read_at(self, offset: int) -> Dict[str, Any]:
+        end = self._data.find(b'\n', offset)
+        return json.loads(self._data[offset:end if end != -1 else len(self._data)])
+
+    def close(self):
+        self._index.close()
+        self._data.close()
+        self._index_file.close()
+        self._data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversation corpus tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help='stream a JSON array export into NDJSON and index it')
+    convert.add_argument('source')
+    convert.add_argument('target')
+    convert.add_argument('--no-index', action='store_true')
+    index = commands.add_parser('index', help='build the offset index for an NDJSON file')
+    index.add_argument('path')
+    get = commands.add_parser('get', help='print one conversation by contact_id')
+    get.add_argument('path')
+    get.add_argument('contact_id')
+    count = commands.add_parser('count', help='count conversations by streaming the file')
+    count.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        print(f"Wrote {convert_to_ndjson(args.source, args.target, not args.no_index)} conversations to {args.target}")
+    elif args.command == 'index':
+        print(f"Indexed {build_offset_index(args.path)} conversations in {index_path_for(args.path)}")
+    elif args.command == 'get':
+        with ConversationIndex(args.path) as corpus:
+            conversation = corpus.get(args.contact_id)
+        if conversation is None:
+            print(f"No conversation for {args.contact_id}", file=sys.stderr)
+            return 1
+        print(json.dumps(conversation, ensure_ascii=False, indent=2))
+    elif args.command == 'count':
+        print(sum(1 for _ in iter_conversations(args.path)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
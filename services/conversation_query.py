@@ -0,0 +1,223 @@
+"""In-memory secondary index over the `conversations` collection.
+
+The index is filled and kept current by a Firestore on_snapshot listener
+(the first snapshot delivers every document as ADDED), so queries never scan
+Firestore. Without Firestore it is loaded once from the local corpus file.
+
+Documents are ordered by (conversation_index, document id). Secondary
+indexes keep that order per scenario and per processed flag, and contact_id
+maps to a single document; a query walks the smallest matching index from
+the cursor position and stops after `limit` hits. Cursors encode the last
+sort key returned, so pages stay stable while documents are added or removed.
+"""
+import base64
+import bisect
+import datetime
+import json
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from services.conversation_corpus import iter_conversations
+from services.scenario_classifier import default_corpus_path, scenario_key
+from utils.logger import logger
+from utils.memory import deep_sizeof, register_memory_source
+
+# Fields returned by listings unless ?fields= asks for others
+SUMMARY_FIELDS = ('contact_id', 'scenario', 'message_count', 'processed', 'created_at', 'conversation_index')
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class ConversationQueryIndex:
+    def __init__(self):
+        self._docs = {}
+        self._sort_keys = {}
+        self._ordered = []
+        self._by_scenario = {}
+        self._by_processed = {True: [], False: []}
+        self._by_contact = {}
+        self._lock = threading.RLock()
+        self._watch = None
+        self.source = None
+        self.ready = threading.Event()
+        register_memory_source('conversation_index', self._size_bytes, priority=90)
+
+    def start(self):
+        """Attach the Firestore listener, or load the local corpus when Firestore is not configured"""
+        if self.source is not None:
+            return
+        from services import database_service
+
+        if database_service.db:
+            self.source = 'firestore'
+            collection = database_service.db.collection('conversations')
+            self._watch = collection.on_snapshot(self._on_snapshot)
+            logger.info("Conversation index listening for changes")
+        else:
+            self.source = 'corpus'
+            threading.Thread(target=self._load_corpus, name='conversation-index-load', daemon=True).start()
+
+    def _on_snapshot(self, _snapshot, changes, _read_time):
+        with self._lock:
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self._remove(change.document.id)
+                else:
+                    self._upsert(change.document.id, change.document.to_dict())
+        self.ready.set()
+
+    def _load_corpus(self):
+        path = default_corpus_path()
+        try:
+            for idx, conversation in enumerate(iter_conversations(path)):
+                messages = conversation.get('conversation', [])
+                with self._lock:
+                    self._upsert(f"conv_{conversation.get('contact_id', idx)}", {
+                        'contact_id': conversation.get('contact_id', f'unknown_{idx}'),
+                        'scenario': conversation.get('scenario', 'Unknown scenario'),
+                        'messages': messages,
+                        'message_count': len(messages),
+                        'processed': False,
+                        'conversation_index': idx
+                    })
+            logger.info(f"Conversation index loaded {len(self._docs)} conversations from {path}")
+        except Exception as e:
+            logger.error(f"Failed to load conversations for the index: {str(e)}")
+        self.ready.set()
+
+    def _upsert(self, doc_id: str, data: Dict[str, Any]):
+        if doc_id in self._docs:
+            self._remove(doc_id)
+        key = (data.get('conversation_index') or 0, doc_id)
+        self._docs[doc_id] = data
+        self._sort_keys[doc_id] = key
+        bisect.insort(self._ordered, key)
+        bisect.insort(self._by_scenario.setdefault(scenario_key(str(data.get('scenario', ''))), []), key)
+        bisect.insort(self._by_processed[bool(data.get('processed'))], key)
+        if data.get('contact_id') is not None:
+            self._by_contact[str(data['contact_id'])] = doc_id
+
+    def _remove(self, doc_id: str):
+        data = self._docs.pop(doc_id, None)
+        if data is None:
+            return
+        key = self._sort_keys.pop(doc_id)
+        _discard(self._ordered, key)
+        scenario = scenario_key(str(data.get('scenario', '')))
+        _discard(self._by_scenario.get(scenario, []), key)
+        if not self._by_scenario.get(scenario):
+            self._by_scenario.pop(scenario, None)
+        _discard(self._by_processed[bool(data.get('processed'))], key)
+        if self._by_contact.get(str(data.get('contact_id'))) == doc_id:
+            del self._by_contact[str(data.get('contact_id'))]
+
+    def query(self, scenario: Optional[str] = None, processed: Optional[bool] = None,
+              contact_id: Optional[str] = None, limit: int = 50, cursor: Optional[str] = None,
+              fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """One page of conversations matching every given filter, in index order"""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        after = decode_cursor(cursor) if cursor else None
+        scenario = scenario_key(scenario) if scenario else None
+        fields = list(fields) if fields is not None else list(SUMMARY_FIELDS)
+
+        with self._lock:
+            if contact_id is not None:
+                doc_id = self._by_contact.get(str(contact_id))
+                candidates = [self._sort_keys[doc_id]] if doc_id else []
+            else:
+                # Walk the most selective ordered index; the others become checks
+                indexes = [self._ordered]
+                if scenario is not None:
+                    indexes.append(self._by_scenario.get(scenario, []))
+                if processed is not None:
+                    indexes.append(self._by_processed[processed])
+                candidates = min(indexes, key=len)
+
+            position = bisect.bisect_right(candidates, after) if after else 0
+            page, last_key, has_more = [], None, False
+            while position < len(candidates):
+                key = candidates[position]
+                position += 1
+                data = self._docs[key[1]]
+                if scenario is not None and scenario_key(str(data.get('scenario', ''))) != scenario:
+                    continue
+                if processed is not None and bool(data.get('processed')) != processed:
+                    continue
+                if len(page) == limit:
+                    has_more = True
+                    break
+                page.append(project(key[1], data, fields))
+                last_key = key
+
+        return {
+            'conversations': page,
+            'count': len(page),
+            'nextCursor': encode_cursor(last_key) if has_more else None
+        }
+
+    def get(self, doc_id: str, fields: Optional[Iterable[str]] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            data = self._docs.get(doc_id)
+            if data is None and doc_id in self._by_contact:
+                doc_id = self._by_contact[doc_id]
+                data = self._docs.get(doc_id)
+            if data is None:
+                return None
+            return project(doc_id, data, list(fields) if fields is not None else None)
+
+    def scenarios(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {}
+            for data in self._docs.values():
+                scenario = data.get('scenario', 'Unknown scenario')
+                counts[scenario] = counts.get(scenario, 0) + 1
+            return counts
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'source': self.source,
+                'ready': self.ready.is_set(),
+                'conversations': len(self._docs),
+                'scenarios': len(self._by_scenario),
+                'processed': len(self._by_processed[True])
+            }
+
+    def _size_bytes(self):
+        with self._lock:
+            return deep_sizeof(self._docs) + deep_sizeof(self._ordered) * 3
+
+
+def project(doc_id: str, data: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """Copy of a document limited to `fields` (all fields when None), with its id"""
+    result = {'id': doc_id}
+    for field in (fields if fields is not None else data.keys()):
+        if field in data:
+            value = data[field]
+            result[field] = value.isoformat() if isinstance(value, datetime.datetime) else value
+    return result
+
+
+def encode_cursor(sort_key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(sort_key)).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        conversation_index, doc_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return conversation_index, str(doc_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def _discard(ordered: List, key):
+    position = bisect.bisect_left(ordered, key)
+    if position < len(ordered) and ordered[position] == key:
+        del ordered[position]
+
+
+conversation_index = ConversationQueryIndex()
@@ -2,11 +2,30 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 from config import Config
 from utils.logger import logger
-import json
+from services.conversation_corpus import iter_conversations
+from services.prompt_store import encode_blob, new_entry, prompt_store_for
+from utils.deadline import ClientDisconnected, DeadlineExceeded, Superseded, call_with_deadline, current_deadline, downstream_timeout
+from utils.tenancy import current_tenant, is_default_tenant
+from utils.tracing import set_span_attributes, start_span
+import hashlib
 import os
+import threading
+import time
 
 db = None
 
+# Scenario prompt variants: {(tenant, scenario): (prompt or None, fetched_at)}
+_variant_cache = {}
+_variant_cache_lock = threading.Lock()
+
+class PromptVersionConflict(Exception):
+    """Raised when the stored prompt changed since the caller read it"""
+
+    def __init__(self, expected_version, actual_version):
+        super().__init__(f"Prompt version conflict: expected {expected_version}, found {actual_version}")
+        self.expected_version = expected_version
+        self.actual_version = actual_version
+
 def init_database():
     global db
     try:
@@ -65,20 +84,15 @@ def upload_conversation_to_firestore():
         
         logger.info("Conversations collection not found. Starting upload...")
         
-        # Load conversations.json
-        conversations_path = os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'conversations.json')
+        # Stream conversations (JSON array or NDJSON) instead of loading the whole export
+        conversations_path = Config.CONVERSATIONS_PATH or os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'conversations.json')
         
         if not os.path.exists(conversations_path):
             logger.error(f"Conversations file not found at: {conversations_path}")
             return
         
-        with open(conversations_path, 'r', encoding='utf-8') as f:
-            conversations = json.load(f)
-        
-        logger.info(f"Loaded {len(conversations)} conversations from JSON file")
-        
-        # Upload each conversation as a document
-        for idx, conversation in enumerate(conversations):
+        uploaded = 0
+        for idx, conversation in enumerate(iter_conversations(conversations_path)):
             # Prepare conversation data with metadata
             conversation_data = {
                 'contact_id': conversation.get('contact_id', f'unknown_{idx}'),
@@ -94,52 +108,235 @@ def upload_conversation_to_firestore():
             doc_id = f"conv_{conversation.get('contact_id', idx)}"
             doc_ref = conversations_ref.document(doc_id)
             doc_ref.set(conversation_data)
+            uploaded += 1
             
-            logger.info(f"Uploaded conversation {idx + 1}/{len(conversations)}: {doc_id}")
+            logger.info(f"Uploaded conversation {uploaded}: {doc_id}")
         
-        logger.info(f"✅ Successfully uploaded {len(conversations)} conversations to Firestore")
+        logger.info(f"✅ Successfully uploaded {uploaded} conversations to Firestore")
         
     except Exception as e:
         logger.error(f"Failed to upload conversations to Firestore: {str(e)}")
         raise
 
-def get_prompt():
-    """Get the current AI prompt from database"""
+def prompt_hash(prompt):
+    """Short content hash identifying a prompt text"""
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+def get_prompt(scenario=None):
+    """Get the current AI prompt from database, preferring the scenario variant if one exists"""
+    with start_span('database.get_prompt', {'scenario': scenario}):
+        if scenario:
+            variant = get_scenario_prompt(scenario)
+            if variant:
+                set_span_attributes({'prompt.source': 'variant', 'prompt.hash': prompt_hash(variant)})
+                return variant
+        prompt, version = get_prompt_with_version()
+        set_span_attributes({'prompt.source': 'main', 'prompt.version': version, 'prompt.hash': prompt_hash(prompt)})
+        return prompt
+
+def prompt_ref(tenant=None):
+    """Head document of the tenant's prompt; the default tenant keeps ai_config/chat_prompt"""
+    tenant = tenant or current_tenant()
+    root = db if is_default_tenant(tenant) else db.collection('tenants').document(tenant)
+    return root.collection('ai_config').document('chat_prompt')
+
+def _variant_ref(scenario):
+    return prompt_ref().collection('variants').document(scenario)
+
+def get_scenario_prompt(scenario):
+    """Get the prompt variant for a scenario (None if there is none), cached per scenario"""
+    now = time.monotonic()
+    cache_key = (current_tenant(), scenario)
+    with _variant_cache_lock:
+        cached = _variant_cache.get(cache_key)
+    if cached and now - cached[1] < Config.PROMPT_VARIANT_CACHE_SECONDS:
+        set_span_attributes({'prompt.variant_cache': 'hit'})
+        return cached[0]
+    set_span_attributes({'prompt.variant_cache': 'miss'})
+    
     try:
         global db
         if not db:
             init_database()
         
-        prompt_ref = db.collection('ai_config').document('chat_prompt')
-        doc = prompt_ref.get()
+        doc = call_with_deadline('get_prompt', _variant_ref(scenario).get, timeout=downstream_timeout('get_prompt'))
+        variant = doc.to_dict().get('prompt') if doc.exists else None
+    except (DeadlineExceeded, ClientDisconnected, Superseded):
+        raise
+    except Exception as e:
+        logger.error(f"Failed to get prompt variant for {scenario}: {str(e)}")
+        set_span_attributes({'prompt.variant_cache': 'stale' if cached else 'error'})
+        # Serve the stale variant, or fall back to the main prompt
+        return cached[0] if cached else None
+    
+    # Misses are cached too so scenarios without a variant cost no extra reads
+    with _variant_cache_lock:
+        _variant_cache[cache_key] = (variant, now)
+    return variant
+
+def list_scenario_prompts():
+    """Get all scenario prompt variants as {scenario: prompt}"""
+    global db
+    if not db:
+        init_database()
+    
+    variants_ref = prompt_ref().collection('variants')
+    return {doc.id: doc.to_dict().get('prompt') for doc in variants_ref.stream()}
+
+def update_scenario_prompt(scenario, new_prompt):
+    """Create or replace the prompt variant for a scenario"""
+    global db
+    if not db:
+        init_database()
+    
+    _variant_ref(scenario).set({'prompt': new_prompt, 'updated_at': firestore.SERVER_TIMESTAMP})
+    with _variant_cache_lock:
+        _variant_cache[(current_tenant(), scenario)] = (new_prompt, time.monotonic())
+    logger.info(f"Prompt variant for {scenario} updated successfully")
+
+def delete_scenario_prompt(scenario):
+    """Remove the prompt variant for a scenario so it falls back to the main prompt"""
+    global db
+    if not db:
+        init_database()
+    
+    _variant_ref(scenario).delete()
+    with _variant_cache_lock:
+        _variant_cache[(current_tenant(), scenario)] = (None, time.monotonic())
+    logger.info(f"Prompt variant for {scenario} deleted")
+
+def get_prompt_with_version():
+    """Get the current AI prompt and its version number.
+
+    Served from the local prompt replica (snapshot file, kept current by a
+    Firestore listener); Firestore is only read here on a host's first start.
+    """
+    try:
+        global db
+        prompt_store = prompt_store_for()
+        if not db and not prompt_store.loaded:
+            init_database()
+        
+        prompt_store.ensure_loaded()
+        current = prompt_store.current()
+        if current:
+            return current[0], current[1]
         
-        if doc.exists:
-            return doc.to_dict().get('prompt', _get_default_prompt())
-        else:
-            # Create default prompt if it doesn't exist
-            default_prompt = _get_default_prompt()
-            prompt_ref.set({'prompt': default_prompt})
-            return default_prompt
+        if prompt_store.source:
+            # No prompt has been saved yet
+            return _get_default_prompt(), 0
+        logger.error("No prompt snapshot and Firestore unavailable; serving the default prompt")
+        return _get_default_prompt(), 0
             
+    except (DeadlineExceeded, ClientDisconnected, Superseded):
+        raise
     except Exception as e:
+        # A Firestore timeout caused by the request budget must fail the request
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check('get_prompt')
         logger.error(f"Failed to get prompt: {str(e)}")
-        return _get_default_prompt()
+        return _get_default_prompt(), 0
+
+def update_prompt(new_prompt, expected_version=None, source='update', rollback_of=None):
+    """Update the AI prompt in database and return the new version number.
 
-def update_prompt(new_prompt):
-    """Update the AI prompt in database"""
+    When expected_version is given the write only succeeds if the stored
+    version still matches, otherwise PromptVersionConflict is raised. Each
+    update appends to the prompt history; without Firestore the history
+    lives in the local snapshot file only.
+    """
     try:
         global db
+        prompt_store = prompt_store_for()
+        prompt_store.ensure_loaded()
+        content_hash = prompt_hash(new_prompt)
+        
         if not db:
-            init_database()
+            entry = prompt_store.commit_local(new_prompt, content_hash, expected_version, source, rollback_of)
+            logger.info(f"AI prompt updated locally (version {entry['version']})")
+            return entry['version']
+        
+        head_ref = prompt_ref()
+        blobs_ref = head_ref.collection('blobs')
+        
+        @firestore.transactional
+        def _commit(transaction):
+            timeout = downstream_timeout('update_prompt')
+            snapshot = head_ref.get(transaction=transaction, timeout=timeout)
+            head = snapshot.to_dict() if snapshot.exists else {}
+            current_version = head.get('version', 0)
+            if expected_version is not None and current_version != expected_version:
+                raise PromptVersionConflict(expected_version, current_version)
+            
+            parent_text = head.get('prompt')
+            parent_hash = head.get('hash') or (prompt_hash(parent_text) if parent_text else None)
+            
+            # All reads happen before the writes, as transactions require
+            new_blob_exists = blobs_ref.document(content_hash).get(transaction=transaction, timeout=timeout).exists
+            parent_doc = None
+            if parent_hash and not new_blob_exists:
+                parent_doc = blobs_ref.document(parent_hash).get(transaction=transaction, timeout=timeout)
+            
+            written = {}
+            parent_depth = 0
+            if parent_doc is not None:
+                if parent_doc.exists:
+                    parent_depth = parent_doc.to_dict().get('depth', 0)
+                else:
+                    # Head predates the history: keep its text as the base keyframe
+                    written[parent_hash] = {'text': parent_text, 'depth': 0}
+            if not new_blob_exists:
+                written[content_hash] = encode_blob(new_prompt, parent_hash, parent_text, parent_depth)
+            
+            entry = new_entry(current_version + 1, content_hash, source, rollback_of)
+            for blob_hash, blob in written.items():
+                transaction.set(blobs_ref.document(blob_hash), blob)
+            transaction.set(head_ref.collection('versions').document(f"{entry['version']:010d}"), entry)
+            transaction.set(head_ref, {'prompt': new_prompt, 'version': entry['version'], 'hash': content_hash})
+            return entry, written
         
-        prompt_ref = db.collection('ai_config').document('chat_prompt')
-        prompt_ref.set({'prompt': new_prompt})
-        logger.info("AI prompt updated successfully")
+        entry, written = call_with_deadline('update_prompt', _commit, db.transaction())
+        prompt_store.apply(entry, written, text=new_prompt)
+        logger.info(f"AI prompt updated successfully (version {entry['version']})")
+        return entry['version']
         
+    except (PromptVersionConflict, DeadlineExceeded, ClientDisconnected):
+        raise
     except Exception as e:
         logger.error(f"Failed to update prompt: {str(e)}")
         raise
 
+def list_prompt_versions(limit=20, before=None):
+    """Prompt history entries, newest first"""
+    prompt_store = prompt_store_for()
+    prompt_store.ensure_loaded()
+    return prompt_store.list_versions(limit, before)
+
+def get_prompt_version(version):
+    """Text and metadata of one prompt version, or None when it is unknown"""
+    prompt_store = prompt_store_for()
+    prompt_store.ensure_loaded()
+    entry = prompt_store.version_entry(version)
+    if entry is None and db:
+        # Written by another worker after this replica last synced
+        prompt_store.sync()
+        entry = prompt_store.version_entry(version)
+    if entry is None:
+        return None
+    return dict(entry, prompt=prompt_store.text(entry['hash']))
+
+def rollback_prompt(version, expected_version=None):
+    """Make an earlier version current again by appending it as a new version.
+
+    The text already exists under its content hash, so the rollback writes
+    only a version entry and the head; returns the new version number.
+    """
+    target = get_prompt_version(version)
+    if target is None:
+        raise KeyError(f"Prompt version {version} not found")
+    return update_prompt(target['prompt'], expected_version=expected_version, source='rollback', rollback_of=version)
+
 def _get_default_prompt():
     """Get the default AI prompt"""
     return """You are a visa consultant specializing in Thai DTV visas. Your responses should be:
@@ -0,0 +1,288 @@
+"""Local fake model server for offline and load testing.
+
+Run with ``python -m services.fake_llm_server --port 8099 --latency lognormal:4.0:0.4``
+and point the API at it with ``LLM_BACKEND=fake FAKE_LLM_URL=http://127.0.0.1:8099``.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+EDITOR_MARKER = "You are an AI prompt editor"
+
+CANNED_REPLIES = [
+    "Hi! Yes, that works. For the DTV our service fee is 18,000 THB including government fees.",
+    "Great question! You'll need your passport, a recent bank statement and proof of your activity.",
+    "Processing usually takes around 10 business days once everything is submitted.",
+    "No problem at all, happy to help. Let me know your nationality and where you'd like to apply from.",
+]
+
+
+class LatencyModel:
+    """Latency distribution parsed from specs like ``uniform:20:80`` (milliseconds)"""
+
+    def __init__(self, spec: str = "constant:0", rng: Optional[random.Random] = None):
+        self.spec = spec
+        self.rng = rng or random.Random()
+        kind, *params = spec.split(":")
+        self.kind = kind
+        self.params = [float(p) for p in params]
+        if kind not in ("constant", "uniform", "normal", "lognormal", "exponential"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample_ms(self) -> float:
+        p = self.params
+        if self.kind == "constant":
+            return p[0] if p else 0.0
+        if self.kind == "uniform":
+            return self.rng.uniform(p[0], p[1])
+        if self.kind == "normal":
+            return max(0.0, self.rng.gauss(p[0], p[1]))
+        if self.kind == "lognormal":
+            # lognormal:mu:sigma with mu/sigma of the underlying normal (ms scale)
+            return self.rng.lognormvariate(p[0], p[1])
+        return self.rng.expovariate(1.0 / p[0])
+
+
+class FakeLLMState:
+    """Mutable server behaviour, adjustable at runtime through POST /v1/config"""
+
+    def __init__(self, latency: str = "constant:0", error_rate: float = 0.0, error_status: int = 500,
+                 stream_chunk_chars: int = 16, stream_chunk_delay_ms: float = 0.0, seed: Optional[int] = None):
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.requests_served = 0
+        self.caches = {}
+        self.configure(latency=latency, error_rate=error_rate, error_status=error_status,
+                       stream_chunk_chars=stream_chunk_chars, stream_chunk_delay_ms=stream_chunk_delay_ms)
+
+    def configure(self, **settings):
+        with self.lock:
+            if "seed" in settings and settings["seed"] is not None:
+                self.rng.seed(settings["seed"])
+            if "latency" in settings:
+                self.latency = LatencyModel(settings["latency"], self.rng)
+            self.error_rate = float(settings.get("error_rate", getattr(self, "error_rate", 0.0)))
+            self.error_status = int(settings.get("error_status", getattr(self, "error_status", 500)))
+            self.stream_chunk_chars = int(settings.get("stream_chunk_chars", getattr(self, "stream_chunk_chars", 16)))
+            self.stream_chunk_delay_ms = float(settings.get("stream_chunk_delay_ms", getattr(self, "stream_chunk_delay_ms", 0.0)))
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "latency": self.latency.spec,
+            "error_rate": self.error_rate,
+            "error_status": self.error_status,
+            "stream_chunk_chars": self.stream_chunk_chars,
+            "stream_chunk_delay_ms": self.stream_chunk_delay_ms,
+            "requests_served": self.requests_served,
+            "caches": len(self.caches),
+        }
+
+    def draw(self):
+        """Return (latency_seconds, should_fail) for one request"""
+        with self.lock:
+            self.requests_served += 1
+            return self.latency.sample_ms() / 1000.0, self.rng.random() < self.error_rate
+
+
+def fake_completion(prompt: str) -> str:
+    """Deterministic response text for a prompt"""
+    if EDITOR_MARKER in prompt:
+        # Greedy: the prompt itself may contain "Client message:", the editor's own section comes last
+        match = re.search(r"Current AI prompt:\n(.*)\n\n(?:Client message|Improvement instructions|Feedback examples):", prompt, re.DOTALL)
+        current = match.group(1) if match else ""
+        # A real editor changes the prompt; an unchanged one counts as a failed edit
+        note = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        return json.dumps({"prompt": f"{current}\n- Follow consultant feedback {note}"})
+    digest = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+    return json.dumps({"reply": CANNED_REPLIES[digest % len(CANNED_REPLIES)]})
+
+
+def count_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)"""
+    return max(1, len(text) // 4)
+
+
+def apply_generation_config(text: str, config: Optional[Dict[str, Any]]):
+    """Apply stop sequences and max_output_tokens the way the real API does; returns (text, finish_reason)"""
+    config = config or {}
+    for stop in config.get("stop_sequences") or []:
+        position = text.find(stop)
+        if position != -1:
+            text = text[:position]
+    max_tokens = config.get("max_output_tokens")
+    if max_tokens and count_tokens(text) > max_tokens:
+        return text[:max_tokens * 4], "MAX_TOKENS"
+    return text, "STOP"
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    server_version = "FakeLLM/1.0"
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this keep-alive
+    # clients see ~40ms of Nagle/delayed-ACK stall per request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "healthy"})
+        elif self.path == "/v1/config":
+            self._send_json(200, self.server.state.describe())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.path == "/v1/config":
+            self.server.state.configure(**body)
+            self._send_json(200, self.server.state.describe())
+            return
+        if self.path == "/v1/caches":
+            content = body.get("content", "")
+            name = "cachedContents/" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+            with self.server.state.lock:
+                self.server.state.caches[name] = content
+            self._send_json(200, {"name": name, "tokens": count_tokens(content)})
+            return
+        if self.path != "/v1/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        state = self.server.state
+        cached_name = (body.get("options") or {}).get("cached_content")
+        cached = ""
+        if cached_name:
+            cached = state.caches.get(cached_name)
+            if cached is None:
+                self._send_json(404, {"error": f"cached content {cached_name} not found", "status": 404})
+                return
+
+        delay, fail = state.draw()
+        if cached:
+            # Cached prefix tokens are not re-processed, so only the suffix adds latency
+            delay *= count_tokens(body.get("prompt", "")) / (count_tokens(body.get("prompt", "")) + count_tokens(cached))
+        time.sleep(delay)
+        if fail:
+            self._send_json(state.error_status, {"error": "injected failure", "status": state.error_status})
+            return
+
+        prompt = cached + body.get("prompt", "")
+        text, finish_reason = apply_generation_config(
+            fake_completion(prompt), (body.get("options") or {}).get("generation_config")
+        )
+        result = {
+            "text": text,
+            "prompt_tokens": count_tokens(prompt),
+            "output_tokens": count_tokens(text),
+            "finish_reason": finish_reason,
+            "cached_tokens": count_tokens(cached) if cached else 0,
+            "metadata": {"model": "fake", "latency_ms": round(delay * 1000, 3)},
+        }
+        if body.get("stream"):
+            self._stream(text, result, state)
+        else:
+            self._send_json(200, result)
+
+    def do_DELETE(self):
+        name = self.path[len("/v1/"):] if self.path.startswith("/v1/cachedContents/") else None
+        with self.server.state.lock:
+            existed = name is not None and self.server.state.caches.pop(name, None) is not None
+        self._send_json(200 if existed else 404, {"deleted": existed})
+
+    def _stream(self, text: str, result: Dict[str, Any], state: FakeLLMState):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        size = max(1, state.stream_chunk_chars)
+        for start in range(0, len(text), size):
+            self._write_chunk({"delta": text[start:start + size]})
+            if state.stream_chunk_delay_ms:
+                time.sleep(state.stream_chunk_delay_ms / 1000.0)
+        done = dict(result)
+        done.pop("text")
+        done["done"] = True
+        self._write_chunk(done)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, event: Dict[str, Any]):
+        data = (json.dumps(event) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state: Optional[FakeLLMState] = None):
+        super().__init__(address, FakeLLMHandler)
+        self.state = state or FakeLLMState()
+
+    def handle_error(self, request, client_address):
+        # Clients that time out and hang up are expected, not server errors
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_fake_server(host: str = "127.0.0.1", port: int = 0, **settings) -> FakeLLMServer:
+    """Start a fake server on a background thread (port 0 picks a free port)"""
+    server = FakeLLMServer((host, port), FakeLLMState(**settings))
+    thread = threading.Thread(target=server.serve_forever, name="fake-llm-server", daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake model server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", default="constant:0", help="constant:MS | uniform:LO:HI | normal:MEAN:SD | lognormal:MU:SIGMA | exponential:MEAN")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stream-chunk-chars", type=int, default=16)
+    parser.add_argument("--stream-chunk-delay-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    state = FakeLLMState(latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+                         stream_chunk_chars=args.stream_chunk_chars,
+                         stream_chunk_delay_ms=args.stream_chunk_delay_ms, seed=args.seed)
+    server = FakeLLMServer((args.host, args.port), state)
+    print(f"Fake model server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Near-duplicate detection for /improve-ai feedback.
+
+Each (client_sequence, consultant_reply) pair is reduced to a MinHash
+signature over word 3-shingles. Signatures are indexed with LSH: the
+signature is cut into bands and pairs sharing any band are candidates, whose
+Jaccard similarity is then estimated from the full signatures. With the
+default 128 hashes in 32 bands of 4, pairs at 0.6 similarity are found 99%
+of the time while unrelated turns of the corpus (below 0.3) rarely become
+candidates. Swapping the country in a fee-and-documents reply still scores
+about 0.7.
+
+Two indexes are kept: examples already applied to the prompt (persisted to
+FEEDBACK_DEDUP_PATH, tagged with the prompt version they produced) and
+examples still in flight. Feedback close to an applied example is skipped
+while that version is still in the head prompt's history (a rollback past it
+makes the example new again); feedback close to one in flight is merged
+into that job. Both indexes hold at most FEEDBACK_DEDUP_MAX_ENTRIES
+signatures, dropping the oldest first.
+
+Every signature is tagged with its tenant and only matches feedback of the
+same tenant, checked against that tenant's prompt history.
+"""
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+from config import Config
+from utils.logger import logger
+from utils.memory import register_memory_source
+from utils.tenancy import current_tenant
+
+NUM_PERM = 128
+BANDS = 32
+SHINGLE_SIZE = 3
+# Hash family h(x) = (a * x + b) mod p over 31-bit shingle hashes, so a * x fits in 64 bits
+_PRIME = (1 << 31) - 1
+_SEED = 1
+
+_rng = np.random.RandomState(_SEED)
+_A = _rng.randint(1, _PRIME, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, size=NUM_PERM).astype(np.uint64)
+
+
+def shingles(client_sequence: str, consultant_reply: str):
+    """Word 3-shingles of both sides, tagged so a phrase in one never matches the other"""
+    result = set()
+    for tag, text in (("c", client_sequence), ("r", consultant_reply)):
+        words = re.findall(r"\w+", (text or "").lower())
+        if len(words) < SHINGLE_SIZE:
+            result.add(f"{tag}:{' '.join(words)}")
+            continue
+        for i in range(len(words) - SHINGLE_SIZE + 1):
+            result.add(f"{tag}:{' '.join(words[i:i + SHINGLE_SIZE])}")
+    return result
+
+
+def minhash(client_sequence: str, consultant_reply: str) -> np.ndarray:
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) & _PRIME for s in shingles(client_sequence, consultant_reply)),
+                         dtype=np.uint64)
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity: the fraction of hash functions with the same minimum"""
+    return float(np.count_nonzero(a == b)) / len(a)
+
+
+class MinHashLSH:
+    """Bounded LSH index of MinHash signatures; the oldest entries are dropped first"""
+
+    def __init__(self, max_entries: int, num_perm: int = NUM_PERM, bands: int = BANDS):
+        self.max_entries = max_entries
+        self.rows = num_perm // bands
+        self.bands = bands
+        self._entries = OrderedDict()
+        self._buckets = [dict() for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        return list(self._entries.items())
+
+    def insert(self, key: str, signature: np.ndarray, meta: Dict[str, Any]):
+        self.remove(key)
+        self._entries[key] = (signature, meta)
+        for band, bucket in zip(self._band_keys(signature), self._buckets):
+            bucket.setdefault(band, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self.remove(next(iter(self._entries)))
+
+    def remove(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for band, bucket in zip(self._band_keys(entry[0]), self._buckets):
+            keys = bucket.get(band)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del bucket[band]
+        return True
+
+    def evict_oldest(self, count: int) -> int:
+        keys = list(self._entries)[:count]
+        for key in keys:
+            self.remove(key)
+        return len(keys)
+
+    def query(self, signature: np.ndarray, threshold: float,
+              accept: Callable[[Dict[str, Any]], bool] = None) -> Optional[Dict[str, Any]]:
+        """Most similar accepted entry at or above threshold, as {key, similarity, meta}"""
+        candidates = set()
+        for band, bucket in zip(self._band_keys(signature), self._buckets):
+            candidates.update(bucket.get(band, ()))
+        best = None
+        for key in candidates:
+            other, meta = self._entries[key]
+            score = similarity(signature, other)
+            if score >= threshold and (best is None or score > best["similarity"]) and (accept is None or accept(meta)):
+                best = {"key": key, "similarity": round(score, 3), "meta": meta}
+        return best
+
+    def size_bytes(self) -> int:
+        # Signatures plus roughly one set slot per band per entry
+        return len(self._entries) * (NUM_PERM * 4 + self.bands * 64 + 200)
+
+    def _band_keys(self, signature: np.ndarray):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+
+class FeedbackDeduplicator:
+    def __init__(self, path: str = None, threshold: float = None, max_entries: int = None):
+        self.path = path or Config.FEEDBACK_DEDUP_PATH
+        self.threshold = threshold if threshold is not None else Config.FEEDBACK_DEDUP_THRESHOLD
+        max_entries = max_entries or Config.FEEDBACK_DEDUP_MAX_ENTRIES
+        self.applied = MinHashLSH(max_entries)
+        self.pending = MinHashLSH(max_entries)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.stats = {"checked": 0, "skipped": 0, "merged": 0, "recorded": 0, "lookupUs": 0.0}
+        register_memory_source('feedback_dedup', self._size_bytes, self._evict, priority=60)
+
+    @staticmethod
+    def enabled() -> bool:
+        return Config.FEEDBACK_DEDUP_ENABLED
+
+    def check_and_reserve(self, job_id: str, signature: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Match for this feedback, or None after reserving it as in flight under job_id.
+
+        A match is {kind: "applied" | "pending", jobId, similarity} plus the
+        promptVersion the example went into for applied matches.
+        """
+        from services.prompt_store import prompt_store_for
+
+        self._ensure_loaded()
+        tenant = current_tenant()
+        prompt_store = prompt_store_for(tenant)
+        started = time.perf_counter()
+        with self._lock:
+            self.stats["checked"] += 1
+            match = self.applied.query(signature, self.threshold,
+                                       accept=lambda meta: meta["tenant"] == tenant
+                                       and prompt_store.in_lineage(meta["promptVersion"]))
+            if match is not None:
+                self.stats["skipped"] += 1
+                result = {"kind": "applied", "jobId": match["key"], "similarity": match["similarity"],
+                          "promptVersion": match["meta"]["promptVersion"]}
+            else:
+                match = self.pending.query(signature, self.threshold, accept=lambda meta: meta["tenant"] == tenant)
+                if match is not None:
+                    self.stats["merged"] += 1
+                    result = {"kind": "pending", "jobId": match["key"], "similarity": match["similarity"]}
+                else:
+                    self.pending.insert(job_id, signature, {"tenant": tenant})
+                    result = None
+            self.stats["lookupUs"] += (time.perf_counter() - started) * 1e6
+        return result
+
+    def release(self, job_id: str):
+        """The job is finished; it no longer absorbs new duplicates"""
+        with self._lock:
+            self.pending.remove(job_id)
+
+    def record_applied(self, examples, prompt_version: int):
+        """Index (job_id, signature) pairs that went into the current tenant's prompt_version and persist the index"""
+        self._ensure_loaded()
+        tenant = current_tenant()
+        with self._lock:
+            for job_id, signature in examples:
+                self.pending.remove(job_id)
+                self.applied.insert(job_id, signature,
+                                    {"promptVersion": prompt_version, "appliedAt": time.time(), "tenant": tenant})
+                self.stats["recorded"] += 1
+            try:
+                self._save()
+            except Exception as e:
+                logger.error(f"Failed to save feedback dedup index {self.path}: {str(e)}")
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                self.stats,
+                threshold=self.threshold,
+                applied=len(self.applied),
+                pending=len(self.pending),
+                maxEntries=self.applied.max_entries,
+                meanLookupUs=round(self.stats["lookupUs"] / self.stats["checked"], 1) if self.stats["checked"] else None,
+                path=os.path.abspath(self.path)
+            )
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not os.path.exists(self.path):
+                return
+            try:
+                with np.load(self.path) as data:
+                    if int(data["num_perm"]) != NUM_PERM or int(data["seed"]) != _SEED:
+                        logger.warning(f"Ignoring feedback dedup index built with other hash parameters: {self.path}")
+                        return
+                    # Indexes written before tenants existed belong to the default tenant
+                    tenants = data["tenants"] if "tenants" in data.files else [Config.DEFAULT_TENANT] * len(data["keys"])
+                    for key, signature, version, applied_at, tenant in zip(data["keys"], data["signatures"],
+                                                                           data["versions"], data["applied_at"], tenants):
+                        self.applied.insert(str(key), signature, {"promptVersion": int(version),
+                                                                  "appliedAt": float(applied_at), "tenant": str(tenant)})
+                logger.info(f"Loaded {len(self.applied)} applied feedback signatures")
+            except Exception as e:
+                logger.error(f"Failed to read feedback dedup index {self.path}: {str(e)}")
+
+    def _save(self):
+        # Caller holds self._lock
+        entries = self.applied.items()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            num_perm=NUM_PERM,
+            seed=_SEED,
+            keys=np.array([key for key, _ in entries], dtype=str),
+            signatures=np.array([signature for _, (signature, _) in entries], dtype=np.uint32).reshape(-1, NUM_PERM),
+            versions=np.array([meta["promptVersion"] for _, (_, meta) in entries], dtype=np.int64),
+            applied_at=np.array([meta["appliedAt"] for _, (_, meta) in entries], dtype=np.float64),
+            tenants=np.array([meta["tenant"] for _, (_, meta) in entries], dtype=str)
+        )
+        os.replace(tmp_path, self.path)
+
+    def _size_bytes(self):
+        with self._lock:
+            return self.applied.size_bytes() + self.pending.size_bytes()
+
+    def _evict(self, fraction):
+        # Only applied examples can go; in-flight ones are needed to finish merging
+        with self._lock:
+            return self.applied.evict_oldest(max(1, int(len(self.applied) * fraction)))
@@ -0,0 +1,298 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from config import Config
+from services.database_service import PromptVersionConflict, get_prompt_with_version, prompt_hash, update_prompt
+from services.feedback_dedup import minhash
+from services.interaction_log import interaction_log
+from services.model_scheduler import PRIORITY_BATCH, model_priority
+from utils.logger import logger
+from utils.memory import deep_sizeof, register_memory_source
+from utils.tenancy import current_tenant, tenant_context
+
+JOB_QUEUED = "queued"
+JOB_PREDICTING = "predicting"
+JOB_BATCHED = "batched"
+JOB_EDITING = "editing"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+# Near-duplicates: of an example already in the prompt, or of a job still in flight
+JOB_SKIPPED = "skipped"
+JOB_MERGED = "merged"
+# Statuses a job never leaves (merged jobs take their primary's outcome), so it can be trimmed or evicted
+FINISHED_STATUSES = (JOB_COMPLETED, JOB_FAILED, JOB_SKIPPED)
+
+
+class ImproveJobQueue:
+    """Background queue for /improve-ai.
+
+    Predictions run in parallel on a worker pool. Finished predictions are
+    collected for a batch window and applied with one editor call per batch,
+    then committed only if the prompt version is unchanged since it was read;
+    on conflict the batch is re-edited against the fresh prompt. An edit that
+    leaves the prompt as it was (the editor returns its input when the model
+    call or its JSON fails) fails the batch instead of committing.
+
+    With a deduplicator, feedback that nearly repeats an example already
+    applied to the current prompt is skipped, and feedback that repeats one
+    still in flight follows that job, both before any model call.
+
+    Jobs run as the tenant that submitted them and a batch only holds one
+    tenant's feedback, which goes into that tenant's prompt. Shadow
+    evaluation covers the default tenant; other tenants' batches commit
+    directly.
+    """
+
+    def __init__(self, ai_service, workers: int = None, batch_window_ms: int = None,
+                 max_batch: int = None, max_commit_retries: int = None, retention: int = None, shadow=None, dedup=None):
+        self.ai_service = ai_service
+        self.shadow = shadow
+        self.dedup = dedup
+        self.workers = workers or Config.IMPROVE_WORKERS
+        self.batch_window = (batch_window_ms if batch_window_ms is not None else Config.IMPROVE_BATCH_WINDOW_MS) / 1000.0
+        self.max_batch = max_batch or Config.IMPROVE_MAX_BATCH
+        self.max_commit_retries = max_commit_retries or Config.IMPROVE_MAX_COMMIT_RETRIES
+        self.retention = retention or Config.IMPROVE_JOB_RETENTION
+
+        self._jobs = OrderedDict()
+        self._pending = []
+        # primary job id -> jobs merged into it
+        self._followers = {}
+        self._lock = threading.Lock()
+        self._pending_ready = threading.Condition(self._lock)
+        self._executor = None
+        self._batcher = None
+        self.stats = {"jobs": 0, "editor_calls": 0, "commits": 0, "conflicts": 0, "skipped": 0, "merged": 0,
+                      "unchanged": 0}
+        register_memory_source('improve_jobs', self._size_bytes, self._evict_finished, priority=20)
+
+    def submit(self, client_sequence: str, chat_history: List[Dict[str, str]], consultant_reply: str) -> Dict[str, Any]:
+        """Enqueue an improvement job and return its initial status"""
+        self._ensure_started()
+        job = {
+            "jobId": uuid.uuid4().hex,
+            "tenant": current_tenant(),
+            "status": JOB_QUEUED,
+            "createdAt": time.time(),
+            "updatedAt": time.time(),
+            "predictedReply": None,
+            "updatedPrompt": None,
+            "promptVersion": None,
+            "batchSize": None,
+            "candidateId": None,
+            "duplicateOf": None,
+            "error": None,
+        }
+        feedback = {
+            "client_sequence": client_sequence,
+            "chat_history": chat_history,
+            "consultant_reply": consultant_reply,
+        }
+        duplicate = None
+        if self.dedup is not None and self.dedup.enabled():
+            feedback["signature"] = minhash(client_sequence, consultant_reply)
+            duplicate = self.dedup.check_and_reserve(job["jobId"], feedback["signature"])
+        with self._lock:
+            self._jobs[job["jobId"]] = job
+            self.stats["jobs"] += 1
+            self._trim_jobs()
+            if duplicate is not None:
+                self._attach_duplicate(job, duplicate)
+                return dict(job)
+        self._executor.submit(self._predict, job, feedback)
+        return dict(job)
+
+    def _attach_duplicate(self, job: Dict[str, Any], duplicate: Dict[str, Any]):
+        # Caller holds self._lock
+        job["duplicateOf"] = duplicate
+        if duplicate["kind"] == "applied":
+            self.stats["skipped"] += 1
+            job.update(status=JOB_SKIPPED, promptVersion=duplicate["promptVersion"])
+            return
+        self.stats["merged"] += 1
+        primary = self._jobs.get(duplicate["jobId"])
+        if primary is not None and primary["status"] in (JOB_COMPLETED, JOB_FAILED):
+            self._copy_outcome(primary, job)
+        else:
+            job["status"] = JOB_MERGED
+            self._followers.setdefault(duplicate["jobId"], []).append(job)
+
+    @staticmethod
+    def _copy_outcome(primary: Dict[str, Any], follower: Dict[str, Any]):
+        for field in ("status", "predictedReply", "updatedPrompt", "promptVersion", "batchSize", "candidateId", "error"):
+            follower[field] = primary[field]
+        follower["updatedAt"] = time.time()
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """The job, if it belongs to the current tenant"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job and job["tenant"] == current_tenant() else None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="improve-predict")
+                self._batcher = threading.Thread(target=self._batch_loop, name="improve-batcher", daemon=True)
+                self._batcher.start()
+
+    def _set_status(self, job: Dict[str, Any], status: str, **fields):
+        with self._lock:
+            job.update(fields)
+            job["status"] = status
+            job["updatedAt"] = time.time()
+            if status in (JOB_COMPLETED, JOB_FAILED):
+                for follower in self._followers.pop(job["jobId"], []):
+                    self._copy_outcome(job, follower)
+        if status in (JOB_COMPLETED, JOB_FAILED) and self.dedup is not None:
+            self.dedup.release(job["jobId"])
+
+    def _predict(self, job: Dict[str, Any], feedback: Dict[str, Any]):
+        try:
+            self._set_status(job, JOB_PREDICTING)
+            # Background work only uses model capacity left over by live traffic
+            with tenant_context(job["tenant"]), model_priority(PRIORITY_BATCH, session=f"improve:{job['jobId']}"):
+                current_prompt, _ = get_prompt_with_version()
+                result = self.ai_service.generate_reply_detailed(
+                    feedback["client_sequence"], feedback["chat_history"], current_prompt
+                )
+            # A failed call comes back as an apology reply; editing against it would teach the prompt nothing
+            if result.get("error"):
+                raise RuntimeError(f"Prediction failed: {result['error']}")
+            predicted_reply = result.pop("reply")
+            feedback["predicted_reply"] = predicted_reply
+            feedback["prediction_metrics"] = result
+            feedback["prompt_hash"] = prompt_hash(current_prompt)
+            with self._lock:
+                job.update(status=JOB_BATCHED, predictedReply=predicted_reply, updatedAt=time.time())
+                self._pending.append((job, feedback))
+                self._pending_ready.notify()
+        except Exception as e:
+            logger.error(f"Improve job {job['jobId']} prediction failed: {str(e)}")
+            self._set_status(job, JOB_FAILED, error=str(e))
+
+    def _batch_loop(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._pending_ready.wait()
+                window_ends = time.monotonic() + self.batch_window
+                while len(self._pending) < self.max_batch:
+                    remaining = window_ends - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._pending_ready.wait(remaining)
+                # Oldest tenant first; its feedback only ever edits its own prompt
+                tenant = self._pending[0][0]["tenant"]
+                batch, rest = [], []
+                for item in self._pending:
+                    (batch if item[0]["tenant"] == tenant and len(batch) < self.max_batch else rest).append(item)
+                self._pending = rest
+            try:
+                with tenant_context(tenant), model_priority(PRIORITY_BATCH, session="improve-editor"):
+                    self._apply_batch(batch)
+            except Exception as e:
+                logger.error(f"Improve batch failed: {str(e)}")
+                for job, _ in batch:
+                    self._set_status(job, JOB_FAILED, error=str(e))
+
+    def _apply_batch(self, batch):
+        jobs = [job for job, _ in batch]
+        examples = [feedback for _, feedback in batch]
+        for job in jobs:
+            self._set_status(job, JOB_EDITING, batchSize=len(batch))
+        
+        if self.shadow is not None and self.shadow.enabled():
+            # Build on the candidate under evaluation and stage the result instead of committing
+            current_prompt = self.shadow.working_prompt() or get_prompt_with_version()[0]
+            updated_prompt = self.ai_service.improve_prompt_batch(current_prompt, examples)
+            with self._lock:
+                self.stats["editor_calls"] += 1
+            self._require_change(current_prompt, updated_prompt)
+            # Recorded as applied for deduplication only if the candidate is promoted
+            candidate = self.shadow.propose(updated_prompt, "improve-ai", applied=[
+                (job["jobId"], feedback["signature"]) for job, feedback in batch if "signature" in feedback])
+            for job in jobs:
+                self._set_status(job, JOB_COMPLETED, updatedPrompt=updated_prompt, candidateId=candidate["candidateId"])
+            self._log_batch(batch, updated_prompt, candidateId=candidate["candidateId"])
+            logger.info(f"Staged {len(batch)} improvement(s) as prompt candidate {candidate['candidateId']}")
+            return
+
+        for attempt in range(1, self.max_commit_retries + 1):
+            current_prompt, version = get_prompt_with_version()
+            updated_prompt = self.ai_service.improve_prompt_batch(current_prompt, examples)
+            with self._lock:
+                self.stats["editor_calls"] += 1
+            self._require_change(current_prompt, updated_prompt)
+            try:
+                new_version = update_prompt(updated_prompt, expected_version=version)
+            except PromptVersionConflict as e:
+                with self._lock:
+                    self.stats["conflicts"] += 1
+                logger.warning(f"Improve batch of {len(batch)} hit {e} (attempt {attempt}); re-editing")
+                continue
+            with self._lock:
+                self.stats["commits"] += 1
+            # Only feedback that changed the committed prompt counts as applied; its near-duplicates get skipped
+            if self.dedup is not None and prompt_hash(updated_prompt) != prompt_hash(current_prompt):
+                self.dedup.record_applied([(job["jobId"], feedback["signature"]) for job, feedback in batch
+                                           if "signature" in feedback], new_version)
+            for job in jobs:
+                self._set_status(job, JOB_COMPLETED, updatedPrompt=updated_prompt, promptVersion=new_version)
+            self._log_batch(batch, updated_prompt, promptVersion=new_version)
+            logger.info(f"Applied {len(batch)} improvement(s) as prompt version {new_version}")
+            return
+
+        raise RuntimeError(f"Prompt changed concurrently {self.max_commit_retries} times; giving up")
+
+    def _require_change(self, current_prompt: str, updated_prompt: str):
+        if isinstance(updated_prompt, str) and updated_prompt.strip() and updated_prompt != current_prompt:
+            return
+        with self._lock:
+            self.stats["unchanged"] += 1
+        raise RuntimeError("Prompt editor returned no change; nothing was committed")
+
+    def _log_batch(self, batch, updated_prompt, **outcome):
+        # Predicted vs consultant reply pairs are the training data
+        for job, feedback in batch:
+            interaction_log.append("improve_ai", dict(
+                outcome,
+                jobId=job["jobId"],
+                promptHash=feedback.get("prompt_hash"),
+                updatedPromptHash=prompt_hash(updated_prompt),
+                batchSize=len(batch),
+                clientSequence=feedback["client_sequence"],
+                chatHistory=feedback["chat_history"],
+                consultantReply=feedback["consultant_reply"],
+                predictedReply=feedback["predicted_reply"],
+                predictionMetrics=feedback.get("prediction_metrics"),
+                jobMs=(time.time() - job["createdAt"]) * 1000.0
+            ))
+
+    def _size_bytes(self):
+        with self._lock:
+            return deep_sizeof(self._jobs) + deep_sizeof(self._pending)
+
+    def _evict_finished(self, fraction):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job["status"] in FINISHED_STATUSES]
+            drop = finished[:max(1, int(len(finished) * fraction))] if finished else []
+            for job_id in drop:
+                del self._jobs[job_id]
+            return len(drop)
+
+    def _trim_jobs(self):
+        # Drop the oldest finished jobs once the retention limit is reached
+        excess = len(self._jobs) - self.retention
+        if excess <= 0:
+            return
+        for job_id in list(self._jobs.keys()):
+            if excess <= 0:
+                break
+            if self._jobs[job_id]["status"] in FINISHED_STATUSES:
+                del self._jobs[job_id]
+                excess -= 1
@@ -0,0 +1,273 @@
+"""Append-only interaction log for training and analysis data.
+
+Requests hand records to an in-memory buffer and return immediately. A writer
+thread drains the buffer with one write per batch (group commit), fsyncs at
+most every INTERACTION_LOG_FSYNC_INTERVAL_MS and rotates the active segment
+by size or age. Closed segments are bulk-loaded into SQLite or Firestore by a
+shipper thread, so no request performs a network write for logging.
+
+Segments are NDJSON files in INTERACTION_LOG_DIR: the active one ends in
+``.open``, closed ones in ``.ndjson``. A ``.open`` segment left by a crash is
+closed on startup and shipped with the rest.
+"""
+import atexit
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List
+
+from config import Config
+from utils.logger import logger
+from utils.tenancy import current_tenant
+
+ACTIVE_SUFFIX = ".open"
+CLOSED_SUFFIX = ".ndjson"
+SHIPPED_DIR = "shipped"
+
+
+class InteractionLog:
+    def __init__(self, directory: str = None, sink: str = None):
+        self.directory = os.path.abspath(directory or Config.INTERACTION_LOG_DIR)
+        self.sink = sink or Config.INTERACTION_LOG_SINK
+        self.segment_max_bytes = Config.INTERACTION_LOG_SEGMENT_MAX_BYTES
+        self.segment_max_age = Config.INTERACTION_LOG_SEGMENT_MAX_AGE_SECONDS
+        self.fsync_interval = Config.INTERACTION_LOG_FSYNC_INTERVAL_MS / 1000.0
+        self.max_pending = Config.INTERACTION_LOG_MAX_PENDING
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._pending_ready = threading.Condition(self._lock)
+        # Serializes segment I/O between the writer thread and flush()
+        self._io_lock = threading.Lock()
+        self._rotate_requested = False
+        self._writer = None
+        self._shipper = None
+        self._segment = None
+        self._segment_path = None
+        self._segment_opened = 0.0
+        self._segment_seq = 0
+        self._last_fsync = 0.0
+        self._unsynced = False
+        self.stats = {"records": 0, "dropped": 0, "batches": 0, "fsyncs": 0, "rotations": 0,
+                      "shipped_segments": 0, "shipped_records": 0, "ship_failures": 0}
+
+    def append(self, kind: str, record: Dict[str, Any]):
+        """Queue a record for the log; never blocks on disk or network"""
+        if not Config.INTERACTION_LOG_ENABLED:
+            return
+        self._ensure_started()
+        entry = dict(record, id=uuid.uuid4().hex, kind=kind, ts=time.time(), tenant=current_tenant())
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.stats["dropped"] += 1
+                return
+            self._pending.append(entry)
+            self.stats["records"] += 1
+            self._pending_ready.notify()
+
+    def rotate(self):
+        """Close the active segment at the next writer pass so it can be shipped"""
+        with self._lock:
+            self._rotate_requested = True
+            self._pending_ready.notify()
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = len(self._pending)
+            active = self._segment_path
+        return {
+            "enabled": Config.INTERACTION_LOG_ENABLED,
+            "directory": self.directory,
+            "sink": self.sink,
+            "activeSegment": active,
+            "closedSegments": len(self._closed_segments()),
+            "pending": pending,
+            "stats": dict(self.stats),
+        }
+
+    def _ensure_started(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            # Segments left open by a dead process are complete as far as they go
+            for path in glob.glob(os.path.join(self.directory, "*" + ACTIVE_SUFFIX)):
+                if not _writer_alive(path):
+                    os.replace(path, path[:-len(ACTIVE_SUFFIX)] + CLOSED_SUFFIX)
+            self._writer = threading.Thread(target=self._write_loop, name="interaction-log-writer", daemon=True)
+            self._writer.start()
+            if self.sink != "none":
+                self._shipper = threading.Thread(target=self._ship_loop, name="interaction-log-shipper", daemon=True)
+                self._shipper.start()
+            atexit.register(self.flush)
+
+    def flush(self):
+        """Write and fsync everything buffered so far (used at exit)"""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        with self._io_lock:
+            if batch:
+                self._write_batch(batch)
+            self._fsync(force=True)
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                if not self._pending and not self._rotate_requested:
+                    # Wake up to honour the fsync interval and segment age
+                    self._pending_ready.wait(self.fsync_interval if self._unsynced else 1.0)
+                batch, self._pending = self._pending, []
+                rotate, self._rotate_requested = self._rotate_requested, False
+            try:
+                with self._io_lock:
+                    if batch:
+                        self._write_batch(batch)
+                    self._fsync()
+                    if rotate or self._segment_due():
+                        self._close_segment()
+            except Exception as e:
+                logger.error(f"Interaction log write failed: {str(e)}")
+                time.sleep(1.0)
+
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        # One write call per batch: the group commit
+        data = "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+                       for entry in batch).encode("utf-8")
+        if self._segment is None:
+            self._open_segment()
+        self._segment.write(data)
+        self._segment.flush()
+        self._unsynced = True
+        self.stats["batches"] += 1
+
+    def _fsync(self, force: bool = False):
+        if self._segment is None or not self._unsynced:
+            return
+        if force or time.monotonic() - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._segment.fileno())
+            self._last_fsync = time.monotonic()
+            self._unsynced = False
+            self.stats["fsyncs"] += 1
+
+    def _segment_due(self) -> bool:
+        if self._segment is None:
+            return False
+        return (self._segment.tell() >= self.segment_max_bytes
+                or time.monotonic() - self._segment_opened >= self.segment_max_age)
+
+    def _open_segment(self):
+        self._segment_seq += 1
+        name = f"interactions-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self._segment_seq:06d}"
+        self._segment_path = os.path.join(self.directory, name + ACTIVE_SUFFIX)
+        self._segment = open(self._segment_path, "ab")
+        self._segment_opened = time.monotonic()
+
+    def _close_segment(self):
+        if self._segment is None:
+            return
+        self._fsync(force=True)
+        self._segment.close()
+        os.replace(self._segment_path, self._segment_path[:-len(ACTIVE_SUFFIX)] + CLOSED_SUFFIX)
+        with self._lock:
+            self._segment = None
+            self._segment_path = None
+        self.stats["rotations"] += 1
+
+    def _closed_segments(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "*" + CLOSED_SUFFIX)))
+
+    def _ship_loop(self):
+        while True:
+            time.sleep(Config.INTERACTION_LOG_SHIP_INTERVAL_SECONDS)
+            for path in self._closed_segments():
+                try:
+                    shipped = self._ship_segment(path)
+                    if Config.INTERACTION_LOG_KEEP_SHIPPED:
+                        shipped_dir = os.path.join(self.directory, SHIPPED_DIR)
+                        os.makedirs(shipped_dir, exist_ok=True)
+                        os.replace(path, os.path.join(shipped_dir, os.path.basename(path)))
+                    else:
+                        os.remove(path)
+                except FileNotFoundError:
+                    # Another worker sharing the directory shipped it first
+                    continue
+                except Exception as e:
+                    self.stats["ship_failures"] += 1
+                    logger.error(f"Shipping {os.path.basename(path)} failed: {str(e)}")
+                    break
+                self.stats["shipped_segments"] += 1
+                self.stats["shipped_records"] += shipped
+
+    def _ship_segment(self, path: str) -> int:
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Torn final line from a crash
+                    logger.warning(f"Skipping unreadable record in {os.path.basename(path)}")
+        if self.sink == "sqlite":
+            _ship_to_sqlite(records)
+        elif self.sink == "firestore":
+            _ship_to_firestore(records)
+        else:
+            raise ValueError(f"Unknown interaction log sink: {self.sink}")
+        return len(records)
+
+
+def _writer_alive(segment_path: str) -> bool:
+    """Whether the process that owns an open segment (pid in its name) still runs"""
+    try:
+        pid = int(os.path.basename(segment_path).split("-")[2])
+        os.kill(pid, 0)
+    except (IndexError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return pid != os.getpid()
+
+
+def _ship_to_sqlite(records: List[Dict[str, Any]]):
+    # Record ids make re-shipping a segment after a crash idempotent
+    os.makedirs(os.path.dirname(os.path.abspath(Config.INTERACTION_LOG_SQLITE_PATH)), exist_ok=True)
+    connection = sqlite3.connect(Config.INTERACTION_LOG_SQLITE_PATH)
+    try:
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS interactions ("
+                "id TEXT PRIMARY KEY, kind TEXT, ts REAL, prompt_hash TEXT, record TEXT)"
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO interactions (id, kind, ts, prompt_hash, record) VALUES (?, ?, ?, ?, ?)",
+                [(r["id"], r.get("kind"), r.get("ts"), r.get("promptHash"), json.dumps(r, ensure_ascii=False))
+                 for r in records]
+            )
+    finally:
+        connection.close()
+
+
+def _ship_to_firestore(records: List[Dict[str, Any]]):
+    from services import database_service
+
+    if not database_service.db:
+        raise RuntimeError("Firestore is not configured")
+    collection = database_service.db.collection('interactions')
+    # Firestore batches hold at most 500 writes
+    for start in range(0, len(records), 500):
+        batch = database_service.db.batch()
+        for record in records[start:start + 500]:
+            batch.set(collection.document(record["id"]), record)
+        batch.commit()
+
+
+interaction_log = InteractionLog()
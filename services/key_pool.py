@@ -0,0 +1,212 @@
+"""API-key pool that spreads model calls over several keys.
+
+Each key has token buckets for requests and tokens per minute. A call is
+scheduled on the available key with the most remaining headroom; its token
+charge is estimated up front (prompt length plus the output cap) and
+reconciled with the reported usage afterwards. Keys that return quota errors
+are parked for the retry delay the API asks for (or GOOGLE_AI_KEY_PARK_SECONDS)
+and the call is retried on the next key.
+
+Context caches belong to the project of the key that created them, so a
+pool cache is created on every key and each call uses the copy on the key it
+is scheduled on.
+"""
+import hashlib
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from config import Config
+from services.llm_backends import LLMBackend, LLMBackendError, LLMResponse
+from utils.logger import logger
+
+RETRY_DELAY_PATTERN = re.compile(r"retry[_ ]?(?:delay|in)\D{0,20}(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+DEFAULT_OUTPUT_ESTIMATE = 512
+
+
+class TokenBucket:
+    """Continuously refilling bucket holding up to `capacity` units per minute"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount: float) -> float:
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+
+class PooledKey:
+    def __init__(self, name: str, backend: LLMBackend, rpm: float, tpm: float):
+        self.name = name
+        self.backend = backend
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.parked_until = 0.0
+        self.stats = {"calls": 0, "quota_errors": 0, "errors": 0, "tokens": 0}
+
+    def headroom(self) -> float:
+        return min(self.requests.level / self.requests.capacity, self.tokens.level / self.tokens.capacity)
+
+
+def is_quota_error(error: LLMBackendError) -> bool:
+    message = str(error)
+    return error.status == 429 or "RESOURCE_EXHAUSTED" in message or "quota" in message.lower()
+
+
+class KeyPoolBackend(LLMBackend):
+    name = "key_pool"
+
+    def __init__(self, keys: List[PooledKey], max_wait_seconds: float = None):
+        if not keys:
+            raise ValueError("Key pool needs at least one key")
+        self.keys = keys
+        self.max_wait_seconds = max_wait_seconds if max_wait_seconds is not None else Config.KEY_POOL_MAX_WAIT_SECONDS
+        self.supports_caching = all(key.backend.supports_caching for key in keys)
+        # Pool cache handle -> {key name: that key's cache handle}
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def generate(self, prompt: str, **options) -> LLMResponse:
+        estimate = self._estimate_tokens(prompt, options)
+        pool_handle = options.get("cached_content")
+        copies = self._caches.get(pool_handle) if pool_handle else None
+        if pool_handle and not copies:
+            raise LLMBackendError(f"Context cache {pool_handle} unavailable", status=404)
+
+        tried = set()
+        while True:
+            key = self._acquire(estimate, tried, eligible=set(copies) if copies else None,
+                                timeout=options.get("timeout"))
+            tried.add(key.name)
+            key_options = dict(options)
+            if copies:
+                key_options["cached_content"] = copies[key.name]
+            try:
+                response = key.backend.generate(prompt, **key_options)
+            except LLMBackendError as e:
+                self._release(key, estimate, None, quota_error=is_quota_error(e), error=e)
+                if is_quota_error(e) and len(tried) < len(self.keys):
+                    logger.warning(f"Key {key.name} hit its quota; retrying on another key")
+                    continue
+                raise
+            # prompt_tokens already includes the cached prefix
+            self._release(key, estimate, response.prompt_tokens + response.output_tokens)
+            response.metadata = dict(response.metadata, key=key.name)
+            return response
+
+    def create_cache(self, content: str, ttl_seconds: int) -> str:
+        copies = {}
+        for key in self.keys:
+            try:
+                copies[key.name] = key.backend.create_cache(content, ttl_seconds)
+            except LLMBackendError as e:
+                logger.warning(f"Context cache creation on key {key.name} failed: {str(e)}")
+        if not copies:
+            raise LLMBackendError("Context cache creation failed on every key")
+        handle = "pool/" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:16] + f"-{int(time.time())}"
+        with self._lock:
+            self._caches[handle] = copies
+        return handle
+
+    def delete_cache(self, handle: str):
+        with self._lock:
+            copies = self._caches.pop(handle, {})
+        for key in self.keys:
+            if key.name in copies:
+                key.backend.delete_cache(copies[key.name])
+
+    def report(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            keys = []
+            for key in self.keys:
+                key.requests.refill(now)
+                key.tokens.refill(now)
+                keys.append({
+                    "key": key.name,
+                    "requestsAvailable": round(key.requests.level, 1),
+                    "requestsPerMinute": key.requests.capacity,
+                    "tokensAvailable": round(key.tokens.level),
+                    "tokensPerMinute": key.tokens.capacity,
+                    "parkedForSeconds": round(max(0.0, key.parked_until - now), 1),
+                    "stats": dict(key.stats),
+                })
+            return {"keys": keys, "caches": len(self._caches)}
+
+    def _estimate_tokens(self, prompt: str, options: Dict[str, Any]) -> int:
+        output_cap = (options.get("generation_config") or {}).get("max_output_tokens") or DEFAULT_OUTPUT_ESTIMATE
+        return len(prompt) // 4 + output_cap
+
+    def _acquire(self, estimate: int, tried: set, eligible: Optional[set], timeout: Optional[float]) -> PooledKey:
+        """Take budget from the key with the most headroom, waiting for refill if all are drained"""
+        give_up_at = time.monotonic() + min(self.max_wait_seconds, timeout or self.max_wait_seconds)
+        while True:
+            now = time.monotonic()
+            wait = None
+            with self._lock:
+                candidates = [key for key in self.keys
+                              if key.name not in tried and (eligible is None or key.name in eligible)]
+                if not candidates:
+                    raise LLMBackendError("No API key available for this call", status=429)
+                for key in candidates:
+                    key.requests.refill(now)
+                    key.tokens.refill(now)
+                ready = [key for key in candidates if key.parked_until <= now
+                         and key.requests.level >= 1 and key.tokens.level >= min(estimate, key.tokens.capacity)]
+                if ready:
+                    key = max(ready, key=PooledKey.headroom)
+                    key.requests.level -= 1
+                    key.tokens.level -= estimate
+                    return key
+                for key in candidates:
+                    key_wait = max(key.parked_until - now, key.requests.seconds_until(1),
+                                   key.tokens.seconds_until(estimate))
+                    wait = key_wait if wait is None else min(wait, key_wait)
+            if now + wait > give_up_at:
+                raise LLMBackendError(f"All API keys are rate-limited for the next {wait:.1f}s", status=429)
+            time.sleep(wait)
+
+    def _release(self, key: PooledKey, estimate: int, actual_tokens: Optional[int],
+                 quota_error: bool = False, error: Optional[Exception] = None):
+        with self._lock:
+            key.stats["calls"] += 1
+            if actual_tokens is not None:
+                # Refund (or charge) the difference between the estimate and the reported usage
+                key.tokens.level = min(key.tokens.capacity, key.tokens.level + estimate - actual_tokens)
+                key.stats["tokens"] += actual_tokens
+            elif quota_error:
+                key.stats["quota_errors"] += 1
+                match = RETRY_DELAY_PATTERN.search(str(error))
+                park_seconds = float(match.group(1)) if match else Config.GOOGLE_AI_KEY_PARK_SECONDS
+                key.parked_until = time.monotonic() + park_seconds
+                logger.warning(f"Parking key {key.name} for {park_seconds:.0f}s after a quota error")
+            else:
+                key.stats["errors"] += 1
+                # The request never reached the model's token accounting
+                key.tokens.level = min(key.tokens.capacity, key.tokens.level + estimate)
+
+
+def parse_key_specs(specs: str) -> List[Dict[str, Any]]:
+    """Parse "key[:rpm[:tpm]],..." into dicts with the configured per-key defaults"""
+    keys = []
+    for spec in filter(None, (part.strip() for part in specs.split(","))):
+        parts = spec.split(":")
+        keys.append({
+            "api_key": parts[0],
+            "rpm": float(parts[1]) if len(parts) > 1 and parts[1] else Config.GOOGLE_AI_KEY_RPM,
+            "tpm": float(parts[2]) if len(parts) > 2 and parts[2] else Config.GOOGLE_AI_KEY_TPM,
+        })
+    return keys
+
+
+def key_label(index: int, api_key: str) -> str:
+    """Non-secret label for logs and reports"""
+    return f"key{index}-...{api_key[-4:]}"
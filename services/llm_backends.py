@@ -0,0 +1,397 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Dict, Iterator, Optional
+
+import requests
+
+from config import Config
+from utils.logger import logger
+
+
+class LLMBackendError(Exception):
+    """Raised when a backend cannot produce a response"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def not_found(self) -> bool:
+        """The call referenced something (e.g. a context cache) the backend no longer has"""
+        return self.status == 404 or "NOT_FOUND" in str(self) or "not found" in str(self).lower()
+
+
+@dataclass
+class LLMResponse:
+    """Normalized model response shared by every backend"""
+    text: str
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    finish_reason: Optional[str] = None
+    cached_tokens: int = 0
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    # Duration of the backend call alone, set by the caller (not part of recordings)
+    backend_ms: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "text": self.text,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "finish_reason": self.finish_reason,
+            "cached_tokens": self.cached_tokens,
+            "metadata": self.metadata,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LLMResponse":
+        return cls(
+            text=data["text"],
+            prompt_tokens=data.get("prompt_tokens", 0),
+            output_tokens=data.get("output_tokens", 0),
+            finish_reason=data.get("finish_reason"),
+            cached_tokens=data.get("cached_tokens", 0),
+            metadata=data.get("metadata") or {},
+        )
+
+
+# Options that only affect transport, not the model output
+TRANSPORT_OPTIONS = ("timeout",)
+
+
+class LLMBackend:
+    """Interface every model backend implements"""
+
+    name = "base"
+    supports_caching = False
+
+    def generate(self, prompt: str, **options) -> LLMResponse:
+        """Run a single prompt and return the complete response.
+
+        ``cached_content`` may name a handle returned by create_cache(); the
+        cached text is then treated as a prefix of ``prompt``. ``timeout`` bounds
+        the call in seconds.
+        """
+        raise NotImplementedError
+
+    def create_cache(self, content: str, ttl_seconds: int) -> str:
+        """Register a static prompt prefix with the model's context cache and return its handle"""
+        raise NotImplementedError(f"{self.name} backend does not support context caching")
+
+    def delete_cache(self, handle: str):
+        """Release a context cache handle (best effort)"""
+
+    def stream(self, prompt: str, **options) -> Iterator[str]:
+        """Yield response text chunks; backends without streaming yield once"""
+        yield self.generate(prompt, **options).text
+
+
+class GeminiBackend(LLMBackend):
+    """Google AI Studio backend built on google.generativeai.
+
+    Each instance uses its own API clients rather than the process-wide
+    genai.configure() default, so several keys can be used side by side.
+    The public caching API (CachedContent.create, from_cached_content by
+    name) only talks to that default client, so per-key caches go through
+    the SDK internals listed in SDK_CACHE_HOOKS; requirements.txt pins the
+    SDK version they were checked against. When a hook is missing, caching
+    is switched off with a warning and full prompts are sent.
+    """
+
+    name = "gemini"
+    supports_caching = True
+
+    # (module, attribute path) of the google.generativeai internals used for per-key caching
+    SDK_CACHE_HOOKS = (
+        ("client", "_ClientManager"),
+        ("caching", "CachedContent._prepare_create_request"),
+        ("caching", "CachedContent._from_obj"),
+    )
+
+    def __init__(self, api_key: str, model_name: str):
+        import google.generativeai as genai
+        from google.generativeai import client
+
+        self.genai = genai
+        self.model_name = model_name
+        missing = self._missing_cache_hooks()
+        if missing:
+            self.supports_caching = False
+            logger.warning(f"google-generativeai {genai.__version__} lacks {', '.join(missing)}; "
+                           f"context caching disabled")
+        self._clients = client._ClientManager()
+        self._clients.configure(api_key=api_key)
+        self._generative_client = self._clients.make_client("generative")
+        self.model = self._bind(genai.GenerativeModel(model_name))
+        self._cached_models = {}
+
+    def generate(self, prompt: str, **options) -> LLMResponse:
+        model = self._model_for(options.get("cached_content"))
+        request_options = {"timeout": options["timeout"]} if options.get("timeout") else None
+        try:
+            response = model.generate_content(
+                prompt, generation_config=options.get("generation_config"), request_options=request_options
+            )
+        except Exception as e:
+            raise LLMBackendError(str(e), status=getattr(e, "code", None)) from e
+        return self._to_response(response)
+
+    def stream(self, prompt: str, **options) -> Iterator[str]:
+        model = self._model_for(options.get("cached_content"))
+        request_options = {"timeout": options["timeout"]} if options.get("timeout") else None
+        try:
+            for chunk in model.generate_content(prompt, stream=True, generation_config=options.get("generation_config"),
+                                                request_options=request_options):
+                yield chunk.text
+        except Exception as e:
+            raise LLMBackendError(str(e), status=getattr(e, "code", None)) from e
+
+    def create_cache(self, content: str, ttl_seconds: int) -> str:
+        from google.generativeai import caching
+
+        try:
+            request = caching.CachedContent._prepare_create_request(
+                model=self.model_name, contents=[content], ttl=timedelta(seconds=ttl_seconds)
+            )
+            cache = caching.CachedContent._from_obj(self._clients.make_client("cache").create_cached_content(request))
+        except Exception as e:
+            raise LLMBackendError(f"Context cache creation failed: {e}", status=getattr(e, "code", None)) from e
+        self._cached_models[cache.name] = self._bind(self.genai.GenerativeModel.from_cached_content(cache))
+        return cache.name
+
+    def delete_cache(self, handle: str):
+        from google.generativeai import protos
+
+        self._cached_models.pop(handle, None)
+        try:
+            self._clients.make_client("cache").delete_cached_content(protos.DeleteCachedContentRequest(name=handle))
+        except Exception as e:
+            logger.warning(f"Failed to delete context cache {handle}: {str(e)}")
+
+    @classmethod
+    def _missing_cache_hooks(cls):
+        import importlib
+
+        missing = []
+        for module_name, path in cls.SDK_CACHE_HOOKS:
+            target = importlib.import_module(f"google.generativeai.{module_name}")
+            for attribute in path.split("."):
+                target = getattr(target, attribute, None)
+                if target is None:
+                    missing.append(f"{module_name}.{path}")
+                    break
+        return missing
+
+    def _bind(self, model):
+        # GenerativeModel falls back to the global default client when _client is unset (an internal, see above)
+        model._client = self._generative_client
+        return model
+
+    def _model_for(self, cached_content: Optional[str]):
+        if not cached_content:
+            return self.model
+        model = self._cached_models.get(cached_content)
+        if model is None:
+            from google.generativeai import caching, protos
+
+            try:
+                response = self._clients.make_client("cache").get_cached_content(
+                    protos.GetCachedContentRequest(name=cached_content)
+                )
+                model = self._bind(self.genai.GenerativeModel.from_cached_content(caching.CachedContent._from_obj(response)))
+            except Exception as e:
+                raise LLMBackendError(f"Context cache {cached_content} unavailable: {e}", status=getattr(e, "code", None)) from e
+            self._cached_models[cached_content] = model
+        return model
+
+    def _to_response(self, response) -> LLMResponse:
+        usage = getattr(response, "usage_metadata", None)
+        finish_reason = None
+        if getattr(response, "candidates", None):
+            reason = response.candidates[0].finish_reason
+            finish_reason = getattr(reason, "name", str(reason))
+        return LLMResponse(
+            text=response.text,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+            finish_reason=finish_reason,
+            cached_tokens=getattr(usage, "cached_content_token_count", 0) or 0,
+            metadata={"model": self.model_name},
+        )
+
+
+class CassetteBackend(LLMBackend):
+    """Record/replay backend keyed by a hash of the request.
+
+    In ``record`` mode every call is forwarded to ``inner`` and the response is
+    stored; in ``replay`` mode the stored response is returned unchanged and a
+    missing entry is an error, so runs never reach the network.
+    """
+
+    name = "cassette"
+
+    def __init__(self, path: str, mode: str = "replay", inner: Optional[LLMBackend] = None):
+        if mode not in ("replay", "record"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if mode == "record" and inner is None:
+            raise ValueError("Recording a cassette requires an inner backend")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        self.supports_caching = inner.supports_caching if inner is not None else True
+        self._lock = threading.Lock()
+        self._entries, self._caches = self._load()
+        self._inner_handles = {}
+
+    @staticmethod
+    def request_key(prompt: str, **options) -> str:
+        options = {k: v for k, v in options.items() if k not in TRANSPORT_OPTIONS}
+        payload = json.dumps({"prompt": prompt, "options": options}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def generate(self, prompt: str, **options) -> LLMResponse:
+        key = self.request_key(prompt, **options)
+        if self.mode == "replay":
+            entry = self._entries.get(key)
+            if entry is None:
+                raise LLMBackendError(f"No cassette entry for request {key[:12]} in {self.path}")
+            return LLMResponse.from_dict(entry["response"])
+
+        inner_options = dict(options)
+        if inner_options.get("cached_content"):
+            inner_options["cached_content"] = self._inner_handles[inner_options["cached_content"]]
+        response = self.inner.generate(prompt, **inner_options)
+        with self._lock:
+            recorded_options = {k: v for k, v in options.items() if k not in TRANSPORT_OPTIONS}
+            self._entries[key] = {"prompt": prompt, "options": recorded_options, "response": response.to_dict()}
+            self._save()
+        return response
+
+    def create_cache(self, content: str, ttl_seconds: int) -> str:
+        # Handles are derived from the cached text so replays match recordings
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        handle = f"cassette/{content_hash[:16]}"
+        if self.mode == "replay":
+            recorded = self._caches.get(content_hash)
+            if recorded is None or recorded.get("error"):
+                raise LLMBackendError((recorded or {}).get("error") or f"No cassette cache entry for {handle}")
+            return handle
+
+        try:
+            self._inner_handles[handle] = self.inner.create_cache(content, ttl_seconds)
+            recorded = {"handle": handle}
+        except Exception as e:
+            recorded = {"handle": handle, "error": str(e)}
+        with self._lock:
+            self._caches[content_hash] = recorded
+            self._save()
+        if recorded.get("error"):
+            raise LLMBackendError(recorded["error"])
+        return handle
+
+    def delete_cache(self, handle: str):
+        inner_handle = self._inner_handles.pop(handle, None)
+        if inner_handle and self.inner is not None:
+            self.inner.delete_cache(inner_handle)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            if self.mode == "replay":
+                logger.warning(f"Cassette file not found at: {self.path}")
+            return {}, {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data.get("entries", {}), data.get("caches", {})
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".cassette-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "entries": self._entries, "caches": self._caches}, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+
+class FakeServerBackend(LLMBackend):
+    """Client for the local fake model server in services/fake_llm_server.py"""
+
+    name = "fake"
+    supports_caching = True
+
+    def __init__(self, base_url: str, timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def generate(self, prompt: str, **options) -> LLMResponse:
+        timeout = options.pop("timeout", None)
+        data = self._request({"prompt": prompt, "options": options, "stream": False}, timeout=timeout).json()
+        return LLMResponse.from_dict(data)
+
+    def stream(self, prompt: str, **options) -> Iterator[str]:
+        timeout = options.pop("timeout", None)
+        response = self._request({"prompt": prompt, "options": options, "stream": True}, stream=True, timeout=timeout)
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event.get("error"):
+                raise LLMBackendError(event["error"], status=event.get("status"))
+            if "delta" in event:
+                yield event["delta"]
+
+    def create_cache(self, content: str, ttl_seconds: int) -> str:
+        return self._request({"content": content, "ttl_seconds": ttl_seconds}, path="/v1/caches").json()["name"]
+
+    def delete_cache(self, handle: str):
+        try:
+            self.session.delete(f"{self.base_url}/v1/{handle}", timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.warning(f"Failed to delete context cache {handle}: {str(e)}")
+
+    def _request(self, body: Dict[str, Any], stream: bool = False, path: str = "/v1/generate",
+                 timeout: Optional[float] = None):
+        try:
+            response = self.session.post(
+                f"{self.base_url}{path}", json=body, timeout=timeout or self.timeout, stream=stream
+            )
+        except requests.RequestException as e:
+            raise LLMBackendError(f"Fake server unreachable: {e}") from e
+        if response.status_code >= 400:
+            raise LLMBackendError(f"Fake server returned {response.status_code}: {response.text}", status=response.status_code)
+        return response
+
+
+def create_backend(kind: Optional[str] = None) -> Optional[LLMBackend]:
+    """Build the backend selected by Config.LLM_BACKEND (None when unconfigured)"""
+    kind = (kind or Config.LLM_BACKEND).lower()
+
+    if kind == "gemini":
+        from services.key_pool import KeyPoolBackend, PooledKey, key_label, parse_key_specs
+
+        specs = parse_key_specs(Config.GOOGLE_AI_API_KEYS or Config.GOOGLE_AI_API_KEY or "")
+        if not specs:
+            return None
+        if len(specs) == 1:
+            return GeminiBackend(specs[0]["api_key"], Config.GOOGLE_AI_MODEL)
+        return KeyPoolBackend([
+            PooledKey(key_label(index, spec["api_key"]), GeminiBackend(spec["api_key"], Config.GOOGLE_AI_MODEL),
+                      spec["rpm"], spec["tpm"])
+            for index, spec in enumerate(specs)
+        ])
+
+    if kind == "fake":
+        return FakeServerBackend(Config.FAKE_LLM_URL, timeout=Config.LLM_TIMEOUT_SECONDS)
+
+    if kind == "cassette":
+        inner = None
+        if Config.LLM_CASSETTE_MODE == "record":
+            inner = create_backend(Config.LLM_CASSETTE_INNER)
+        return CassetteBackend(Config.LLM_CASSETTE_PATH, mode=Config.LLM_CASSETTE_MODE, inner=inner)
+
+    raise ValueError(f"Unknown LLM backend: {kind}")
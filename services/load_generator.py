@@ -0,0 +1,367 @@
+"""Open-loop load generator for /generate-reply and /chat.
+
+Client turns from the conversation corpus are replayed at a target rate with
+Poisson arrivals. Arrival times are fixed up front and each request's latency
+is measured from its intended start, so a slow server that delays later
+requests shows up in the numbers instead of silently lowering the offered
+load (coordinated omission). Latencies go into HDR-style log-linear
+histograms and can be written in the HdrHistogram ``.hgrm`` percentile format.
+
+Several rates can be stepped through in one run to find the saturation point:
+
+    python -m services.load_generator --url http://127.0.0.1:3032 --rps 5,10,20,40 --duration 30
+
+With ``--fake-model`` the tool starts the local fake model server, and with
+``--app-command`` it also starts the app under test pointed at it, e.g.
+
+    python -m services.load_generator --fake-model lognormal:6.5:0.4 \\
+        --app-command "gunicorn app:app --workers 2 --threads 8 --bind 127.0.0.1:3032" --rps 10,20,40
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from services.conversation_corpus import iter_conversations
+from services.scenario_classifier import default_corpus_path
+
+ENDPOINTS = {
+    "generate-reply": "/generate-reply",
+    "chat": "/chat",
+}
+
+
+class LatencyHistogram:
+    """Log-linear histogram of integer values (microseconds) in the style of HdrHistogram.
+
+    Values below 2 * 10**significant_digits (rounded up to a power of two) are
+    counted exactly; above that, each power-of-two range is split into the
+    same number of sub-buckets, so every recorded value is kept within the
+    requested number of significant digits.
+    """
+
+    def __init__(self, highest_value: int = 3_600_000_000, significant_digits: int = 2):
+        self.sub_bucket_bits = math.ceil(math.log2(2 * 10 ** significant_digits))
+        self.sub_bucket_count = 1 << self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count // 2
+        self.highest_value = highest_value
+        self.counts = [0] * (self._index(highest_value) + 1)
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self._sum = 0
+        self._sum_squares = 0
+        self._lock = threading.Lock()
+
+    def _index(self, value: int) -> int:
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (shift + 1) * self.sub_bucket_half + (value >> shift) - self.sub_bucket_half
+
+    def _highest_equivalent(self, index: int) -> int:
+        if index < self.sub_bucket_count:
+            return index
+        shift = index // self.sub_bucket_half - 1
+        sub_bucket = index % self.sub_bucket_half + self.sub_bucket_half
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value: int):
+        value = min(max(0, int(value)), self.highest_value)
+        with self._lock:
+            self.counts[self._index(value)] += 1
+            self.total += 1
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = max(self.max, value)
+            self._sum += value
+            self._sum_squares += value * value
+
+    def merge(self, other: "LatencyHistogram"):
+        with self._lock:
+            for index, count in enumerate(other.counts):
+                self.counts[index] += count
+            self.total += other.total
+            if other.min is not None:
+                self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._sum += other._sum
+            self._sum_squares += other._sum_squares
+
+    def mean(self) -> float:
+        return self._sum / self.total if self.total else 0.0
+
+    def stddev(self) -> float:
+        if not self.total:
+            return 0.0
+        return math.sqrt(max(0.0, self._sum_squares / self.total - self.mean() ** 2))
+
+    def value_at_percentile(self, percentile: float) -> int:
+        if not self.total:
+            return 0
+        target = max(1, math.ceil(percentile / 100.0 * self.total))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._highest_equivalent(index), self.max)
+        return self.max
+
+    def percentiles_ms(self, percentiles=(50, 90, 99, 99.9)) -> Dict[str, float]:
+        summary = {f"p{p:g}": round(self.value_at_percentile(p) / 1000.0, 2) for p in percentiles}
+        summary["max"] = round(self.max / 1000.0, 2)
+        summary["mean"] = round(self.mean() / 1000.0, 2)
+        return summary
+
+    def to_hgrm(self, ticks_per_half_distance: int = 5) -> str:
+        """Percentile distribution in HdrHistogram's text format, values in milliseconds"""
+        lines = [f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>14}", ""]
+        if self.total:
+            percentile = 0.0
+            while True:
+                value = self.value_at_percentile(percentile)
+                count = self._count_at_or_below(value)
+                inverse = f"{1.0 / (1.0 - percentile / 100.0):14.2f}" if percentile < 100.0 else f"{'inf':>14}"
+                lines.append(f"{value / 1000.0:12.3f} {percentile / 100.0:14.12f} {count:10d} {inverse}")
+                if percentile >= 100.0:
+                    break
+                if count >= self.total:
+                    percentile = 100.0
+                    continue
+                half_distance = 2 ** (int(math.log2(100.0 / (100.0 - percentile))) + 1)
+                percentile = min(100.0, percentile + 100.0 / (half_distance * ticks_per_half_distance))
+        lines.append(f"#[Mean    = {self.mean() / 1000.0:12.3f}, StdDeviation   = {self.stddev() / 1000.0:12.3f}]")
+        lines.append(f"#[Max     = {self.max / 1000.0:12.3f}, Total count    = {self.total:12d}]")
+        lines.append(f"#[Buckets = {len(self.counts) // self.sub_bucket_half:12d}, SubBuckets     = {self.sub_bucket_count:12d}]")
+        return "\n".join(lines) + "\n"
+
+    def _count_at_or_below(self, value: int) -> int:
+        return sum(self.counts[:self._index(min(value, self.highest_value)) + 1])
+
+
+def load_turns(path: str) -> List[Dict[str, Any]]:
+    """Client turns with the history before them: consecutive client messages form one turn"""
+    turns = []
+    for conversation in iter_conversations(path):
+        history, pending = [], []
+        for message in conversation.get("conversation", []):
+            if message.get("direction") == "in":
+                pending.append(message.get("text", ""))
+                continue
+            if pending:
+                turns.append({"clientSequence": "\n".join(pending), "chatHistory": list(history),
+                              "contactId": conversation.get("contact_id")})
+                history.extend({"role": "client", "message": text} for text in pending)
+                pending = []
+            history.append({"role": "consultant", "message": message.get("text", "")})
+    if not turns:
+        raise ValueError(f"No client turns found in {path}")
+    return turns
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Parse "generate-reply=0.8,chat=0.2" into normalized endpoint weights"""
+    mix = {}
+    for part in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint in --mix: {name} (expected one of {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    total = sum(mix.values())
+    return {name: weight / total for name, weight in mix.items()}
+
+
+def build_request(endpoint: str, turn: Dict[str, Any], index: int) -> Dict[str, Any]:
+    if endpoint == "chat":
+        return {"message": turn["clientSequence"], "chat_history": turn["chatHistory"],
+                "session_id": f"load-{turn['contactId']}-{index}"}
+    return {"clientSequence": turn["clientSequence"], "chatHistory": turn["chatHistory"]}
+
+
+class LoadStep:
+    """One fixed-rate run: schedules arrivals, sends requests and collects latencies"""
+
+    def __init__(self, base_url: str, turns: List[Dict[str, Any]], mix: Dict[str, float], rps: float,
+                 duration: float, max_in_flight: int, timeout: float, rng: random.Random):
+        self.base_url = base_url.rstrip("/")
+        self.turns = turns
+        self.mix = mix
+        self.rps = rps
+        self.duration = duration
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.rng = rng
+        # Corrected: from the intended start; service: from the actual send
+        self.corrected = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.per_endpoint = {name: LatencyHistogram() for name in mix}
+        self.statuses = {}
+        self.max_send_lag_ms = 0.0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def run(self) -> Dict[str, Any]:
+        arrivals, t = [], 0.0
+        while True:
+            t += self.rng.expovariate(self.rps)
+            if t >= self.duration:
+                break
+            endpoint = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            arrivals.append((t, endpoint, self.rng.randrange(len(self.turns))))
+
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="load")
+        started = time.perf_counter() + 0.05
+        for index, (offset, endpoint, turn_index) in enumerate(arrivals):
+            intended = started + offset
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(self._send, intended, endpoint, self.turns[turn_index], index)
+        executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - started
+
+        completed = sum(self.statuses.values())
+        ok = sum(count for status, count in self.statuses.items() if status == "200")
+        return {
+            "targetRps": self.rps,
+            "offered": len(arrivals),
+            "completed": completed,
+            "achievedRps": round(ok / elapsed, 2) if elapsed > 0 else 0.0,
+            "errorRate": round(1 - ok / completed, 4) if completed else 0.0,
+            "statuses": dict(self.statuses),
+            "maxSendLagMs": round(self.max_send_lag_ms, 2),
+            "correctedMs": self.corrected.percentiles_ms(),
+            "serviceMs": self.service.percentiles_ms(),
+            "endpoints": {name: histogram.percentiles_ms() for name, histogram in self.per_endpoint.items()
+                          if histogram.total},
+        }
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _send(self, intended: float, endpoint: str, turn: Dict[str, Any], index: int):
+        sent = time.perf_counter()
+        try:
+            response = self._session().post(self.base_url + ENDPOINTS[endpoint],
+                                             json=build_request(endpoint, turn, index), timeout=self.timeout)
+            status = str(response.status_code)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        finished = time.perf_counter()
+        corrected_us = (finished - intended) * 1e6
+        self.corrected.record(corrected_us)
+        self.service.record((finished - sent) * 1e6)
+        self.per_endpoint[endpoint].record(corrected_us)
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.max_send_lag_ms = max(self.max_send_lag_ms, (sent - intended) * 1000.0)
+
+
+def wait_until_healthy(base_url: str, timeout: float = 30.0):
+    give_up_at = time.monotonic() + timeout
+    while time.monotonic() < give_up_at:
+        try:
+            if requests.get(base_url.rstrip("/") + "/health", timeout=1.0).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{base_url} did not become healthy within {timeout:.0f}s")
+
+
+def format_step(result: Dict[str, Any]) -> str:
+    corrected, service = result["correctedMs"], result["serviceMs"]
+    return (f"{result['targetRps']:>8.1f} {result['achievedRps']:>9.1f} {result['errorRate']:>7.1%} "
+            f"{corrected['p50']:>9.1f} {corrected['p99']:>9.1f} {corrected['p99.9']:>9.1f} {corrected['max']:>9.1f} "
+            f"{service['p50']:>9.1f} {service['p99']:>9.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Open-loop load generator for /generate-reply and /chat")
+    parser.add_argument("--url", default="http://127.0.0.1:3032", help="base URL of the app under test")
+    parser.add_argument("--rps", default="10", help="target request rate, or a comma-separated list of steps")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per step")
+    parser.add_argument("--mix", default="generate-reply=0.8,chat=0.2")
+    parser.add_argument("--corpus", default=None, help="conversation file (default: CONVERSATIONS_PATH or data/conversations.json)")
+    parser.add_argument("--max-in-flight", type=int, default=512, help="client-side concurrency limit")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request client timeout (seconds)")
+    parser.add_argument("--slo-p99-ms", type=float, default=None,
+                        help="stop stepping once corrected p99 exceeds this (saturation reached)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--hgrm-out", default=None, help="write <prefix>-<rps>.corrected.hgrm and .service.hgrm per step")
+    parser.add_argument("--json-out", default=None, help="write all step results as JSON")
+    parser.add_argument("--fake-model", default=None, metavar="LATENCY",
+                        help="start the fake model server with this latency spec (e.g. lognormal:6.5:0.4)")
+    parser.add_argument("--fake-model-port", type=int, default=8099)
+    parser.add_argument("--app-command", default=None,
+                        help="start the app under test with this command (LLM_BACKEND=fake when --fake-model is set)")
+    args = parser.parse_args(argv)
+
+    steps = [float(rate) for rate in args.rps.split(",") if rate.strip()]
+    mix = parse_mix(args.mix)
+    turns = load_turns(args.corpus or default_corpus_path())
+    rng = random.Random(args.seed)
+
+    fake_server, app_process = None, None
+    try:
+        env = dict(os.environ)
+        if args.fake_model:
+            from services.fake_llm_server import start_fake_server
+
+            fake_server = start_fake_server("127.0.0.1", args.fake_model_port, latency=args.fake_model)
+            env.update(LLM_BACKEND="fake", FAKE_LLM_URL=fake_server.url)
+            print(f"Fake model server on {fake_server.url} (latency {args.fake_model})")
+        if args.app_command:
+            app_process = subprocess.Popen(shlex.split(args.app_command), env=env,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_until_healthy(args.url)
+            print(f"Started app under test: {args.app_command}")
+
+        print(f"{len(turns)} client turns, mix {mix}")
+        print(f"{'target':>8} {'achieved':>9} {'errors':>7} {'c-p50':>9} {'c-p99':>9} {'c-p99.9':>9} {'c-max':>9} "
+              f"{'s-p50':>9} {'s-p99':>9}   (ms; c = corrected for coordinated omission, s = service time)")
+        results = []
+        for rps in steps:
+            step = LoadStep(args.url, turns, mix, rps, args.duration, args.max_in_flight, args.timeout, rng)
+            result = step.run()
+            results.append(result)
+            print(format_step(result), flush=True)
+            if args.hgrm_out:
+                with open(f"{args.hgrm_out}-{rps:g}.corrected.hgrm", "w") as f:
+                    f.write(step.corrected.to_hgrm())
+                with open(f"{args.hgrm_out}-{rps:g}.service.hgrm", "w") as f:
+                    f.write(step.service.to_hgrm())
+            if args.slo_p99_ms is not None and result["correctedMs"]["p99"] > args.slo_p99_ms:
+                print(f"Corrected p99 above {args.slo_p99_ms:g}ms at {rps:g} rps; stopping")
+                break
+
+        if args.json_out:
+            with open(args.json_out, "w") as f:
+                json.dump(results, f, indent=2)
+        return 0
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            try:
+                app_process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                app_process.kill()
+        if fake_server is not None:
+            fake_server.shutdown()
+            fake_server.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
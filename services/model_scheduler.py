@@ -0,0 +1,333 @@
+"""Priority scheduler for model calls.
+
+Every backend call made by GoogleAIService takes a slot from this scheduler
+first. Calls belong to a priority class: interactive replies, admin prompt
+edits, or batch work (improvement jobs, shadow evaluation). When slots are
+short, waiting calls are dispatched by weighted fair queuing across classes,
+and round-robin across sessions within a class so one busy session cannot
+hold up the others. While no interactive call is waiting, background classes
+may not take the last MODEL_INTERACTIVE_RESERVED_SLOTS slots, so a new reply
+finds a free slot instead of queueing behind background work; under
+interactive overload the class weights keep background work from starving.
+
+Before queueing here, a call passes its tenant's own limits (TENANT_LIMITS,
+or TENANT_MAX_CONCURRENCY and TENANT_MODEL_CALLS_PER_MINUTE): a tenant at its
+concurrency limit waits outside the shared queue, so its spike cannot take
+the slots other tenants need. Over the per-minute quota, request calls fail
+with TenantQuotaExceeded while batch work waits for the next minute.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Optional
+
+from config import Config
+from services.llm_backends import LLMBackendError
+from utils.tenancy import TenantQuotaExceeded, current_tenant, tenant_limits
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_ADMIN = "admin"
+PRIORITY_BATCH = "batch"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_ADMIN, PRIORITY_BATCH)
+
+# Class used when the caller did not set one
+STAGE_PRIORITIES = {
+    "generate_reply": PRIORITY_INTERACTIVE,
+    "manual_improve_prompt": PRIORITY_ADMIN,
+    "improve_prompt": PRIORITY_BATCH,
+}
+
+# Wait times kept per class for the percentiles
+MAX_WAIT_SAMPLES = 1000
+
+_current_priority = contextvars.ContextVar('model_priority', default=None)
+_current_session = contextvars.ContextVar('model_session', default=None)
+
+
+@contextlib.contextmanager
+def model_priority(priority: str, session: Optional[str] = None):
+    """Run model calls in this block under the given class (and fairness session)"""
+    priority_token = _current_priority.set(priority)
+    session_token = _current_session.set(session) if session is not None else None
+    try:
+        yield
+    finally:
+        if session_token is not None:
+            _current_session.reset(session_token)
+        _current_priority.reset(priority_token)
+
+
+def set_model_session(session: Optional[str]):
+    """Fairness session for model calls in the current context; returns a token for reset_model_session()"""
+    return _current_session.set(session)
+
+
+def reset_model_session(token):
+    _current_session.reset(token)
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Parse "interactive:16,admin:4,batch:1"; classes left out keep weight 1"""
+    weights = {priority: 1.0 for priority in PRIORITY_CLASSES}
+    for part in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, weight = part.partition(":")
+        if name not in weights:
+            raise ValueError(f"Unknown priority class in MODEL_PRIORITY_WEIGHTS: {name}")
+        weights[name] = float(weight)
+    return weights
+
+
+class _Waiter:
+    __slots__ = ("priority", "session", "enqueued", "granted")
+
+    def __init__(self, priority, session):
+        self.priority = priority
+        self.session = session
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class _ClassQueue:
+    def __init__(self, weight: float):
+        self.weight = weight
+        # session -> deque of waiters; sessions are served round-robin
+        self.sessions = OrderedDict()
+        self.depth = 0
+        # Virtual start tag of the call at the head of the queue, finish tag of the last dispatched one
+        self.start_tag = 0.0
+        self.finish_tag = 0.0
+        self.in_flight = 0
+        self.waits = deque(maxlen=MAX_WAIT_SAMPLES)
+        self.stats = {"dispatched": 0, "timed_out": 0, "max_depth": 0}
+
+    def push(self, waiter: _Waiter):
+        self.sessions.setdefault(waiter.session, deque()).append(waiter)
+        self.depth += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.depth)
+
+    def pop(self) -> _Waiter:
+        session, waiters = next(iter(self.sessions.items()))
+        waiter = waiters.popleft()
+        del self.sessions[session]
+        if waiters:
+            self.sessions[session] = waiters
+        self.depth -= 1
+        return waiter
+
+    def remove(self, waiter: _Waiter):
+        waiters = self.sessions.get(waiter.session)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self.depth -= 1
+            if not waiters:
+                del self.sessions[waiter.session]
+
+
+class TenantLimiter:
+    """Per-tenant cap on model calls in flight and on calls started per minute"""
+
+    def __init__(self):
+        self._tenants = {}
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def acquire(self, tenant: str, priority: str, timeout: Optional[float] = None):
+        concurrency, per_minute = tenant_limits(tenant)
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            state = self._state(tenant)
+            while True:
+                now = time.monotonic()
+                while state["starts"] and now - state["starts"][0] > 60.0:
+                    state["starts"].popleft()
+                over_quota = per_minute and len(state["starts"]) >= per_minute
+                if over_quota and priority != PRIORITY_BATCH:
+                    state["stats"]["rejected"] += 1
+                    raise TenantQuotaExceeded(tenant, per_minute, 60.0 - (now - state["starts"][0]))
+                if not over_quota and (not concurrency or state["inFlight"] < concurrency):
+                    break
+                remaining = give_up_at - now if give_up_at is not None else None
+                if remaining is not None and remaining <= 0:
+                    state["stats"]["timed_out"] += 1
+                    raise LLMBackendError(f"Timed out waiting for tenant {tenant}'s model-call limit", status=503)
+                state["stats"]["waited"] += 1
+                # Over quota: until the oldest call leaves the window; at the concurrency limit: until a release
+                wait = 60.0 - (now - state["starts"][0]) if over_quota else None
+                if remaining is not None:
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._released.wait(wait)
+            state["inFlight"] += 1
+            state["starts"].append(now)
+            state["stats"]["calls"] += 1
+
+    def release(self, tenant: str):
+        with self._lock:
+            self._tenants[tenant]["inFlight"] -= 1
+            self._released.notify_all()
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            report = {}
+            for tenant, state in self._tenants.items():
+                concurrency, per_minute = tenant_limits(tenant)
+                report[tenant] = dict(
+                    state["stats"],
+                    inFlight=state["inFlight"],
+                    callsLastMinute=sum(1 for started in state["starts"] if now - started <= 60.0),
+                    maxConcurrency=concurrency,
+                    maxPerMinute=per_minute
+                )
+            return report
+
+    def _state(self, tenant: str) -> Dict[str, Any]:
+        # Caller holds self._lock
+        state = self._tenants.get(tenant)
+        if state is None:
+            state = self._tenants[tenant] = {"inFlight": 0, "starts": deque(),
+                                             "stats": {"calls": 0, "waited": 0, "rejected": 0, "timed_out": 0}}
+        return state
+
+
+class ModelCallScheduler:
+    def __init__(self, capacity: int = None, interactive_reserved: int = None, weights: Dict[str, float] = None):
+        self.capacity = capacity or Config.MODEL_MAX_CONCURRENCY
+        reserved = interactive_reserved if interactive_reserved is not None else Config.MODEL_INTERACTIVE_RESERVED_SLOTS
+        self.interactive_reserved = min(reserved, self.capacity - 1)
+        weights = weights or parse_weights(Config.MODEL_PRIORITY_WEIGHTS)
+        self._queues = {priority: _ClassQueue(weights[priority]) for priority in PRIORITY_CLASSES}
+        self._in_flight = 0
+        self._abandoned = 0
+        self._virtual_time = 0.0
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self.tenants = TenantLimiter()
+
+    @contextlib.contextmanager
+    def slot(self, stage: str, timeout: Optional[float] = None):
+        """Hold a model-call slot for the duration of the block"""
+        priority = _current_priority.get() or STAGE_PRIORITIES.get(stage, PRIORITY_INTERACTIVE)
+        tenant = current_tenant()
+        # Sessions of different tenants may share IDs
+        session = f"{tenant}:{_current_session.get() or priority}"
+        started = time.monotonic()
+        self.tenants.acquire(tenant, priority, timeout)
+        try:
+            self._acquire(priority, session, max(0.0, timeout - (time.monotonic() - started)) if timeout is not None else None)
+        except BaseException:
+            self.tenants.release(tenant)
+            raise
+
+        def release():
+            self._release(priority)
+            self.tenants.release(tenant)
+
+        abandoned = None
+        try:
+            yield
+        except BaseException as e:
+            abandoned = getattr(e, 'abandoned_call', None)
+            raise
+        finally:
+            if abandoned is not None and not abandoned.done():
+                # The request gave up but the backend call still runs; its slot stays taken until it returns
+                with self._lock:
+                    self._abandoned += 1
+                abandoned.add_done_callback(lambda _: self._release_abandoned(release))
+            else:
+                release()
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            classes = {}
+            for priority, queue in self._queues.items():
+                waits = sorted(queue.waits)
+                classes[priority] = dict(
+                    queue.stats,
+                    weight=queue.weight,
+                    queueDepth=queue.depth,
+                    waitingSessions=len(queue.sessions),
+                    inFlight=queue.in_flight,
+                    p50WaitMs=_percentile(waits, 0.5),
+                    p95WaitMs=_percentile(waits, 0.95),
+                    p99WaitMs=_percentile(waits, 0.99),
+                )
+            return {
+                "capacity": self.capacity,
+                "interactiveReserved": self.interactive_reserved,
+                "inFlight": self._in_flight,
+                "abandonedInFlight": self._abandoned,
+                "classes": classes,
+                "tenants": self.tenants.report(),
+            }
+
+    def _acquire(self, priority: str, session: str, timeout: Optional[float]):
+        waiter = _Waiter(priority, session)
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            queue = self._queues[priority]
+            if queue.depth == 0:
+                # A class that was idle starts at the current virtual time, not with saved-up credit
+                queue.start_tag = max(queue.finish_tag, self._virtual_time)
+            queue.push(waiter)
+            self._dispatch()
+            while not waiter.granted:
+                remaining = give_up_at - time.monotonic() if give_up_at is not None else None
+                if remaining is not None and remaining <= 0:
+                    queue.remove(waiter)
+                    queue.stats["timed_out"] += 1
+                    raise LLMBackendError(f"Timed out waiting for a model slot ({priority})", status=503)
+                self._slot_freed.wait(remaining)
+
+    def _release_abandoned(self, release: Callable[[], None]):
+        with self._lock:
+            self._abandoned -= 1
+        release()
+
+    def _release(self, priority: str):
+        with self._lock:
+            self._in_flight -= 1
+            self._queues[priority].in_flight -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        # Caller holds self._lock
+        granted = False
+        while self._in_flight < self.capacity:
+            queue = self._next_queue()
+            if queue is None:
+                break
+            waiter = queue.pop()
+            # Start-time fair queuing: each dispatched call advances its class by 1/weight
+            self._virtual_time = queue.start_tag
+            queue.finish_tag = queue.start_tag + 1.0 / queue.weight
+            queue.start_tag = queue.finish_tag
+            waiter.granted = True
+            self._in_flight += 1
+            queue.in_flight += 1
+            queue.stats["dispatched"] += 1
+            queue.waits.append((time.monotonic() - waiter.enqueued) * 1000.0)
+            granted = True
+        if granted:
+            self._slot_freed.notify_all()
+
+    def _next_queue(self) -> Optional[_ClassQueue]:
+        # Reserved slots are headroom for interactive bursts: background classes may not take them
+        # while no interactive call waits. Once interactive calls queue, the weights decide.
+        interactive_waiting = self._queues[PRIORITY_INTERACTIVE].depth > 0
+        background_full = self._in_flight >= self.capacity - self.interactive_reserved and not interactive_waiting
+        candidates = [
+            queue for priority, queue in self._queues.items()
+            if queue.depth and (priority == PRIORITY_INTERACTIVE or not background_full)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda queue: queue.start_tag + 1.0 / queue.weight)
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))], 2)
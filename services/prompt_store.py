@@ -0,0 +1,352 @@
+"""Versioned prompt history with a local snapshot for cold start.
+
+Every prompt change appends a version entry {version, hash, createdAt,
+source, rollbackOf}. Prompt texts are stored once per content hash as blobs;
+a blob is either a keyframe (full text) or a line delta against its parent
+blob, with a keyframe at least every PROMPT_HISTORY_KEYFRAME_INTERVAL links so
+reading any version replays a bounded number of deltas. A rollback appends a
+version pointing at an existing hash, so it writes no text at all.
+
+Firestore holds the shared history (``ai_config/chat_prompt`` is the head,
+with ``versions`` and ``blobs`` subcollections; other tenants have the same
+layout under ``tenants/{tenant}``). This module keeps a replica per tenant
+in memory and in PROMPT_SNAPSHOT_PATH (``tenants/<tenant>/`` beside it for
+other tenants), written atomically after every change,
+so a worker serves the current prompt from disk before it has talked to
+Firestore. A listener on the head document pulls changes made by other
+workers. Without Firestore the snapshot file is the only store.
+"""
+import difflib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import Config
+from utils.deadline import downstream_timeout
+from utils.logger import logger
+from utils.tenancy import current_tenant
+
+SNAPSHOT_FORMAT = 1
+# Decoded texts kept in memory; blobs are immutable so entries never go stale
+TEXT_CACHE_SIZE = 32
+
+
+def make_delta(base: str, text: str) -> List[Any]:
+    """Line delta turning base into text: [start, end] copies base lines, strings are inserted"""
+    base_lines = base.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append(''.join(lines[j1:j2]))
+    return delta
+
+
+def apply_delta(base: str, delta: List[Any]) -> str:
+    base_lines = base.splitlines(keepends=True)
+    return ''.join(''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in delta)
+
+
+def encode_blob(text: str, parent_hash: Optional[str], parent_text: Optional[str], parent_depth: int) -> Dict[str, Any]:
+    """Blob for text: a delta against the parent unless a keyframe is due or the delta is not smaller"""
+    if parent_hash and parent_text is not None and parent_depth + 1 < Config.PROMPT_HISTORY_KEYFRAME_INTERVAL:
+        delta = make_delta(parent_text, text)
+        if len(json.dumps(delta)) < len(text):
+            return {'base': parent_hash, 'delta': delta, 'depth': parent_depth + 1}
+    return {'text': text, 'depth': 0}
+
+
+def new_entry(version: int, content_hash: str, source: str, rollback_of: Optional[int] = None) -> Dict[str, Any]:
+    return {'version': version, 'hash': content_hash, 'createdAt': time.time(), 'source': source, 'rollbackOf': rollback_of}
+
+
+class PromptVersionStore:
+    def __init__(self, path: str = None, tenant: str = None):
+        self.path = path or Config.PROMPT_SNAPSHOT_PATH
+        self.tenant = tenant or Config.DEFAULT_TENANT
+        self.head = None
+        self.versions = []
+        self.blobs = {}
+        self.source = None
+        self._texts = OrderedDict()
+        self._lock = threading.RLock()
+        self.loaded = False
+        self._watch = None
+        # Versions whose changes the head prompt still contains, keyed by head version
+        self._lineage = (None, frozenset())
+
+    def ensure_loaded(self):
+        """Load the local snapshot once; start syncing with Firestore in the background"""
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            self._load_snapshot()
+            self.loaded = True
+        from services import database_service
+
+        if not database_service.db:
+            self.source = self.source or 'local'
+        else:
+            threading.Thread(target=self._watch_head, name='prompt-store-sync', daemon=True).start()
+            if self.head is None:
+                # First start on this host: nothing on disk to serve from yet
+                try:
+                    self.sync()
+                except Exception as e:
+                    logger.error(f"Initial prompt sync failed: {str(e)}")
+
+    def current(self) -> Optional[Tuple[str, int, str]]:
+        """(prompt, version, hash) of the head, or None when nothing is known yet"""
+        with self._lock:
+            if self.head is None:
+                return None
+            return self.text(self.head['hash']), self.head['version'], self.head['hash']
+
+    def text(self, content_hash: str) -> str:
+        with self._lock:
+            cached = self._texts.get(content_hash)
+            if cached is not None:
+                self._texts.move_to_end(content_hash)
+                return cached
+            # Walk back to the nearest keyframe, then replay the deltas forward
+            chain = []
+            blob = self.blobs[content_hash]
+            while 'text' not in blob:
+                chain.append(blob)
+                blob = self.blobs[blob['base']]
+            text = blob['text']
+            for link in reversed(chain):
+                text = apply_delta(text, link['delta'])
+            self._texts[content_hash] = text
+            if len(self._texts) > TEXT_CACHE_SIZE:
+                self._texts.popitem(last=False)
+            return text
+
+    def version_entry(self, version: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            # Versions are appended in order, so position is version - first version
+            if not self.versions:
+                return None
+            index = version - self.versions[0]['version']
+            if 0 <= index < len(self.versions) and self.versions[index]['version'] == version:
+                return self.versions[index]
+            return next((entry for entry in self.versions if entry['version'] == version), None)
+
+    def list_versions(self, limit: int = 20, before: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = [entry for entry in reversed(self.versions) if before is None or entry['version'] < before]
+            return [dict(entry) for entry in entries[:limit]]
+
+    def in_lineage(self, version: int) -> bool:
+        """Whether the head prompt still contains the change made by version (no rollback went past it)"""
+        with self._lock:
+            if self.head is None:
+                return False
+            head_version = self.head['version']
+            if self._lineage[0] != head_version:
+                self._lineage = (head_version, frozenset(self._walk_lineage(head_version)))
+            first_known = self.versions[0]['version'] if self.versions else head_version
+            return version in self._lineage[1] or version < first_known
+
+    def _walk_lineage(self, version: int):
+        # Step back one version at a time; a rollback continues from the version it restored
+        first_known = self.versions[0]['version'] if self.versions else version
+        while version >= first_known:
+            yield version
+            entry = self.version_entry(version)
+            rollback_of = entry.get('rollbackOf') if entry else None
+            version = rollback_of if rollback_of is not None and rollback_of < version else version - 1
+
+    def commit_local(self, text: str, content_hash: str, expected_version: Optional[int],
+                     source: str, rollback_of: Optional[int]) -> Dict[str, Any]:
+        """Append a version when there is no Firestore; the snapshot file is the whole store"""
+        from services.database_service import PromptVersionConflict
+
+        with self._lock:
+            current_version = self.head['version'] if self.head else 0
+            if expected_version is not None and current_version != expected_version:
+                raise PromptVersionConflict(expected_version, current_version)
+            blobs = {}
+            if content_hash not in self.blobs:
+                parent_hash = self.head['hash'] if self.head else None
+                parent_text = self.text(parent_hash) if parent_hash else None
+                blobs[content_hash] = encode_blob(text, parent_hash, parent_text, self.blob_depth(parent_hash))
+            entry = new_entry(current_version + 1, content_hash, source, rollback_of)
+            self.apply(entry, blobs)
+            return entry
+
+    def apply(self, entry: Dict[str, Any], blobs: Dict[str, Dict[str, Any]], text: str = None):
+        """Record a committed version (and any blobs it introduced) and persist the snapshot"""
+        with self._lock:
+            self.blobs.update(blobs)
+            if entry['hash'] not in self.blobs and text is not None:
+                # Blob already existed in Firestore but not in this replica
+                self.blobs[entry['hash']] = {'text': text, 'depth': 0}
+            if self.version_entry(entry['version']) is None:
+                self.versions.append(entry)
+                self.versions.sort(key=lambda e: e['version'])
+            if self.head is None or entry['version'] >= self.head['version']:
+                self.head = {'version': entry['version'], 'hash': entry['hash']}
+            self.source = self.source or 'local'
+            self.save_snapshot()
+
+    def blob_depth(self, content_hash: Optional[str]) -> int:
+        with self._lock:
+            blob = self.blobs.get(content_hash) if content_hash else None
+            return blob['depth'] if blob else 0
+
+    def save_snapshot(self):
+        """Write the replica with write-to-temp, fsync and rename so readers never see a partial file"""
+        with self._lock:
+            data = {'format': SNAPSHOT_FORMAT, 'head': self.head, 'versions': self.versions, 'blobs': self.blobs}
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.prompt_snapshot-')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError:
+                pass
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'tenant': self.tenant,
+                'source': self.source,
+                'head': self.head,
+                'versions': len(self.versions),
+                'blobs': len(self.blobs),
+                'keyframes': sum(1 for blob in self.blobs.values() if 'text' in blob),
+                'snapshotPath': os.path.abspath(self.path)
+            }
+
+    def sync(self):
+        """Pull versions and blobs newer than the local replica from Firestore"""
+        from services import database_service
+
+        prompt_ref = database_service.prompt_ref(self.tenant)
+        head_doc = prompt_ref.get(timeout=downstream_timeout('get_prompt'))
+        if not head_doc.exists:
+            return
+        head = head_doc.to_dict()
+        with self._lock:
+            known = self.versions[-1]['version'] if self.versions else -1
+        entries = [doc.to_dict() for doc in prompt_ref.collection('versions')
+                   .where('version', '>', known).order_by('version').stream()]
+        blobs = {}
+        for entry in entries:
+            self._fetch_blob_chain(prompt_ref, entry['hash'], blobs)
+
+        with self._lock:
+            self.blobs.update(blobs)
+            for entry in entries:
+                if self.version_entry(entry['version']) is None:
+                    self.versions.append(entry)
+            head_version = head.get('version', 0)
+            if self.head is None or head_version > self.head['version']:
+                content_hash = head.get('hash')
+                if content_hash is None or content_hash not in self.blobs:
+                    # Head written before the history existed: keep its text as a keyframe
+                    from services.database_service import prompt_hash
+                    content_hash = prompt_hash(head['prompt'])
+                    self.blobs.setdefault(content_hash, {'text': head['prompt'], 'depth': 0})
+                    if self.version_entry(head_version) is None:
+                        self.versions.append(new_entry(head_version, content_hash, 'imported'))
+                self.versions.sort(key=lambda e: e['version'])
+                self.head = {'version': head_version, 'hash': content_hash}
+            self.source = 'firestore'
+            self.save_snapshot()
+
+    def _fetch_blob_chain(self, prompt_ref, content_hash, blobs):
+        while content_hash and content_hash not in blobs and content_hash not in self.blobs:
+            doc = prompt_ref.collection('blobs').document(content_hash).get(timeout=downstream_timeout('get_prompt'))
+            if not doc.exists:
+                raise KeyError(f"Prompt blob {content_hash} missing from Firestore")
+            blob = doc.to_dict()
+            blobs[content_hash] = blob
+            content_hash = blob.get('base')
+
+    def _watch_head(self):
+        from services import database_service
+
+        try:
+            prompt_ref = database_service.prompt_ref(self.tenant)
+            self._watch = prompt_ref.on_snapshot(self._on_head_change)
+        except Exception as e:
+            logger.error(f"Prompt history listener failed to start: {str(e)}")
+
+    def _on_head_change(self, docs, _changes, _read_time):
+        with self._lock:
+            local_version = self.head['version'] if self.head else -1
+        if any(doc.exists and doc.to_dict().get('version', 0) > local_version for doc in docs) or self.source != 'firestore':
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Prompt history sync failed: {str(e)}")
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('format') != SNAPSHOT_FORMAT:
+                logger.warning(f"Ignoring prompt snapshot with format {data.get('format')}")
+                return
+            self.head = data.get('head')
+            self.versions = data.get('versions', [])
+            self.blobs = data.get('blobs', {})
+            self.source = 'snapshot'
+            logger.info(f"Loaded prompt snapshot (version {self.head['version'] if self.head else None})")
+        except Exception as e:
+            logger.error(f"Failed to read prompt snapshot {self.path}: {str(e)}")
+
+
+def tenant_snapshot_path(tenant: str) -> str:
+    """Snapshot file of a tenant other than the default: tenants/<tenant>/ next to PROMPT_SNAPSHOT_PATH"""
+    directory, name = os.path.split(Config.PROMPT_SNAPSHOT_PATH)
+    return os.path.join(directory, 'tenants', tenant, name)
+
+
+def prompt_store_for(tenant: str = None) -> PromptVersionStore:
+    """Prompt history of tenant (the current request's tenant by default), created on first use"""
+    tenant = tenant or current_tenant()
+    store = _stores.get(tenant)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(tenant)
+            if store is None:
+                store = _stores[tenant] = PromptVersionStore(tenant_snapshot_path(tenant), tenant)
+    return store
+
+
+def prompt_stores() -> List[PromptVersionStore]:
+    with _stores_lock:
+        return list(_stores.values())
+
+
+prompt_store = PromptVersionStore()
+_stores = {Config.DEFAULT_TENANT: prompt_store}
+_stores_lock = threading.Lock()
@@ -0,0 +1,188 @@
+"""Local scenario classifier for incoming client messages.
+
+Multinomial naive Bayes over hashed word unigrams and bigrams, trained from
+the client ("in") messages of the conversation corpus and labelled with each
+conversation's scenario. Prediction touches only the handful of hashed
+feature columns present in the message, so it runs in microseconds.
+
+    python -m services.scenario_classifier train data/conversations.json
+    python -m services.scenario_classifier predict "Can I train Muay Thai on the DTV?"
+"""
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from config import Config
+from services.conversation_corpus import iter_conversations
+from utils.logger import logger
+from utils.tracing import set_span_attributes, traced
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def scenario_key(scenario: str) -> str:
+    """Stable identifier for a scenario label, e.g. 'muay_thai_training_dtv_detailed_process'"""
+    return "_".join(TOKEN_PATTERN.findall(scenario.lower()))
+
+
+def hashed_features(text: str, n_features: int):
+    """Return (feature indexes, counts) for the unigrams and bigrams of text"""
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    if not grams:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.int64, count=len(grams))
+    indexes, counts = np.unique(hashes % n_features, return_counts=True)
+    return indexes, counts.astype(np.float64)
+
+
+class ScenarioClassifier:
+    """Multinomial naive Bayes with Laplace smoothing over hashed n-grams"""
+
+    def __init__(self, labels: List[str], log_prior: np.ndarray, log_likelihood: np.ndarray):
+        self.labels = labels
+        self.log_prior = log_prior
+        # Stored feature-major so a prediction gathers a few contiguous rows
+        self.log_likelihood = np.ascontiguousarray(log_likelihood)
+        self.n_features = log_likelihood.shape[0]
+
+    @classmethod
+    def train(cls, corpus_path: str, n_features: int = None, alpha: float = 1.0) -> "ScenarioClassifier":
+        n_features = n_features or Config.CLASSIFIER_FEATURES
+        label_index = {}
+        feature_counts = []
+        doc_counts = []
+
+        for conversation in iter_conversations(corpus_path):
+            label = scenario_key(conversation.get("scenario", "unknown"))
+            if label not in label_index:
+                label_index[label] = len(label_index)
+                feature_counts.append(np.zeros(n_features, dtype=np.float64))
+                doc_counts.append(0)
+            row = label_index[label]
+            for message in conversation.get("conversation", []):
+                if message.get("direction") != "in":
+                    continue
+                indexes, counts = hashed_features(message.get("text", ""), n_features)
+                np.add.at(feature_counts[row], indexes, counts)
+                doc_counts[row] += 1
+
+        if not label_index:
+            raise ValueError(f"No conversations found in {corpus_path}")
+
+        counts = np.vstack(feature_counts) + alpha
+        log_likelihood = np.log(counts) - np.log(counts.sum(axis=1, keepdims=True))
+        docs = np.asarray(doc_counts, dtype=np.float64) + 1.0
+        log_prior = np.log(docs / docs.sum())
+        labels = sorted(label_index, key=label_index.get)
+        return cls(labels, log_prior, log_likelihood.T.astype(np.float32))
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Return (scenario key, posterior probability) for text"""
+        indexes, counts = hashed_features(text, self.n_features)
+        scores = self.log_prior + counts @ self.log_likelihood[indexes]
+        best = int(np.argmax(scores))
+        probabilities = np.exp(scores - scores[best])
+        return self.labels[best], float(1.0 / probabilities.sum())
+
+    def save(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, labels=np.array(self.labels), log_prior=self.log_prior,
+                            log_likelihood=self.log_likelihood)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ScenarioClassifier":
+        with np.load(path) as data:
+            return cls([str(label) for label in data["labels"]], data["log_prior"], data["log_likelihood"])
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+# After a failed load or training run, requests use the default prompt until this time
+_unavailable_until = 0.0
+
+
+def default_corpus_path() -> str:
+    return Config.CONVERSATIONS_PATH or os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'conversations.json')
+
+
+def get_classifier() -> Optional[ScenarioClassifier]:
+    """Load the persisted model, training it from the corpus on first use.
+
+    A failure is logged once and cached for CLASSIFIER_RETRY_SECONDS, during
+    which None is returned without retrying.
+    """
+    global _classifier, _unavailable_until
+    if _classifier is not None:
+        return _classifier
+    if time.monotonic() < _unavailable_until:
+        return None
+    with _classifier_lock:
+        if _classifier is None and time.monotonic() >= _unavailable_until:
+            try:
+                if os.path.exists(Config.CLASSIFIER_MODEL_PATH):
+                    _classifier = ScenarioClassifier.load(Config.CLASSIFIER_MODEL_PATH)
+                else:
+                    _classifier = ScenarioClassifier.train(default_corpus_path())
+                    _classifier.save(Config.CLASSIFIER_MODEL_PATH)
+                    logger.info(f"Trained scenario classifier with {len(_classifier.labels)} scenarios")
+            except Exception as e:
+                _unavailable_until = time.monotonic() + Config.CLASSIFIER_RETRY_SECONDS
+                logger.error(f"Scenario classifier unavailable for {Config.CLASSIFIER_RETRY_SECONDS}s: {str(e)}")
+                return None
+    return _classifier
+
+
+@traced('classifier.classify')
+def classify_scenario(text: str) -> Tuple[Optional[str], float]:
+    """Scenario key for text, or (None, confidence) when routing is off or confidence is low"""
+    if not Config.SCENARIO_ROUTING_ENABLED:
+        return None, 0.0
+    classifier = get_classifier()
+    if classifier is None:
+        return None, 0.0
+    label, confidence = classifier.predict(text)
+    set_span_attributes({'scenario.label': label, 'scenario.confidence': round(float(confidence), 3)})
+    if confidence < Config.CLASSIFIER_MIN_CONFIDENCE:
+        return None, confidence
+    return label, confidence
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scenario classifier")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train = commands.add_parser("train", help="train from a conversation corpus and save the model")
+    train.add_argument("corpus", nargs="?", default=None)
+    train.add_argument("--output", default=None)
+    predict = commands.add_parser("predict", help="classify a client message")
+    predict.add_argument("text")
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        classifier = ScenarioClassifier.train(args.corpus or default_corpus_path())
+        output = args.output or Config.CLASSIFIER_MODEL_PATH
+        classifier.save(output)
+        print(f"Saved classifier with {len(classifier.labels)} scenarios to {output}")
+    else:
+        classifier = get_classifier()
+        if classifier is None:
+            print(f"No classifier available: {Config.CLASSIFIER_MODEL_PATH} could not be loaded or trained "
+                  f"(see the log above)", file=sys.stderr)
+            return 1
+        label, confidence = classifier.predict(args.text)
+        print(f"{label}\t{confidence:.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
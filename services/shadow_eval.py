@@ -0,0 +1,302 @@
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from config import Config
+from services.database_service import PromptVersionConflict, get_prompt_with_version, update_prompt
+from services.model_scheduler import PRIORITY_BATCH, model_priority
+from utils.logger import logger
+from utils.tenancy import is_default_tenant, tenant_context
+
+CANDIDATE_QUEUED = "queued"
+CANDIDATE_SHADOWING = "shadowing"
+CANDIDATE_PROMOTED = "promoted"
+CANDIDATE_REJECTED = "rejected"
+CANDIDATE_SUPERSEDED = "superseded"
+
+# Paired samples kept per candidate for the latency percentiles
+MAX_SAMPLES = 1000
+
+
+class ShadowEvaluator:
+    """Evaluates a candidate prompt on sampled live /generate-reply traffic.
+
+    Prompt edits are staged as a candidate instead of being committed. A
+    sample of live requests is replayed against the candidate on a
+    background pool, and its latency, token usage and failure rate are
+    recorded next to the primary prompt's for the same requests. Once enough
+    samples are in, the candidate is promoted (committed as the new prompt)
+    or rejected, based on the configured thresholds.
+
+    Edits proposed while a candidate is being evaluated build on it and are
+    queued as the next candidate (later edits merge into the queued one), so
+    a running evaluation is never thrown away; the queued candidate starts
+    once the current one is decided. Feedback staged in a candidate is only
+    recorded as applied for deduplication when the candidate is promoted.
+
+    Shadowing covers the default tenant's prompt; other tenants' edits are
+    committed directly.
+    """
+
+    def __init__(self, ai_service, sample_rate: float = None, workers: int = None, max_pending: int = None,
+                 dedup=None):
+        self.ai_service = ai_service
+        self.dedup = dedup
+        self.sample_rate = sample_rate if sample_rate is not None else Config.SHADOW_SAMPLE_RATE
+        self.workers = workers or Config.SHADOW_WORKERS
+        self.max_pending = max_pending or Config.SHADOW_MAX_PENDING
+
+        self._candidate = None
+        self._queued = None
+        self._history = deque(maxlen=20)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.stats = {"shadowed": 0, "dropped": 0, "promotions": 0, "rejections": 0}
+
+    @staticmethod
+    def enabled() -> bool:
+        return Config.PROMPT_ROLLOUT_MODE == "shadow" and is_default_tenant()
+
+    def propose(self, prompt: str, source: str, applied: List = None) -> Dict[str, Any]:
+        """Stage a prompt edit (built on working_prompt()) as the candidate, or queue it behind the one being evaluated.
+
+        applied lists the (job_id, signature) pairs of the feedback in the
+        edit; they are recorded with the deduplicator if it is promoted.
+        """
+        _, base_version = get_prompt_with_version()
+        with self._lock:
+            if self._queued is not None:
+                # The queued edit was built on too, so the newest prompt carries both
+                queued = self._queued
+                queued.update(prompt=prompt, merges=queued["merges"] + 1)
+                queued["applied"].extend(applied or [])
+                public = self._public(queued)
+                logger.info(f"Prompt edit from {source} merged into queued candidate {queued['candidateId']}")
+                return public
+            candidate = _new_candidate(prompt, source, applied)
+            if self._candidate is not None:
+                candidate["status"] = CANDIDATE_QUEUED
+                self._queued = candidate
+                logger.info(f"Prompt candidate {candidate['candidateId']} from {source} queued behind "
+                            f"{self._candidate['candidateId']}")
+            else:
+                candidate.update(status=CANDIDATE_SHADOWING, baseVersion=base_version)
+                self._candidate = candidate
+                logger.info(f"Prompt candidate {candidate['candidateId']} from {source} is now shadowing")
+            return self._public(candidate)
+
+    def working_prompt(self) -> Optional[str]:
+        """Prompt of the newest staged edit (queued, else being evaluated), so further edits build on it"""
+        with self._lock:
+            latest = self._queued or self._candidate
+            return latest["prompt"] if latest else None
+
+    def maybe_shadow(self, client_sequence: str, chat_history: List[Dict[str, str]], primary_result: Dict[str, Any]):
+        """Replay a served request against the candidate in the background (sampled)"""
+        if not is_default_tenant():
+            return
+        with self._lock:
+            candidate = self._candidate
+            if candidate is None or random.random() >= self.sample_rate:
+                return
+            if self._pending >= self.max_pending:
+                self.stats["dropped"] += 1
+                return
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="shadow-eval")
+        self._executor.submit(self._evaluate, candidate, client_sequence, list(chat_history), primary_result)
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            candidate = self._public(self._candidate) if self._candidate else None
+            queued = self._public(self._queued) if self._queued else None
+            history = [self._public(c) for c in self._history]
+            return {
+                "mode": Config.PROMPT_ROLLOUT_MODE,
+                "sampleRate": self.sample_rate,
+                "candidate": candidate,
+                "queued": queued,
+                "history": history,
+                "stats": dict(self.stats, pending=self._pending),
+            }
+
+    def promote(self, reason: str = "promoted manually") -> Optional[Dict[str, Any]]:
+        """Commit the current candidate as the production prompt"""
+        with self._lock:
+            candidate = self._candidate
+        if candidate is None:
+            return None
+        self._promote(candidate, reason)
+        with self._lock:
+            return self._public(candidate)
+
+    def reject(self, reason: str = "rejected manually") -> Optional[Dict[str, Any]]:
+        with self._lock:
+            candidate = self._candidate
+            if candidate is None:
+                return None
+            self._close(candidate, CANDIDATE_REJECTED, reason)
+            self.stats["rejections"] += 1
+            self._start_queued(candidate["baseVersion"])
+            return self._public(candidate)
+
+    def _evaluate(self, candidate, client_sequence, chat_history, primary_result):
+        try:
+            with model_priority(PRIORITY_BATCH, session="shadow"):
+                shadow_result = self.ai_service.generate_reply_detailed(client_sequence, chat_history, candidate["prompt"])
+            with self._lock:
+                if candidate["status"] != CANDIDATE_SHADOWING:
+                    return
+                _record(candidate["primary"], primary_result)
+                _record(candidate["candidate"], shadow_result)
+                candidate["samples"] += 1
+                self.stats["shadowed"] += 1
+                ready = Config.SHADOW_AUTO_DECIDE and candidate["samples"] >= Config.SHADOW_MIN_SAMPLES
+            if ready:
+                self._decide(candidate)
+        except Exception as e:
+            logger.error(f"Shadow evaluation of {candidate['candidateId']} failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _decide(self, candidate):
+        with self._lock:
+            if candidate["status"] != CANDIDATE_SHADOWING:
+                return
+            comparison = _compare(candidate)
+        failures = []
+        if (comparison["latencyRatio"] or 0) > Config.SHADOW_MAX_LATENCY_RATIO:
+            failures.append(f"p50 latency x{comparison['latencyRatio']:.2f}")
+        if (comparison["outputTokensRatio"] or 0) > Config.SHADOW_MAX_OUTPUT_TOKENS_RATIO:
+            failures.append(f"output tokens x{comparison['outputTokensRatio']:.2f}")
+        if comparison["candidateFailureRate"] > Config.SHADOW_MAX_FAILURE_RATE:
+            failures.append(f"failure rate {comparison['candidateFailureRate']:.1%}")
+
+        if failures:
+            with self._lock:
+                if candidate["status"] != CANDIDATE_SHADOWING:
+                    return
+                self._close(candidate, CANDIDATE_REJECTED, "; ".join(failures))
+                self.stats["rejections"] += 1
+                self._start_queued(candidate["baseVersion"])
+            logger.warning(f"Prompt candidate {candidate['candidateId']} rejected: {'; '.join(failures)}")
+        else:
+            self._promote(candidate, "within shadow thresholds")
+
+    def _promote(self, candidate, reason):
+        try:
+            with tenant_context(Config.DEFAULT_TENANT):
+                version = update_prompt(candidate["prompt"], expected_version=candidate["baseVersion"])
+        except PromptVersionConflict as e:
+            # The production prompt was changed directly while this candidate was shadowing
+            with self._lock:
+                self._close(candidate, CANDIDATE_SUPERSEDED, str(e))
+                # The queued edit lacks the direct change too, so it will conflict the same way when decided
+                self._start_queued(candidate["baseVersion"])
+            logger.warning(f"Prompt candidate {candidate['candidateId']} not promoted: {e}")
+            return
+        with self._lock:
+            self._close(candidate, CANDIDATE_PROMOTED, f"{reason} (version {version})")
+            self.stats["promotions"] += 1
+            self._start_queued(version)
+        logger.info(f"Prompt candidate {candidate['candidateId']} promoted as version {version}")
+        if self.dedup is not None and candidate["applied"]:
+            # Only now did the feedback go into the production prompt; its near-duplicates get skipped from here on
+            with tenant_context(Config.DEFAULT_TENANT):
+                self.dedup.record_applied(candidate["applied"], version)
+
+    def _close(self, candidate, status, decision):
+        # Caller holds self._lock
+        if candidate["status"] != CANDIDATE_SHADOWING:
+            return
+        candidate.update(status=status, decision=decision, decidedAt=time.time())
+        if self._candidate is candidate:
+            self._candidate = None
+        self._history.appendleft(candidate)
+
+    def _start_queued(self, base_version):
+        # Caller holds self._lock; the queued edit starts shadowing once the current candidate is decided
+        queued = self._queued
+        if queued is None or self._candidate is not None:
+            return
+        queued.update(status=CANDIDATE_SHADOWING, baseVersion=base_version)
+        self._candidate, self._queued = queued, None
+        logger.info(f"Queued prompt candidate {queued['candidateId']} is now shadowing")
+
+    @staticmethod
+    def _public(candidate):
+        # Caller holds self._lock
+        public = {k: v for k, v in candidate.items() if k not in ("primary", "candidate", "applied")}
+        public["appliedFeedback"] = len(candidate["applied"])
+        public["comparison"] = _compare(candidate)
+        return public
+
+
+def _new_candidate(prompt, source, applied):
+    return {
+        "candidateId": uuid.uuid4().hex,
+        "status": None,
+        "source": source,
+        "prompt": prompt,
+        "baseVersion": None,
+        "createdAt": time.time(),
+        "decidedAt": None,
+        "decision": None,
+        "samples": 0,
+        "merges": 0,
+        "applied": list(applied or []),
+        "primary": _new_arm(),
+        "candidate": _new_arm(),
+    }
+
+
+def _new_arm():
+    return {"count": 0, "failures": 0, "truncated": 0, "promptTokens": 0, "outputTokens": 0,
+            "latencies": deque(maxlen=MAX_SAMPLES)}
+
+
+def _record(arm, result):
+    arm["count"] += 1
+    arm["failures"] += int(bool(result.get("parseFailed") or result.get("error")))
+    arm["truncated"] += int(bool(result.get("truncated")))
+    arm["promptTokens"] += result.get("promptTokens", 0)
+    arm["outputTokens"] += result.get("outputTokens", 0)
+    arm["latencies"].append(result.get("latencyMs", 0.0))
+
+
+def _summary(arm):
+    count = arm["count"]
+    latencies = sorted(arm["latencies"])
+    return {
+        "samples": count,
+        "p50LatencyMs": latencies[len(latencies) // 2] if latencies else 0.0,
+        "p90LatencyMs": latencies[int(len(latencies) * 0.9)] if latencies else 0.0,
+        "meanPromptTokens": arm["promptTokens"] / count if count else 0.0,
+        "meanOutputTokens": arm["outputTokens"] / count if count else 0.0,
+        "failureRate": arm["failures"] / count if count else 0.0,
+        "truncationRate": arm["truncated"] / count if count else 0.0,
+    }
+
+
+def _ratio(candidate_value, primary_value):
+    # Undefined until the primary arm has non-zero values
+    return candidate_value / primary_value if primary_value > 0 else None
+
+
+def _compare(candidate):
+    primary = _summary(candidate["primary"])
+    shadow = _summary(candidate["candidate"])
+    return {
+        "primary": primary,
+        "candidate": shadow,
+        "latencyRatio": _ratio(shadow["p50LatencyMs"], primary["p50LatencyMs"]),
+        "outputTokensRatio": _ratio(shadow["meanOutputTokens"], primary["meanOutputTokens"]),
+        "candidateFailureRate": shadow["failureRate"],
+    }
@@ -0,0 +1,207 @@
+"""Speculative reply pre-generation from /draft.
+
+While the client is still typing, /draft sends the in-progress text. A reply
+for it is generated in the background, against the session's current
+history, and kept under the session and the normalized text. When the
+message the client finally sends is close enough to the draft (and the
+session got no new turns in between), that reply is used instead of a new
+model call.
+
+Speculation is best-effort and must not cost live traffic capacity: it runs
+in the batch priority class of the model scheduler, at most
+SPECULATION_MAX_IN_FLIGHT at once and SPECULATION_MAX_PER_MINUTE in total,
+each under its own SPECULATION_TIMEOUT_MS deadline. One draft per session
+is kept; a changed draft supersedes the running generation.
+"""
+import difflib
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from config import Config
+from services.database_service import get_prompt
+from services.model_scheduler import PRIORITY_BATCH, model_priority
+from services.scenario_classifier import classify_scenario
+from utils.deadline import Deadline, Superseded, current_deadline, reset_deadline, set_deadline
+from utils.logger import logger
+from utils.memory import deep_sizeof, register_memory_source
+from utils.session_manager import get_chat_history, get_last_turn_index, session_key
+from utils.tenancy import current_tenant, tenant_context
+from utils.tracing import start_span
+
+# Drafts shorter than this (normalized) are not worth a model call
+MIN_DRAFT_CHARS = 8
+
+
+def normalize_draft(text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", (text or "").strip().lower()).rstrip(" .!?,")
+
+
+class _Speculation:
+    def __init__(self, session_id: str, text: str, normalized: str, turn: int):
+        self.session_id = session_id
+        self.tenant = current_tenant()
+        self.text = text
+        self.normalized = normalized
+        self.turn = turn
+        self.created = time.monotonic()
+        self.deadline = Deadline(Config.SPECULATION_TIMEOUT_MS / 1000.0)
+        self.done = threading.Event()
+        self.result = None
+        self.scenario = None
+        self.prompt = None
+        self.error = None
+
+
+class ReplySpeculator:
+    def __init__(self, ai_service):
+        self.ai_service = ai_service
+        self._drafts = {}
+        self._starts = deque()
+        self._lock = threading.Lock()
+        self._executor = None
+        self.stats = {"drafts": 0, "started": 0, "unchanged": 0, "budgetSkipped": 0, "superseded": 0,
+                      "failed": 0, "hits": 0, "misses": 0, "wasted": 0}
+        register_memory_source('speculation', self._size_bytes, self._evict, priority=15)
+
+    @staticmethod
+    def enabled() -> bool:
+        return Config.SPECULATION_ENABLED
+
+    def draft(self, session_id: str, text: str) -> Dict[str, Any]:
+        """Start speculating on the session's in-progress text; returns {status[, reason]}"""
+        normalized = normalize_draft(text)
+        if len(normalized) < MIN_DRAFT_CHARS:
+            return {"status": "skipped", "reason": "draft too short"}
+        turn = get_last_turn_index(session_id)
+        now = time.monotonic()
+        with self._lock:
+            self.stats["drafts"] += 1
+            self._expire(now)
+            key = session_key(session_id)
+            current = self._drafts.get(key)
+            if current is not None and current.normalized == normalized and current.turn == turn and current.error is None:
+                self.stats["unchanged"] += 1
+                return {"status": "unchanged"}
+            if current is not None:
+                self._discard(self._drafts.pop(key), "Draft changed")
+
+            while self._starts and now - self._starts[0] > 60.0:
+                self._starts.popleft()
+            in_flight = sum(1 for speculation in self._drafts.values() if not speculation.done.is_set())
+            if in_flight >= Config.SPECULATION_MAX_IN_FLIGHT:
+                self.stats["budgetSkipped"] += 1
+                return {"status": "skipped", "reason": "speculation in-flight limit reached"}
+            if len(self._starts) >= Config.SPECULATION_MAX_PER_MINUTE:
+                self.stats["budgetSkipped"] += 1
+                return {"status": "skipped", "reason": "speculation rate limit reached"}
+
+            speculation = _Speculation(session_id, text, normalized, turn)
+            self._drafts[key] = speculation
+            self._starts.append(now)
+            self.stats["started"] += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=Config.SPECULATION_MAX_IN_FLIGHT,
+                                                    thread_name_prefix="speculate")
+        self._executor.submit(self._run, speculation)
+        return {"status": "started"}
+
+    def take(self, session_id: str, text: str) -> Optional[Tuple[Dict[str, Any], Optional[str], str]]:
+        """(generate_reply_detailed() result, scenario, prompt) speculated for the sent text, or None on a miss"""
+        with self._lock:
+            speculation = self._drafts.pop(session_key(session_id), None)
+        if speculation is None:
+            return None
+
+        fresh = time.monotonic() - speculation.created <= Config.SPECULATION_TTL_SECONDS
+        same_history = speculation.turn == get_last_turn_index(session_id)
+        normalized = normalize_draft(text)
+        close = normalized == speculation.normalized or difflib.SequenceMatcher(
+            None, normalized, speculation.normalized).ratio() >= Config.SPECULATION_MATCH_THRESHOLD
+        if not (fresh and same_history and close):
+            with self._lock:
+                self.stats["misses"] += 1
+                self._discard(speculation, "Sent message differs from the draft")
+            return None
+
+        if not speculation.done.is_set():
+            # Already under way: finishing it is quicker than starting over
+            deadline = current_deadline()
+            speculation.done.wait(max(0.0, deadline.remaining()) if deadline is not None else None)
+        with self._lock:
+            if speculation.result is None:
+                self.stats["misses"] += 1
+                self._discard(speculation, "Request stopped waiting for the draft")
+                return None
+            self.stats["hits"] += 1
+        return speculation.result, speculation.scenario, speculation.prompt
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                self.stats,
+                enabled=self.enabled(),
+                draftsHeld=len(self._drafts),
+                inFlight=sum(1 for speculation in self._drafts.values() if not speculation.done.is_set()),
+                startsLastMinute=len(self._starts),
+                maxInFlight=Config.SPECULATION_MAX_IN_FLIGHT,
+                maxPerMinute=Config.SPECULATION_MAX_PER_MINUTE
+            )
+
+    def _run(self, speculation: _Speculation):
+        token = set_deadline(speculation.deadline)
+        try:
+            speculation.deadline.check('speculate')
+            # Runs on a pool thread: a trace of its own, not part of the /draft request that started it
+            with tenant_context(speculation.tenant), \
+                    model_priority(PRIORITY_BATCH, session=f"draft:{speculation.session_id}"), \
+                    start_span('speculation.run', {'draft.chars': len(speculation.text), 'session.turn': speculation.turn}):
+                chat_history = get_chat_history(speculation.session_id)
+                scenario, _ = classify_scenario(speculation.text)
+                prompt = get_prompt(scenario)
+                result = self.ai_service.generate_reply_detailed(speculation.text, chat_history, prompt)
+            if result.get("error"):
+                raise RuntimeError(result["error"])
+            speculation.scenario, speculation.prompt = scenario, prompt
+            speculation.result = result
+        except Superseded:
+            pass
+        except Exception as e:
+            speculation.error = str(e)
+            with self._lock:
+                self.stats["failed"] += 1
+            logger.warning(f"Speculative reply for session {speculation.session_id} failed: {str(e)}")
+        finally:
+            reset_deadline(token)
+            speculation.done.set()
+
+    def _discard(self, speculation: _Speculation, reason: str):
+        # Caller holds self._lock
+        if speculation.done.is_set():
+            if speculation.result is not None:
+                self.stats["wasted"] += 1
+        else:
+            self.stats["superseded"] += 1
+            speculation.deadline.supersede(reason)
+
+    def _expire(self, now: float):
+        # Caller holds self._lock
+        for key in [key for key, speculation in self._drafts.items()
+                    if now - speculation.created > Config.SPECULATION_TTL_SECONDS]:
+            self._discard(self._drafts.pop(key), "Draft expired")
+
+    def _size_bytes(self):
+        with self._lock:
+            return deep_sizeof([(s.text, s.result) for s in self._drafts.values()])
+
+    def _evict(self, fraction):
+        with self._lock:
+            finished = [key for key, s in self._drafts.items() if s.done.is_set()]
+            drop = finished[:max(1, int(len(finished) * fraction))] if finished else []
+            for key in drop:
+                self._discard(self._drafts.pop(key), "Evicted")
+            return len(drop)
@@ -0,0 +1,63 @@
+"""Shared setup: the API runs against the local fake model server, without Firestore.
+
+Config is read when it is first imported, so the fake server is started and the
+environment prepared in pytest_configure, before test modules are collected and
+import the app. Snapshots, models and logs go to a per-session scratch directory.
+"""
+import os
+
+import pytest
+
+from services.fake_llm_server import start_fake_server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+fake_server = None
+
+
+def pytest_configure(config):
+    global fake_server
+    fake_server = start_fake_server("127.0.0.1", latency="constant:5")
+    os.environ.update({
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_URL": fake_server.url,
+        "FIREBASE_PROJECT_ID": "",
+        "CONVERSATIONS_PATH": os.path.join(REPO_ROOT, "data", "conversations.json"),
+        "SCENARIO_ROUTING_ENABLED": "false",
+        "INTERACTION_LOG_ENABLED": "false",
+        "TRACING_ENABLED": "false",
+        "FEEDBACK_DEDUP_ENABLED": "false",
+        "CHAT_DEBOUNCE_MS": "0",
+    })
+
+
+def pytest_unconfigure(config):
+    if fake_server is not None:
+        fake_server.shutdown()
+        fake_server.server_close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def scratch_dir(tmp_path_factory):
+    """Run the session in a scratch directory so relative data paths never touch the checkout"""
+    with pytest.MonkeyPatch.context() as patch:
+        path = tmp_path_factory.mktemp("workdir")
+        patch.chdir(path)
+        yield path
+
+
+@pytest.fixture(scope="session")
+def fake_llm():
+    return fake_server
+
+
+@pytest.fixture(scope="session")
+def app(scratch_dir):
+    from app import app as flask_app
+
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,29 @@
+from config import Config
+
+
+def test_other_tenants_cannot_use_admin_endpoints(client, monkeypatch):
+    monkeypatch.setattr(Config, "TENANTS", "acme")
+
+    response = client.get("/admin/tenants", headers={"X-Tenant-ID": "acme"})
+
+    assert response.status_code == 403
+
+
+def test_admin_endpoints_fail_closed_for_multiple_tenants_without_a_token(client, monkeypatch):
+    monkeypatch.setattr(Config, "TENANTS", "acme")
+    monkeypatch.setattr(Config, "ADMIN_TOKEN", None)
+
+    assert client.get("/admin/tenants").status_code == 403
+
+    monkeypatch.setattr(Config, "ADMIN_TOKEN", "secret")
+    assert client.get("/admin/tenants").status_code == 401
+    assert client.get("/admin/tenants", headers={"X-Admin-Token": "secret"}).status_code == 200
+
+
+def test_admin_inspects_another_tenants_prompt_store(client, monkeypatch):
+    monkeypatch.setattr(Config, "TENANTS", "acme")
+    monkeypatch.setattr(Config, "ADMIN_TOKEN", "secret")
+    headers = {"X-Admin-Token": "secret"}
+
+    assert client.get("/admin/prompt-store?tenant=acme", headers=headers).status_code == 200
+    assert client.get("/admin/prompt-store?tenant=nobody", headers=headers).status_code == 404
@@ -0,0 +1,107 @@
+import pytest
+
+from config import Config
+from services.context_cache import PromptContextCache
+from services.google_ai_service import GoogleAIService
+from services.llm_backends import FakeServerBackend, LLMBackendError
+from utils.tenancy import tenant_context
+
+PREFIXES = ["Main prompt instructions. " * 20, "Variant prompt instructions. " * 20, "Candidate prompt. " * 20]
+
+
+def _cache(**kwargs):
+    return PromptContextCache(FakeServerBackend(Config.FAKE_LLM_URL), enabled=True, min_chars=1, **kwargs)
+
+
+def test_alternating_prefixes_keep_their_own_handles():
+    cache = _cache(max_entries=4)
+    first = [cache.handle_for(prefix) for prefix in PREFIXES]
+    again = [cache.handle_for(prefix) for prefix in PREFIXES]
+
+    assert first == again
+    assert len(set(first)) == 3
+    assert cache.stats["creates"] == 3
+    assert cache.stats["hits"] == 3
+
+
+def test_least_recently_used_handle_is_released(fake_llm):
+    cache = _cache(max_entries=2)
+    main, variant = cache.handle_for(PREFIXES[0]), cache.handle_for(PREFIXES[1])
+    cache.handle_for(PREFIXES[0])
+    cache.handle_for(PREFIXES[2])
+
+    assert cache.stats["evictions"] == 1
+    assert variant not in fake_llm.state.caches
+    assert main in fake_llm.state.caches
+    assert cache.handle_for(PREFIXES[0]) == main
+
+
+def test_tenants_with_the_same_prefix_get_separate_entries():
+    cache = _cache()
+    with tenant_context("acme"):
+        cache.handle_for(PREFIXES[0])
+    cache.handle_for(PREFIXES[0])
+    with tenant_context("acme"):
+        cache.invalidate()
+
+    assert cache.stats["creates"] == 2
+    assert cache.handle_for(PREFIXES[0])
+    assert cache.stats["hits"] == 1
+
+
+def test_replies_use_the_cached_prefix(monkeypatch):
+    monkeypatch.setattr(Config, "CONTEXT_CACHE_MIN_CHARS", 1)
+    service = GoogleAIService()
+    prompt = PREFIXES[0] + "Client message: {client_sequence}\n\nChat history:\n{chat_history}"
+
+    first = service.generate_reply_detailed("Hello", [], prompt)
+    second = service.generate_reply_detailed("Hello again", [], prompt)
+
+    assert first["reply"] and second["reply"]
+    assert service.context_cache.stats["creates"] == 1
+    assert service.context_cache.stats["hits"] == 1
+
+
+def test_missing_cache_is_invalidated_and_resent_in_full(monkeypatch, fake_llm):
+    monkeypatch.setattr(Config, "CONTEXT_CACHE_MIN_CHARS", 1)
+    service = GoogleAIService()
+    prompt = PREFIXES[1] + "Client message: {client_sequence}\n\nChat history:\n{chat_history}"
+    service.generate_reply_detailed("Hello", [], prompt)
+    fake_llm.state.caches.clear()
+
+    result = service.generate_reply_detailed("Hello again", [], prompt)
+
+    assert result["reply"] and not result.get("error")
+    assert service.context_cache.stats["creates"] == 1
+    service.generate_reply_detailed("Hello once more", [], prompt)
+    assert service.context_cache.stats["creates"] == 2
+
+
+def test_transient_cached_call_failure_keeps_the_cache(monkeypatch):
+    monkeypatch.setattr(Config, "CONTEXT_CACHE_MIN_CHARS", 1)
+    service = GoogleAIService()
+    static_prefix, dynamic = service.split_prompt(PREFIXES[2] + "Client message: {client_sequence}")
+    handle = service.context_cache.handle_for(static_prefix)
+
+    def overloaded(stage, prompt, profile=None, **options):
+        raise LLMBackendError("model overloaded", status=503)
+
+    monkeypatch.setattr(service, "_generate", overloaded)
+
+    with pytest.raises(LLMBackendError):
+        service._generate_with_prefix(static_prefix, dynamic)
+    assert service.context_cache.handle_for(static_prefix) == handle
+
+
+def test_prompt_tokens_count_the_cached_prefix_once(monkeypatch):
+    monkeypatch.setattr(Config, "CONTEXT_CACHE_MIN_CHARS", 1)
+    service = GoogleAIService()
+    prompt = PREFIXES[0] + "Client message: {client_sequence}\n\nChat history:\n{chat_history}"
+    uncached = GoogleAIService()
+    uncached.context_cache.enabled = False
+
+    cached_result = service.generate_reply_detailed("Hello", [], prompt)
+    plain_result = uncached.generate_reply_detailed("Hello", [], prompt)
+
+    assert service.context_cache.stats["creates"] == 1
+    assert cached_result["promptTokens"] == plain_result["promptTokens"]
@@ -0,0 +1,19 @@
+from services.generation_profiles import JSON_ENVELOPE_STOP, restore_stop_sequence
+
+
+def _envelope_profile():
+    from services.generation_profiles import get_profiles
+
+    return next(name for name, profile in get_profiles().items()
+                if JSON_ENVELOPE_STOP in (profile.get("stop_sequences") or []))
+
+
+def test_cut_off_envelope_is_closed():
+    text = '{"reply": "You can apply from Bali'
+
+    assert restore_stop_sequence(text, _envelope_profile(), "STOP") == text + JSON_ENVELOPE_STOP
+
+
+def test_natural_plain_text_end_is_left_alone():
+    for text in ("You can apply from Bali.", '{"reply": "Done."}', '{"reply": "A "quoted" word'):
+        assert restore_stop_sequence(text, _envelope_profile(), "STOP") == text
@@ -0,0 +1,83 @@
+import uuid
+
+from config import Config
+
+BODY = {"clientSequence": "How long does the DTV take?", "chatHistory": []}
+
+
+def _key():
+    return {"Idempotency-Key": uuid.uuid4().hex}
+
+
+def test_retry_with_same_key_replays_the_original_response(client):
+    headers = _key()
+    first = client.post("/generate-reply", json=BODY, headers=headers)
+    retry = client.post("/generate-reply", json=BODY, headers=headers)
+
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.get_json() == first.get_json()
+
+
+def test_same_key_with_a_different_body_is_rejected(client):
+    headers = _key()
+    client.post("/generate-reply", json=BODY, headers=headers)
+    mismatch = client.post("/generate-reply", json=dict(BODY, clientSequence="Something else"), headers=headers)
+
+    assert mismatch.status_code == 422
+
+
+def test_keys_are_scoped_per_route(client):
+    headers = _key()
+    client.post("/generate-reply", json=BODY, headers=headers)
+    other_route = client.post("/chat", json={"message": BODY["clientSequence"], "chat_history": []}, headers=headers)
+
+    assert other_route.status_code == 200
+    assert "Idempotent-Replayed" not in other_route.headers
+
+
+def test_quota_rejection_is_not_replayed(client, monkeypatch):
+    monkeypatch.setattr(Config, "TENANTS", "quota-test")
+    monkeypatch.setattr(Config, "TENANT_LIMITS", "quota-test:0:1")
+    headers = dict(_key(), **{"X-Tenant-ID": "quota-test"})
+    client.post("/generate-reply", json=dict(BODY, clientSequence="Uses up the quota"),
+                headers={"X-Tenant-ID": "quota-test"})
+
+    rejected = client.post("/generate-reply", json=BODY, headers=headers)
+    assert rejected.status_code == 429
+    assert int(rejected.headers["Retry-After"]) >= 1
+
+    monkeypatch.setattr(Config, "TENANT_LIMITS", "quota-test:0:10")
+    retry = client.post("/generate-reply", json=BODY, headers=headers)
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+def test_failed_model_call_is_not_replayed(client, monkeypatch):
+    from controllers.chat_controller import ai_service
+
+    headers = _key()
+    with monkeypatch.context() as patch:
+        patch.setattr(ai_service, "generate_reply_detailed",
+                      lambda *args, **kwargs: {"reply": "I apologize...", "error": "backend down"})
+        failed = client.post("/generate-reply", json=BODY, headers=headers)
+    retry = client.post("/generate-reply", json=BODY, headers=headers)
+
+    assert failed.status_code == 502
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+def test_unchanged_manual_edit_is_not_committed(client, monkeypatch):
+    from controllers.chat_controller import ai_service
+    from services.database_service import get_prompt_with_version
+
+    _, version_before = get_prompt_with_version()
+    monkeypatch.setattr(ai_service, "manual_improve_prompt", lambda current_prompt, instructions: current_prompt)
+
+    response = client.post("/improve-ai-manually", json={"instructions": "Be brief"}, headers=_key())
+
+    assert response.status_code == 502
+    assert get_prompt_with_version()[1] == version_before
@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+from services.database_service import get_prompt_with_version, update_prompt
+from services.google_ai_service import GoogleAIService
+from services.improve_queue import JOB_COMPLETED, JOB_FAILED, ImproveJobQueue
+
+
+class EditorHooks:
+    """Fake-backed AI service whose editor calls can be intercepted"""
+
+    def __init__(self, before_edit=None, edit=None):
+        self.ai = GoogleAIService()
+        self.before_edit = before_edit
+        self.edit = edit
+        self.edits = 0
+
+    def generate_reply_detailed(self, *args, **kwargs):
+        return self.ai.generate_reply_detailed(*args, **kwargs)
+
+    def improve_prompt_batch(self, current_prompt, examples):
+        self.edits += 1
+        if self.before_edit:
+            self.before_edit(self.edits, current_prompt)
+        if self.edit:
+            return self.edit(current_prompt, examples)
+        return self.ai.improve_prompt_batch(current_prompt, examples)
+
+
+def _feedback(n):
+    return (f"Can I apply for the DTV from Bali? ({n})", [], f"Yes, from the embassy in Jakarta. ({n})")
+
+
+def _wait(queue, job_ids, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs = [queue.get_job(job_id) for job_id in job_ids]
+        if all(job["status"] in (JOB_COMPLETED, JOB_FAILED) for job in jobs):
+            return jobs
+        time.sleep(0.02)
+    pytest.fail(f"Jobs did not finish: {[job['status'] for job in jobs]}")
+
+
+def test_feedback_within_window_is_applied_in_one_batch():
+    ai = EditorHooks()
+    queue = ImproveJobQueue(ai, batch_window_ms=300, max_batch=5)
+    _, version_before = get_prompt_with_version()
+
+    jobs = _wait(queue, [queue.submit(*_feedback(n))["jobId"] for n in range(3)])
+
+    assert ai.edits == 1
+    assert {job["status"] for job in jobs} == {JOB_COMPLETED}
+    assert {job["batchSize"] for job in jobs} == {3}
+    assert {job["promptVersion"] for job in jobs} == {version_before + 1}
+    assert all(job["predictedReply"] for job in jobs)
+    prompt, version = get_prompt_with_version()
+    assert version == version_before + 1
+    assert prompt == jobs[0]["updatedPrompt"]
+
+
+def test_conflicting_commit_is_re_edited_against_the_fresh_prompt():
+    def competing_write(edit_number, current_prompt):
+        if edit_number == 1:
+            update_prompt(current_prompt + "\n- Edited by an admin meanwhile")
+
+    ai = EditorHooks(before_edit=competing_write)
+    queue = ImproveJobQueue(ai, batch_window_ms=50, max_commit_retries=3)
+    _, version_before = get_prompt_with_version()
+
+    job, = _wait(queue, [queue.submit(*_feedback(0))["jobId"]])
+
+    assert job["status"] == JOB_COMPLETED
+    assert ai.edits == 2
+    assert queue.stats["conflicts"] == 1
+    assert job["promptVersion"] == version_before + 2
+    assert "Edited by an admin meanwhile" in job["updatedPrompt"]
+
+
+def test_unchanged_edit_fails_without_committing():
+    ai = EditorHooks(edit=lambda current_prompt, examples: current_prompt)
+    queue = ImproveJobQueue(ai, batch_window_ms=50)
+    _, version_before = get_prompt_with_version()
+
+    job, = _wait(queue, [queue.submit(*_feedback(0))["jobId"]])
+
+    assert job["status"] == JOB_FAILED
+    assert job["error"]
+    assert get_prompt_with_version()[1] == version_before
+    assert queue.stats["commits"] == 0
+
+
+def test_failed_prediction_fails_the_job_before_any_edit():
+    ai = EditorHooks()
+    ai.generate_reply_detailed = lambda *args, **kwargs: {"reply": "I apologize...", "error": "backend down"}
+    queue = ImproveJobQueue(ai, batch_window_ms=50)
+
+    job, = _wait(queue, [queue.submit(*_feedback(0))["jobId"]])
+
+    assert job["status"] == JOB_FAILED
+    assert "backend down" in job["error"]
+    assert ai.edits == 0
@@ -0,0 +1,30 @@
+import threading
+import time
+
+import pytest
+
+from services.model_scheduler import ModelCallScheduler
+from utils.deadline import Deadline, DeadlineExceeded, call_with_deadline, reset_deadline, set_deadline
+
+
+def test_abandoned_call_keeps_its_slot_until_it_returns():
+    scheduler = ModelCallScheduler(capacity=2, interactive_reserved=0)
+    backend_returns = threading.Event()
+    token = set_deadline(Deadline(0.05))
+    try:
+        with pytest.raises(DeadlineExceeded):
+            with scheduler.slot("generate_reply"):
+                call_with_deadline("generate_reply", backend_returns.wait, 5)
+    finally:
+        reset_deadline(token)
+
+    assert scheduler.report()["inFlight"] == 1
+    assert scheduler.report()["abandonedInFlight"] == 1
+
+    backend_returns.set()
+    for _ in range(100):
+        if scheduler.report()["inFlight"] == 0:
+            break
+        time.sleep(0.01)
+    assert scheduler.report()["inFlight"] == 0
+    assert scheduler.report()["abandonedInFlight"] == 0
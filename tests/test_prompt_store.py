@@ -0,0 +1,64 @@
+from config import Config
+from services.database_service import prompt_hash
+from services.prompt_store import PromptVersionStore, apply_delta, make_delta
+
+BASE = "You are a visa consultant.\nBe friendly.\n\nClient message: {client_sequence}\n\nChat history:\n{chat_history}"
+
+
+def _edit(text, n):
+    return text.replace("Be friendly.", f"Be friendly.\nRule {n}: answer in under {n + 2} sentences.")
+
+
+def _commit(store, text, **kwargs):
+    return store.commit_local(text, prompt_hash(text), None, kwargs.pop("source", "test"), kwargs.pop("rollback_of", None))
+
+
+def test_delta_round_trip():
+    edited = _edit(BASE, 1).replace("Chat history:", "Conversation so far:")
+    assert apply_delta(BASE, make_delta(BASE, edited)) == edited
+    assert apply_delta(edited, make_delta(edited, BASE)) == BASE
+
+
+def test_versions_read_back_through_deltas_and_keyframes(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "PROMPT_HISTORY_KEYFRAME_INTERVAL", 3)
+    store = PromptVersionStore(str(tmp_path / "snapshot.json"))
+    store.ensure_loaded()
+
+    texts = [BASE]
+    for n in range(1, 8):
+        texts.append(_edit(texts[-1], n))
+    for text in texts:
+        _commit(store, text)
+
+    depths = [store.blobs[prompt_hash(text)]["depth"] for text in texts]
+    assert depths == [0, 1, 2, 0, 1, 2, 0, 1]
+    assert all("delta" in store.blobs[prompt_hash(text)] for text, depth in zip(texts, depths) if depth)
+
+    # A fresh replica reads every version back from the snapshot alone
+    reloaded = PromptVersionStore(str(tmp_path / "snapshot.json"))
+    reloaded.ensure_loaded()
+    assert reloaded.current() == (texts[-1], len(texts), prompt_hash(texts[-1]))
+    for version, text in enumerate(texts, start=1):
+        assert reloaded.text(reloaded.version_entry(version)["hash"]) == text
+
+
+def test_rollback_reuses_blob_and_cuts_lineage(tmp_path):
+    store = PromptVersionStore(str(tmp_path / "snapshot.json"))
+    store.ensure_loaded()
+    v1 = _edit(BASE, 1)
+    v2 = _edit(v1, 2)
+    v3 = _edit(v2, 3)
+    for text in (v1, v2, v3):
+        _commit(store, text)
+    blobs_before = len(store.blobs)
+
+    entry = _commit(store, v1, source="rollback", rollback_of=1)
+
+    assert entry["version"] == 4
+    assert len(store.blobs) == blobs_before
+    assert store.current()[0] == v1
+    assert [store.in_lineage(v) for v in (1, 2, 3, 4)] == [True, False, False, True]
+
+    # Building on the rolled-back prompt keeps the restored lineage
+    _commit(store, _edit(v1, 5))
+    assert [store.in_lineage(v) for v in (1, 2, 3, 4, 5)] == [True, False, False, True, True]
@@ -0,0 +1,8 @@
+from services import scenario_classifier
+
+
+def test_predict_without_a_classifier_fails(monkeypatch, capsys):
+    monkeypatch.setattr(scenario_classifier, "get_classifier", lambda: None)
+
+    assert scenario_classifier.main(["predict", "Can I get the DTV from Bali?"]) == 1
+    assert "No classifier available" in capsys.readouterr().err
@@ -0,0 +1,66 @@
+import threading
+import time
+import uuid
+
+from config import Config
+from utils.session_manager import get_turns_since, join_burst
+
+
+def _in_thread(fn, *args):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", fn(*args)))
+    thread.start()
+    return thread, result
+
+
+def test_messages_within_the_window_join_one_burst():
+    session_id = uuid.uuid4().hex
+    first, first_result = _in_thread(join_burst, session_id, "Hi", 300, 2000)
+    time.sleep(0.05)
+    second, second_result = _in_thread(join_burst, session_id, "Can I get the DTV from Bali?", 300, 2000)
+    first.join(5)
+    second.join(5)
+
+    assert first_result["value"] is None
+    burst, leader = second_result["value"]
+    assert burst.messages == ["Hi", "Can I get the DTV from Bali?"]
+    assert burst.text == "Hi\nCan I get the DTV from Bali?"
+    assert burst.close(leader)
+
+
+def test_burst_is_answered_once_after_max_wait():
+    session_id = uuid.uuid4().hex
+    started = time.monotonic()
+    burst, leader = join_burst(session_id, "Hello", 5000, 100)
+
+    assert time.monotonic() - started < 1.0
+    assert burst.messages == ["Hello"]
+    assert burst.close(leader)
+    # Closed bursts are not reused by the next message
+    assert not burst.close(leader)
+
+
+def test_rapid_session_messages_get_one_merged_reply(app, monkeypatch):
+    monkeypatch.setattr(Config, "CHAT_DEBOUNCE_MS", 300)
+    session_id = uuid.uuid4().hex
+
+    def send(text):
+        response = app.test_client().post("/generate-reply", json={"clientSequence": text, "sessionId": session_id})
+        return response.status_code, response.get_json()
+
+    first, first_result = _in_thread(send, "Hi")
+    time.sleep(0.05)
+    second, second_result = _in_thread(send, "What documents do I need?")
+    first.join(10)
+    second.join(10)
+
+    status, superseded = first_result["value"]
+    assert status == 200
+    assert superseded["superseded"] is True
+    assert superseded["aiReply"] is None
+
+    status, answered = second_result["value"]
+    assert status == 200
+    assert answered["aiReply"]
+    assert answered["mergedMessages"] == 2
+    assert [turn["role"] for turn in get_turns_since(session_id)] == ["client", "client", "consultant"]
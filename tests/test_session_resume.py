@@ -0,0 +1,42 @@
+import uuid
+
+HISTORY = [
+    {"role": "client", "message": "I work remotely for a German company."},
+    {"role": "consultant", "message": "Then the DTV workcation route fits you."},
+]
+
+
+def test_lost_session_asks_for_the_history_instead_of_answering_without_it(client):
+    session_id = uuid.uuid4().hex
+
+    response = client.post("/generate-reply", json={
+        "clientSequence": "Which documents do I need?", "sessionId": session_id, "lastSeenTurn": 1})
+
+    assert response.status_code == 409
+    assert response.get_json()["sessionReset"] is True
+
+
+def test_resent_history_seeds_the_session(client):
+    session_id = uuid.uuid4().hex
+
+    response = client.post("/generate-reply", json={
+        "clientSequence": "Which documents do I need?", "sessionId": session_id,
+        "chatHistory": HISTORY, "lastSeenTurn": 1})
+    turns = client.get(f"/sessions/{session_id}/turns").get_json()["turns"]
+
+    assert response.status_code == 200
+    assert response.get_json()["sessionReset"] is False
+    assert response.get_json()["turnIndex"] == 3
+    assert [turn["message"] for turn in turns[:2]] == [turn["message"] for turn in HISTORY]
+
+
+def test_history_does_not_overwrite_a_live_session(client):
+    session_id = uuid.uuid4().hex
+    client.post("/generate-reply", json={"clientSequence": "Hello", "sessionId": session_id})
+
+    client.post("/generate-reply", json={
+        "clientSequence": "Which documents do I need?", "sessionId": session_id, "chatHistory": HISTORY})
+    turns = client.get(f"/sessions/{session_id}/turns").get_json()["turns"]
+
+    assert turns[0]["message"] == "Hello"
+    assert len(turns) == 4
@@ -0,0 +1,47 @@
+from services.database_service import get_prompt_with_version
+from services.shadow_eval import CANDIDATE_QUEUED, CANDIDATE_SHADOWING, ShadowEvaluator
+
+
+class RecordingDedup:
+    def __init__(self):
+        self.recorded = []
+
+    def record_applied(self, examples, prompt_version):
+        self.recorded.append((list(examples), prompt_version))
+
+
+def test_edits_during_an_evaluation_queue_and_merge_instead_of_replacing_it():
+    shadow = ShadowEvaluator(ai_service=None, sample_rate=0)
+    base_prompt, _ = get_prompt_with_version()
+
+    first = shadow.propose(base_prompt + "\n- First edit", "improve-ai")
+    second = shadow.propose(shadow.working_prompt() + "\n- Second edit", "improve-ai")
+    third = shadow.propose(shadow.working_prompt() + "\n- Third edit", "improve-ai-manually")
+
+    report = shadow.report()
+    assert first["status"] == CANDIDATE_SHADOWING
+    assert second["status"] == third["status"] == CANDIDATE_QUEUED
+    assert second["candidateId"] == third["candidateId"]
+    assert report["candidate"]["candidateId"] == first["candidateId"]
+    assert report["queued"]["merges"] == 1
+    assert shadow.working_prompt().endswith("- Second edit\n- Third edit")
+
+
+def test_queued_candidate_starts_after_promotion_and_feedback_is_recorded_then():
+    dedup = RecordingDedup()
+    shadow = ShadowEvaluator(ai_service=None, sample_rate=0, dedup=dedup)
+    base_prompt, _ = get_prompt_with_version()
+
+    first = shadow.propose(base_prompt + "\n- Staged edit", "improve-ai", applied=[("job-1", "sig-1")])
+    queued = shadow.propose(shadow.working_prompt() + "\n- Next edit", "improve-ai", applied=[("job-2", "sig-2")])
+    assert dedup.recorded == []
+
+    promoted = shadow.promote()
+
+    _, version = get_prompt_with_version()
+    assert promoted["candidateId"] == first["candidateId"]
+    assert dedup.recorded == [([("job-1", "sig-1")], version)]
+    current = shadow.report()["candidate"]
+    assert current["candidateId"] == queued["candidateId"]
+    assert current["status"] == CANDIDATE_SHADOWING
+    assert current["baseVersion"] == version
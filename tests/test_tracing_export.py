@@ -0,0 +1,26 @@
+import os
+
+from config import Config
+from utils.tracing import BatchSpanExporter
+
+
+def test_jsonl_export_rotates_and_keeps_a_bounded_number_of_files(tmp_path, monkeypatch):
+    path = str(tmp_path / "spans.jsonl")
+    monkeypatch.setattr(Config, "TRACE_JSONL_PATH", path)
+    monkeypatch.setattr(Config, "TRACE_JSONL_MAX_BYTES", 100)
+    monkeypatch.setattr(Config, "TRACE_JSONL_MAX_FILES", 2)
+    exporter = BatchSpanExporter()
+
+    for _ in range(6):
+        exporter._append_jsonl([Line("x" * 120)])
+
+    assert sorted(os.listdir(tmp_path)) == ["spans.jsonl.1", "spans.jsonl.2"]
+    assert exporter.stats["rotations"] == 6
+
+
+class Line:
+    def __init__(self, text):
+        self.text = text
+
+    def to_dict(self):
+        return {"name": self.text}
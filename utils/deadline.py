@@ -0,0 +1,140 @@
+import contextvars
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Optional
+
+from config import Config
+
+# Deadline of the request being handled on this thread/context (None outside requests)
+_current_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+# Threads that run downstream calls so the request thread can stop waiting on them
+_call_executor = ThreadPoolExecutor(max_workers=Config.DEADLINE_CALL_THREADS, thread_name_prefix='deadline-call')
+
+# How often a waiting request re-checks for client disconnects
+POLL_INTERVAL_SECONDS = 0.05
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the request's time budget is spent"""
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client went away and the request's work should be abandoned"""
+
+
+class Superseded(Exception):
+    """Raised when newer input from the same client made the request's work obsolete"""
+
+
+class Deadline:
+    """Absolute time budget for one request, plus an optional cancellation check"""
+
+    def __init__(self, timeout_seconds: float, is_cancelled: Optional[Callable[[], bool]] = None):
+        self.timeout_seconds = timeout_seconds
+        self.expires_at = time.monotonic() + timeout_seconds
+        self.is_cancelled = is_cancelled or (lambda: False)
+        self.superseded_by = None
+
+    def supersede(self, reason: str):
+        """Abandon the request's remaining work from another thread; the next check raises Superseded"""
+        self.superseded_by = reason
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str = 'request'):
+        """Raise if the budget is spent, the client disconnected or newer input superseded the request"""
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline of {self.timeout_seconds:.3f}s exceeded before {stage}")
+        if self.is_cancelled():
+            raise ClientDisconnected(f"Client disconnected before {stage}")
+        if self.superseded_by is not None:
+            raise Superseded(f"{self.superseded_by} before {stage}")
+
+    def timeout_for(self, stage: str, cap: Optional[float] = None) -> float:
+        """Remaining budget to hand to a downstream call, optionally capped"""
+        self.check(stage)
+        remaining = self.remaining()
+        return min(remaining, cap) if cap else remaining
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+def set_deadline(deadline: Optional[Deadline]):
+    """Install deadline for the current context and return a token for reset_deadline()"""
+    return _current_deadline.set(deadline)
+
+
+def reset_deadline(token):
+    _current_deadline.reset(token)
+
+
+def downstream_timeout(stage: str, cap: Optional[float] = None) -> Optional[float]:
+    """Timeout for a downstream call: the request's remaining budget, or cap outside requests"""
+    deadline = current_deadline()
+    if deadline is None:
+        return cap
+    return deadline.timeout_for(stage, cap)
+
+
+def deadline_from_request(request) -> Deadline:
+    """Build the request deadline from X-Request-Timeout-Ms or the configured default"""
+    timeout_ms = Config.DEFAULT_REQUEST_TIMEOUT_MS
+    header = request.headers.get('X-Request-Timeout-Ms')
+    if header:
+        try:
+            timeout_ms = float(header)
+        except ValueError:
+            pass
+    timeout_ms = max(1.0, min(timeout_ms, Config.MAX_REQUEST_TIMEOUT_MS))
+    environ = request.environ
+    return Deadline(timeout_ms / 1000.0, is_cancelled=lambda: client_disconnected(environ))
+
+
+def client_disconnected(environ) -> bool:
+    """Best-effort check whether the client closed its connection"""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+
+def call_with_deadline(stage: str, fn: Callable, *args, **kwargs):
+    """Run fn, abandoning it if the request deadline passes or the client disconnects.
+
+    Outside a request fn runs inline. The abandoned call keeps its own
+    downstream timeout, so the worker thread is released once that fires;
+    the raised exception carries its future as abandoned_call, so callers
+    holding a resource for the call (a model slot) can keep it until then.
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return fn(*args, **kwargs)
+
+    deadline.check(stage)
+    context = contextvars.copy_context()
+    future = _call_executor.submit(context.run, fn, *args, **kwargs)
+    while True:
+        try:
+            return future.result(timeout=min(POLL_INTERVAL_SECONDS, max(deadline.remaining(), 0.001)))
+        except FutureTimeoutError:
+            pass
+        if deadline.expired() or deadline.is_cancelled() or deadline.superseded_by is not None:
+            future.cancel()
+            try:
+                deadline.check(stage)
+            except (DeadlineExceeded, ClientDisconnected, Superseded) as e:
+                e.abandoned_call = future
+                raise
@@ -0,0 +1,160 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, jsonify, make_response, request
+
+from config import Config
+from utils.deadline import current_deadline
+from utils.logger import logger
+from utils.memory import deep_sizeof, register_memory_source
+from utils.tenancy import current_tenant
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+# Outcomes a retry may change (conflict, rate or quota limit, abandoned request), handed to waiters but never stored
+TRANSIENT_STATUSES = (408, 409, 425, 429, 499)
+# Recomputed for each response rather than replayed
+_UNSTORED_HEADERS = ('content-length',)
+
+
+class _Entry:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.created = time.monotonic()
+        self.done = threading.Event()
+        self.response = None
+
+
+class IdempotencyStore:
+    """Bounded TTL store of responses keyed by (tenant, route, Idempotency-Key).
+
+    The first request with a key runs the handler; duplicates arriving while
+    it runs wait for its result, later duplicates get the stored response,
+    headers included. 5xx and transient 4xx responses (TRANSIENT_STATUSES)
+    are handed to waiters but not kept, so a retry after a server error, a
+    quota rejection or an abandoned request runs again.
+    """
+
+    def __init__(self, ttl_seconds=None, max_entries=None):
+        self.ttl = ttl_seconds or Config.IDEMPOTENCY_TTL_SECONDS
+        self.max_entries = max_entries or Config.IDEMPOTENCY_MAX_ENTRIES
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'executed': 0, 'replayed': 0, 'attached': 0, 'mismatched': 0}
+        register_memory_source('idempotency', self._size_bytes, self._evict, priority=30)
+
+    def begin(self, key, fingerprint):
+        """Return (entry, owner); owner is True when the caller must run the handler"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry, False
+            entry = _Entry(fingerprint)
+            self._entries[key] = entry
+            self._trim()
+            self.stats['executed'] += 1
+            return entry, True
+
+    def finish(self, key, entry, response_data):
+        entry.response = response_data
+        entry.done.set()
+        status = response_data[1]
+        if status >= 500 or status in TRANSIENT_STATUSES:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+
+    def report(self):
+        with self._lock:
+            running = sum(1 for entry in self._entries.values() if not entry.done.is_set())
+            return {'entries': len(self._entries), 'running': running, 'stats': dict(self.stats)}
+
+    def _expire(self, now):
+        # Entries are in creation order, so expired ones are at the front
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.created < self.ttl or not entry.done.is_set():
+                break
+            del self._entries[key]
+
+    def _trim(self):
+        excess = len(self._entries) - self.max_entries
+        for key in list(self._entries.keys()):
+            if excess <= 0:
+                break
+            if self._entries[key].done.is_set():
+                del self._entries[key]
+                excess -= 1
+
+    def _size_bytes(self):
+        with self._lock:
+            return sum(deep_sizeof(entry.response) + 200 for entry in self._entries.values())
+
+    def _evict(self, fraction):
+        with self._lock:
+            finished = [key for key, entry in self._entries.items() if entry.done.is_set()]
+            drop = finished[:max(1, int(len(finished) * fraction))] if finished else []
+            for key in drop:
+                del self._entries[key]
+            return len(drop)
+
+
+idempotency_store = IdempotencyStore()
+
+
+def idempotent(view):
+    """Deduplicate POST requests carrying an Idempotency-Key header"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not client_key:
+            return view(*args, **kwargs)
+        if len(client_key) > 255:
+            return jsonify({'error': f'{IDEMPOTENCY_HEADER} must be at most 255 characters'}), 400
+
+        key = f"{current_tenant()}:{request.path}:{client_key}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        entry, owner = idempotency_store.begin(key, fingerprint)
+
+        if not owner:
+            if entry.fingerprint != fingerprint:
+                idempotency_store.stats['mismatched'] += 1
+                return jsonify({'error': f'{IDEMPOTENCY_HEADER} was already used with a different request body'}), 422
+            if not entry.done.is_set():
+                idempotency_store.stats['attached'] += 1
+                deadline = current_deadline()
+                wait = deadline.remaining() if deadline is not None else Config.IDEMPOTENCY_WAIT_SECONDS
+                if not entry.done.wait(max(0.0, wait)):
+                    return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+            else:
+                idempotency_store.stats['replayed'] += 1
+            return _replay(entry.response)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception as e:
+            logger.error(f"Idempotent handler for {request.path} failed: {str(e)}")
+            # Waiters get the error and the key can be retried
+            idempotency_store.finish(key, entry, (b'{"error": "request failed"}', 500,
+                                                  [('Content-Type', 'application/json')]))
+            raise
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name.lower() not in _UNSTORED_HEADERS]
+        idempotency_store.finish(key, entry, (response.get_data(), response.status_code, headers))
+        return response
+
+    return wrapper
+
+
+def _replay(response_data):
+    body, status, headers = response_data
+    response = Response(body, status=status, headers=headers)
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
@@ -0,0 +1,348 @@
+"""Request tracing: spans with W3C trace context and a batching exporter.
+
+Each request gets a server span, continuing the trace in the ``traceparent``
+header when the client sent one. Code below it opens child spans with
+``start_span()`` or ``@traced``; the current span lives in a context
+variable, so spans follow the request into ``call_with_deadline`` worker
+threads. ``set_span_attributes()`` annotates the current span from code that
+does not own it.
+
+Spans of a trace are held until its local root ends and then kept when the
+trace was sampled (TRACE_SAMPLE_RATE, or the caller's sampled flag), took at
+least TRACE_SLOW_MS, or failed, so tail-latency outliers are always kept
+whole. Kept spans go to a background exporter that sends batches to
+OTEL_EXPORTER_OTLP_ENDPOINT as OTLP/HTTP JSON, or appends them to
+TRACE_JSONL_PATH when no collector is configured; that file is rotated at
+TRACE_JSONL_MAX_BYTES and only TRACE_JSONL_MAX_FILES rotated files are kept.
+"""
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from config import Config
+from utils.logger import logger
+
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# Spans buffered per trace before the keep/drop decision; the rest are counted as dropped
+MAX_SPANS_PER_TRACE = 256
+
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_current_span = contextvars.ContextVar('trace_span', default=None)
+
+
+def parse_traceparent(header: Optional[str]):
+    """(trace_id, parent_span_id, sampled) from a W3C traceparent header, or None if it is invalid"""
+    match = _TRACEPARENT.match((header or "").strip().lower())
+    if not match:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 0x01)
+
+
+class _LocalTrace:
+    """Spans of one trace recorded in this process, until the keep/drop decision"""
+
+    def __init__(self, sampled: bool):
+        self.sampled = sampled
+        self.spans = []
+        self.kept = None
+        self.lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], local_trace: _LocalTrace,
+                 kind: int = KIND_INTERNAL, attributes: Dict[str, Any] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = {key: value for key, value in (attributes or {}).items() if value is not None}
+        self.status = None
+        self.status_message = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._local_trace = local_trace
+        self.is_local_root = False
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self._local_trace.sampled else '00'}"
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        self.attributes.update((key, value) for key, value in attributes.items() if value is not None)
+
+    def set_error(self, message: str):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def end(self, is_root: bool = False):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        local_trace = self._local_trace
+        with local_trace.lock:
+            if local_trace.kept is None:
+                if len(local_trace.spans) < MAX_SPANS_PER_TRACE:
+                    local_trace.spans.append(self)
+                else:
+                    exporter.count_dropped(1)
+                if not is_root:
+                    return
+                local_trace.kept = (local_trace.sampled or self.status == STATUS_ERROR
+                                    or self.duration_ms >= Config.TRACE_SLOW_MS)
+                spans, local_trace.spans = local_trace.spans, []
+            else:
+                # Ended after its root (background work): follows the root's decision
+                spans = [self]
+        if local_trace.kept:
+            exporter.export(spans)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.end_ns,
+            'durationMs': round(self.duration_ms, 3),
+            'attributes': self.attributes,
+            'status': {'code': self.status or STATUS_OK, 'message': self.status_message}
+        }
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def set_span_attributes(attributes: Dict[str, Any]):
+    """Annotate the current span, if there is one"""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attributes(attributes)
+
+
+def begin_span(name: str, traceparent: Optional[str] = None, kind: int = KIND_INTERNAL,
+               attributes: Dict[str, Any] = None):
+    """Start a span (child of the current one, of traceparent, or a new trace) and make it current.
+
+    Returns (span, token); pass both to finish_span(). Used where the start and
+    end are in different hooks, such as before_request/teardown_request.
+    """
+    if not Config.TRACING_ENABLED:
+        return None, None
+    parent = _current_span.get()
+    if parent is not None:
+        span = Span(name, parent.trace_id, parent.span_id, parent._local_trace, kind, attributes)
+        return span, _current_span.set(span)
+    remote = parse_traceparent(traceparent)
+    if remote is not None:
+        trace_id, parent_id, sampled = remote
+    else:
+        trace_id, parent_id, sampled = os.urandom(16).hex(), None, False
+    # A caller's unsampled flag is no veto: the trace may still be sampled here, or kept for being slow
+    sampled = sampled or random.random() < Config.TRACE_SAMPLE_RATE
+    span = Span(name, trace_id, parent_id, _LocalTrace(sampled), kind, attributes)
+    span.is_local_root = True
+    return span, _current_span.set(span)
+
+
+def finish_span(span: Optional[Span], token, error: Optional[BaseException] = None):
+    if span is None:
+        return
+    if error is not None:
+        span.set_error(f"{type(error).__name__}: {error}")
+    _current_span.reset(token)
+    span.end(is_root=span.is_local_root)
+
+
+@contextlib.contextmanager
+def start_span(name: str, attributes: Dict[str, Any] = None, kind: int = KIND_INTERNAL):
+    """Context manager for a child span of the current one (or a new trace); yields the span or None"""
+    span, token = begin_span(name, kind=kind, attributes=attributes)
+    try:
+        yield span
+    except BaseException as e:
+        finish_span(span, token, e)
+        raise
+    finish_span(span, token)
+
+
+def traced(name: str, kind: int = KIND_INTERNAL):
+    """Decorator: run the function inside a span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with start_span(name, kind=kind):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class BatchSpanExporter:
+    """Queues finished spans and ships them from a background thread in batches"""
+
+    def __init__(self):
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self.stats = {'exported': 0, 'dropped': 0, 'batches': 0, 'failures': 0, 'rotations': 0}
+
+    def export(self, spans: List[Span]):
+        with self._lock:
+            overflow = len(self._queue) + len(spans) - Config.TRACE_QUEUE_SIZE
+            if overflow > 0:
+                # Keep the newest spans; a collector outage must not grow memory
+                self.stats['dropped'] += overflow
+                for _ in range(min(overflow, len(self._queue))):
+                    self._queue.popleft()
+                spans = spans[max(0, len(spans) - Config.TRACE_QUEUE_SIZE):]
+            self._queue.extend(spans)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._export_loop, name='trace-exporter', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            if len(self._queue) >= Config.TRACE_EXPORT_BATCH_SIZE:
+                self._wakeup.notify()
+
+    def count_dropped(self, count: int):
+        with self._lock:
+            self.stats['dropped'] += count
+
+    def flush(self):
+        """Export everything queued so far (used at exit)"""
+        while True:
+            with self._lock:
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), Config.TRACE_EXPORT_BATCH_SIZE))]
+            if not batch:
+                return
+            self._send(batch)
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                self.stats,
+                enabled=Config.TRACING_ENABLED,
+                queued=len(self._queue),
+                target=Config.OTEL_EXPORTER_OTLP_ENDPOINT or os.path.abspath(Config.TRACE_JSONL_PATH),
+                sampleRate=Config.TRACE_SAMPLE_RATE,
+                slowMs=Config.TRACE_SLOW_MS
+            )
+
+    def _export_loop(self):
+        while True:
+            with self._lock:
+                if len(self._queue) < Config.TRACE_EXPORT_BATCH_SIZE:
+                    self._wakeup.wait(Config.TRACE_EXPORT_INTERVAL_MS / 1000.0)
+            self.flush()
+
+    def _send(self, batch: List[Span]):
+        try:
+            if Config.OTEL_EXPORTER_OTLP_ENDPOINT:
+                self._send_otlp(batch)
+            else:
+                self._append_jsonl(batch)
+            with self._lock:
+                self.stats['exported'] += len(batch)
+                self.stats['batches'] += 1
+        except Exception as e:
+            with self._lock:
+                self.stats['failures'] += 1
+                self.stats['dropped'] += len(batch)
+            logger.warning(f"Trace export of {len(batch)} spans failed: {str(e)}")
+
+    def _send_otlp(self, batch: List[Span]):
+        url = Config.OTEL_EXPORTER_OTLP_ENDPOINT.rstrip('/') + '/v1/traces'
+        response = requests.post(url, json=otlp_payload(batch), timeout=Config.TRACE_EXPORT_TIMEOUT_SECONDS)
+        response.raise_for_status()
+
+    def _append_jsonl(self, batch: List[Span]):
+        directory = os.path.dirname(os.path.abspath(Config.TRACE_JSONL_PATH))
+        os.makedirs(directory, exist_ok=True)
+        with open(Config.TRACE_JSONL_PATH, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(span.to_dict(), default=str) + '\n' for span in batch))
+            size = f.tell()
+        if Config.TRACE_JSONL_MAX_BYTES and size >= Config.TRACE_JSONL_MAX_BYTES:
+            self._rotate_jsonl()
+
+    def _rotate_jsonl(self):
+        # spans.jsonl -> spans.jsonl.1 -> ... -> spans.jsonl.<TRACE_JSONL_MAX_FILES>, the oldest is dropped
+        path = Config.TRACE_JSONL_PATH
+        try:
+            if Config.TRACE_JSONL_MAX_FILES <= 0:
+                os.remove(path)
+            else:
+                for index in range(Config.TRACE_JSONL_MAX_FILES - 1, 0, -1):
+                    if os.path.exists(f"{path}.{index}"):
+                        os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+                os.replace(path, f"{path}.1")
+        except FileNotFoundError:
+            # Another worker appending to the same file rotated it first
+            return
+        with self._lock:
+            self.stats['rotations'] += 1
+
+
+def otlp_payload(batch: List[Span]) -> Dict[str, Any]:
+    """OTLP/HTTP JSON ExportTraceServiceRequest for a batch of spans"""
+    spans = []
+    for span in batch:
+        entry = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': span.kind,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+            'status': {'code': span.status or STATUS_OK}
+        }
+        if span.parent_id:
+            entry['parentSpanId'] = span.parent_id
+        if span.status_message:
+            entry['status']['message'] = span.status_message
+        spans.append(entry)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_otlp_attribute('service.name', Config.TRACE_SERVICE_NAME)]},
+        'scopeSpans': [{'scope': {'name': 'visa-qa-pack'}, 'spans': spans}]
+    }]}
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+exporter = BatchSpanExporter()